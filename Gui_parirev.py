@@ -1,16 +1,101 @@
 # Gui_Parirev.py
 from __future__ import annotations
-import os, sys, subprocess, shutil
+import os, sys, subprocess, shutil, threading
 from pathlib import Path
 import tkinter as tk
 from tkinter import messagebox
-from Swarky import BASE_NAME, map_location, _docno_from_match
+from Swarky import BASE_NAME, map_location, _docno_from_match, same_content, list_dir_cached, archived_path, thumbnail_cache
 
 LIGHT_BG = "#eef3f9"
 NAVY_BG  = "#000080"
 NAVY_SEL = "#133869"
 FG_LIGHT = "light gray"
 FG_WHITE = "white"
+FG_SAME  = "#86efac"  # identico all'archivio
+
+PREFETCH_MAX = 200  # anteprime preparate in anticipo a ogni refresh
+
+class ThumbPair(tk.Frame):
+    """Anteprime affiancate: il file in revisione e la sua copia in archivio."""
+    def __init__(self, master: tk.Misc, cfg, left_title: str) -> None:
+        super().__init__(master, bg=LIGHT_BG)
+        self.cfg = cfg
+        self.thumbs = thumbnail_cache(cfg)
+        self._name = ""
+        self._imgs: dict = {}  # Tk non trattiene le PhotoImage
+        self._lbl: dict = {}
+        for col, (key, title) in enumerate((("src", left_title), ("arch", "Archivio"))):
+            self.columnconfigure(col, weight=1)
+            tk.Label(self, text=title, bg=LIGHT_BG).grid(row=0, column=col, sticky="w")
+            lbl = tk.Label(self, bg=NAVY_BG, fg=FG_LIGHT, text="", width=45, height=14)
+            lbl.grid(row=1, column=col, sticky="nsew", padx=(0, 4) if col == 0 else (4, 0))
+            self._lbl[key] = lbl
+
+    def _set(self, key: str, png=None, text: str = "") -> None:
+        lbl = self._lbl[key]
+        if png is None:
+            self._imgs.pop(key, None)
+            lbl.config(image="", text=text, width=45, height=14)
+            return
+        try:
+            img = tk.PhotoImage(file=str(png))
+        except tk.TclError:
+            lbl.config(image="", text="Anteprima non leggibile", width=45, height=14)
+            return
+        self._imgs[key] = img
+        lbl.config(image=img, text="", width=0, height=0)
+
+    def _done(self, name: str, key: str, missing: str = "Anteprima non disponibile"):
+        def _cb(_src, png) -> None:
+            def _apply() -> None:
+                if name == self._name:
+                    self._set(key, png, "" if png else missing)
+            try:
+                self.after(0, _apply)
+            except (tk.TclError, RuntimeError):
+                pass  # finestra chiusa
+        return _cb
+
+    def show(self, src: Path) -> None:
+        name = src.name
+        self._name = name
+        if not self.thumbs.max_bytes:
+            for key in self._lbl:
+                self._set(key, None, "Anteprime disattivate")
+            return
+        if not self.thumbs.available():
+            for key in self._lbl:
+                self._set(key, None, "Anteprime: installare Pillow")
+            return
+        for key in self._lbl:
+            self._set(key, None, "…")
+        self.thumbs.submit(src, self._done(name, "src"))
+        def _arch() -> None:
+            try:
+                arch = archived_path(self.cfg, name)
+            except Exception:
+                arch = None
+            if arch is None:
+                self._done(name, "arch", "Non in archivio")(None, None)
+            else:
+                self.thumbs.submit(arch, self._done(name, "arch"))
+        threading.Thread(target=_arch, daemon=True).start()
+
+    def prefetch(self, paths: list) -> None:
+        """Prepara in background le anteprime di paths e delle loro copie in archivio."""
+        if not (self.thumbs.max_bytes and self.thumbs.available()):
+            return
+        paths = paths[:PREFETCH_MAX]
+        def _run() -> None:
+            for p in paths:
+                self.thumbs.submit(p)
+                try:
+                    arch = archived_path(self.cfg, p.name)
+                except Exception:
+                    arch = None
+                if arch is not None:
+                    self.thumbs.submit(arch)
+        threading.Thread(target=_run, daemon=True).start()
 
 def _open_path(path: Path) -> None:
     try:
@@ -34,7 +119,7 @@ class PariRevWindow(tk.Toplevel):
         # ===== griglia finestra: 2 colonne sopra + info + LOG sotto =====
         self.columnconfigure(0, weight=1)
         self.columnconfigure(1, weight=1)
-        self.rowconfigure(2, weight=1)  # il LOG si espande
+        self.rowconfigure(3, weight=1)  # il LOG si espande
 
         PAD = 8
         LABEL_PADY = (0,4)
@@ -72,9 +157,11 @@ class PariRevWindow(tk.Toplevel):
         self.btn_getnumber = tk.Button(btns, text="Get Number",     width=BTN_W, command=self._not_implemented)
         self.btn_goto      = tk.Button(btns, text="GoTo Folder",    width=BTN_W, command=self._goto_dest_folder)
         self.btn_srdir     = tk.Button(btns, text="Goto Sr Folder", width=BTN_W, command=self._goto_sr_folder)
+        self.btn_same      = tk.Button(btns, text="Check Identical", width=BTN_W, command=self._check_identical)
 
-        for i, b in enumerate((self.btn_sr_go, self.btn_getnumber, self.btn_goto, self.btn_srdir)):
-            pady = (0,3) if i == 0 else (3,0) if i == 3 else 3
+        buttons = (self.btn_sr_go, self.btn_getnumber, self.btn_goto, self.btn_srdir, self.btn_same)
+        for i, b in enumerate(buttons):
+            pady = (0,3) if i == 0 else (3,0) if i == len(buttons) - 1 else 3
             b.pack(fill="x", expand=True, pady=pady)
 
         # ----- info dimensione disegno -----
@@ -83,9 +170,13 @@ class PariRevWindow(tk.Toplevel):
             row=1, column=0, columnspan=2, sticky="w", padx=PAD, pady=(0,PAD)
         )
 
+        # ----- anteprime: pari revisione | archivio -----
+        self.preview = ThumbPair(self, cfg, "Pari Revisione")
+        self.preview.grid(row=2, column=0, columnspan=2, sticky="ew", padx=PAD, pady=(0, PAD))
+
         # ----- LOG sotto -----
         logf = tk.Frame(self, bg=LIGHT_BG)
-        logf.grid(row=2, column=0, columnspan=2, sticky="nsew", padx=PAD, pady=(0, PAD))
+        logf.grid(row=3, column=0, columnspan=2, sticky="nsew", padx=PAD, pady=(0, PAD))
         logf.columnconfigure(0, weight=1)
         logf.rowconfigure(1, weight=1)
 
@@ -119,10 +210,8 @@ class PariRevWindow(tk.Toplevel):
 
         try:
             base = self.cfg.PARI_REV_DIR
-            patterns = ["*.tif", "*.TIF"]
-            if getattr(self.cfg, "ACCEPT_PDF", True):
-                patterns += ["*.pdf", "*.PDF"]
-            names = sorted({p.name for pat in patterns for p in base.glob(pat) if p.is_file()}, key=str.lower)
+            exts = (".tif", ".pdf") if getattr(self.cfg, "ACCEPT_PDF", True) else (".tif",)
+            names = sorted(list_dir_cached(base, exts), key=str.lower)
         except Exception:
             names = []
 
@@ -133,6 +222,8 @@ class PariRevWindow(tk.Toplevel):
         lb.delete(0, tk.END)
         for nm in names:
             lb.insert(tk.END, nm)
+        seen = set(old)
+        self.preview.prefetch([base / nm for nm in names if nm not in seen])
 
         if saved in names:
             idx = names.index(saved)
@@ -165,6 +256,9 @@ class PariRevWindow(tk.Toplevel):
     def _on_select(self, _evt=None) -> None:
         self._copy_docno_prefix()
         self._update_size_label()
+        sel = self.lst_srfolder.curselection()
+        if sel:
+            self.preview.show(Path(self.cfg.PARI_REV_DIR) / self.lst_srfolder.get(sel[0]))
 
     # -------- azioni --------
     def _open_selected(self, _evt=None) -> None:
@@ -229,20 +323,18 @@ class PariRevWindow(tk.Toplevel):
 
             try:
                 loc = map_location(m, self.cfg)
-                target_dir = loc["dir_tif_loc"]
                 human_loc = self._pretty_loc(loc)
             except Exception as e:
                 messagebox.showerror("FSR", f"map_location fallita:\n{e}")
                 return
 
-            dest = target_dir / nm
-            if not dest.exists():
+            dest = archived_path(self.cfg, nm)
+            if dest is None:
                 messagebox.showwarning("FSR", f"NON presente in Archivio (non aggiornato):\n{nm}\n→ {human_loc}")
                 self._log(f"{nm} → {human_loc}: assente in archivio")
                 return
 
             try:
-                target_dir.mkdir(parents=True, exist_ok=True)
                 shutil.copy2(src, dest)  # overwrite
                 self._log(f"{nm} → {human_loc}: copiato (overwrite)")
             except Exception as e:
@@ -251,6 +343,57 @@ class PariRevWindow(tk.Toplevel):
         finally:
             self.btn_sr_go.config(state="normal")
 
+    # -------- confronto contenuto con l'archivio --------
+    def _check_identical(self) -> None:
+        """Confronta in background ogni file Pari Revisione con la copia in archivio."""
+        names = list(self.lst_srfolder.get(0, tk.END))
+        if not names:
+            return
+        self.btn_same.config(state="disabled")
+        self._log(f"Confronto contenuto di {len(names)} file...")
+        threading.Thread(target=self._check_identical_worker, args=(names,), daemon=True).start()
+
+    def _check_identical_worker(self, names: list[str]) -> None:
+        identical: list[str] = []
+        different: list[str] = []
+        for nm in names:
+            m = BASE_NAME.fullmatch(nm)
+            if not m:
+                continue
+            try:
+                arch = archived_path(self.cfg, nm)
+                if arch is not None and same_content(self.cfg.PARI_REV_DIR / nm, arch):
+                    identical.append(nm)
+                else:
+                    different.append(nm)
+            except Exception:
+                different.append(nm)
+        self.after(0, lambda: self._on_identical_done(identical, different))
+
+    def _on_identical_done(self, identical: list[str], different: list[str]) -> None:
+        self.btn_same.config(state="normal")
+        for nm in different:
+            self._log(f"{nm}: DIVERSO dall'archivio")
+        names = list(self.lst_srfolder.get(0, tk.END))
+        for nm in identical:
+            if nm in names:
+                self.lst_srfolder.itemconfig(names.index(nm), fg=FG_SAME)
+        self._log(f"Identici: {len(identical)} • Diversi: {len(different)}")
+        if not identical:
+            return
+        if not messagebox.askyesno("FSR", f"{len(identical)} file identici all'archivio.\nEliminarli da Pari Revisione?"):
+            return
+        removed = 0
+        for nm in identical:
+            try:
+                (self.cfg.PARI_REV_DIR / nm).unlink()
+                removed += 1
+                self._log(f"{nm}: identico, eliminato")
+            except Exception as e:
+                self._log(f"{nm}: ERRORE eliminazione → {e}")
+        self._log(f"Eliminati {removed} duplicati identici")
+        self.refresh_list()
+
     # -------- window helpers --------
     def _center_on_parent(self) -> None:
         try:
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import sys, re, time, logging, json, os
-from dataclasses import dataclass
+import time
+_T_IMPORT0 = time.perf_counter()
+# moduli usati solo da sottocomandi o opzioni (zipfile, mmap, http.server, csv, ...) si importano
+# dentro le funzioni che li usano: l'avvio della GUI e di --watch non li paga
+import sys, re, logging, json, os, hashlib, threading, queue, struct
+from array import array
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, replace as dc_replace
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional, Dict, Any, Tuple
 
-# Solo Windows
-if sys.platform != "win32":
-    raise RuntimeError("Questo programma è supportato solo su Windows.")
-
 # ---- CONFIG DATACLASS ----------------------------------------------------------------
 
 @dataclass(frozen=True)
@@ -27,9 +30,30 @@ class Config:
     DIR_PLM_ERROR: Path
     DIR_TABELLARI: Path
     LOG_DIR: Optional[Path] = None
+    CLOCK_PROBE_DIR: Optional[Path] = None  # cartella dedicata alla sonda orologio server (oltre a LOG_DIR)
     LOG_LEVEL: int = logging.INFO
     ACCEPT_PDF: bool = True
     LOG_PHASES: bool = True  # <— flag GUI/FILE per log fasi
+    PARI_REV_DISCARD_IDENTICAL: bool = False  # pari rev identici all'archivio: scarta invece di PARI_REV_DIR
+    NODE_ID: Optional[str] = None  # multi-nodo: id di questa istanza (None = nodo singolo)
+    LEASE_SEC: int = 300           # multi-nodo: durata lease docno / heartbeat nodo
+    CLAIM_BATCH: int = 50          # multi-nodo: file reclamati per giro
+    JOURNAL: bool = True           # write-ahead journal delle azioni post-accettazione
+    DIR_CACHE: bool = True         # cache persistente degli elenchi cartella, validata da mtime
+    SHARD_DIGITS: int = 0          # >0: archivio/storico in sottocartelle per prime cifre del numero
+    FS_TIMEOUT_SEC: float = 60.0   # scadenza operazioni su share (0 = nessuna)
+    FS_COPY_TIMEOUT_SEC: float = 300.0  # scadenza copie e letture intere di file
+    BREAKER_FAILS: int = 3         # timeout consecutivi che sospendono un host
+    BREAKER_COOLDOWN_SEC: int = 300  # sospensione host; i file parcheggiati si riprovano dopo questo tempo
+    STREAM_CHUNK: int = 0          # >0: scan/classificazione/processing in pipeline a blocchi di N file
+    STREAM_QUEUE: int = 4          # blocchi in attesa tra uno stadio e il successivo
+    DOCNO_FILTER: bool = True      # usa il filtro docno (se costruito) per saltare l'enumerazione dei nuovi docno
+    FS_STATS: bool = False         # conteggio/tempi operazioni FS per tipo, host, fase e file
+    STORICO_PACK: bool = False     # storico in contenitori zip per docno invece che file sciolti
+    THUMB_CACHE_MB: int = 200      # cache locale anteprime (GUI); 0 = anteprime disattivate
+    EVENT_LOG: bool = False        # eventi JSON-lines (uno per riga di log) accanto al log testuale
+    TRACE: bool = False            # trace Chrome/Perfetto per batch (fasi + operazioni FS per thread)
+    DEEP_TIFF_CHECK: bool = False  # verifica struttura TIFF (IFD, strip/tile, compressione) prima dell'archivio
 
     @staticmethod
     def from_json(d: Dict[str, Any]) -> "Config":
@@ -40,6 +64,7 @@ class Config:
                 raise KeyError(f"Config mancante: paths.{key}")
             return Path(val)
         log_dir = p.get("log_dir")
+        clock_probe = p.get("clock_probe")
         return Config(
             DIR_HPLOTTER=P("hplotter"),
             ARCHIVIO_DISEGNI=P("archivio"),
@@ -53,9 +78,30 @@ class Config:
             DIR_PLM_ERROR=P("error_plm"),
             DIR_TABELLARI=P("tab"),
             LOG_DIR=Path(log_dir) if log_dir else None,
+            CLOCK_PROBE_DIR=Path(clock_probe) if clock_probe else None,
             LOG_LEVEL=logging.INFO,
             ACCEPT_PDF=bool(d.get("ACCEPT_PDF", True)),
             LOG_PHASES=bool(d.get("LOG_PHASES", True)),
+            PARI_REV_DISCARD_IDENTICAL=bool(d.get("PARI_REV_DISCARD_IDENTICAL", False)),
+            NODE_ID=os.environ.get("SWARKY_NODE_ID") or d.get("NODE_ID") or None,
+            LEASE_SEC=int(d.get("LEASE_SEC", 300)),
+            CLAIM_BATCH=int(d.get("CLAIM_BATCH", 50)),
+            JOURNAL=bool(d.get("JOURNAL", True)),
+            DIR_CACHE=bool(d.get("DIR_CACHE", True)),
+            SHARD_DIGITS=int(d.get("SHARD_DIGITS", 0)),
+            FS_TIMEOUT_SEC=float(d.get("FS_TIMEOUT_SEC", 60.0)),
+            FS_COPY_TIMEOUT_SEC=float(d.get("FS_COPY_TIMEOUT_SEC", 300.0)),
+            BREAKER_FAILS=int(d.get("BREAKER_FAILS", 3)),
+            BREAKER_COOLDOWN_SEC=int(d.get("BREAKER_COOLDOWN_SEC", 300)),
+            STREAM_CHUNK=int(d.get("STREAM_CHUNK", 0)),
+            STREAM_QUEUE=int(d.get("STREAM_QUEUE", 4)),
+            DOCNO_FILTER=bool(d.get("DOCNO_FILTER", True)),
+            FS_STATS=bool(d.get("FS_STATS", False)),
+            STORICO_PACK=bool(d.get("STORICO_PACK", False)),
+            THUMB_CACHE_MB=int(d.get("THUMB_CACHE_MB", 200)),
+            EVENT_LOG=bool(d.get("EVENT_LOG", False)),
+            TRACE=bool(d.get("TRACE", False)),
+            DEEP_TIFF_CHECK=bool(d.get("DEEP_TIFF_CHECK", False)),
         )
 
 # ---- REGEX ---------------------------------------------------------------------------
@@ -65,175 +111,612 @@ ISS_BASENAME = re.compile(r"G(\d{4})([A-Za-z0-9]{4})([A-Za-z0-9]{6})ISSR(\d{2})S
 
 # ---- PREFISSO DOCNO: LISTA NOMI SENZA ENUM COMPLETA -------------------------
 
-import ctypes
-import ctypes.wintypes as wt
-
-INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
-FILE_ATTRIBUTE_DIRECTORY = 0x10
-FIND_FIRST_EX_LARGE_FETCH = 2
-FindExInfoBasic = 1
-FindExSearchNameMatch = 0
-ERROR_FILE_NOT_FOUND = 2
-ERROR_PATH_NOT_FOUND = 3
-
-class WIN32_FIND_DATAW(ctypes.Structure):
-    _fields_ = [
-        ("dwFileAttributes", wt.DWORD),
-        ("ftCreationTime", wt.FILETIME),
-        ("ftLastAccessTime", wt.FILETIME),
-        ("ftLastWriteTime", wt.FILETIME),
-        ("nFileSizeHigh", wt.DWORD),
-        ("nFileSizeLow", wt.DWORD),
-        ("dwReserved0", wt.DWORD),
-        ("dwReserved1", wt.DWORD),
-        ("cFileName", ctypes.c_wchar * 260),
-        ("cAlternateFileName", ctypes.c_wchar * 14),
-    ]
+if sys.platform == "win32":
+    import ctypes
+    import ctypes.wintypes as wt
+
+    INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+    FILE_ATTRIBUTE_DIRECTORY = 0x10
+    FIND_FIRST_EX_LARGE_FETCH = 2
+    FindExInfoBasic = 1
+    FindExSearchNameMatch = 0
+    ERROR_FILE_NOT_FOUND = 2
+    ERROR_PATH_NOT_FOUND = 3
+
+    class WIN32_FIND_DATAW(ctypes.Structure):
+        _fields_ = [
+            ("dwFileAttributes", wt.DWORD),
+            ("ftCreationTime", wt.FILETIME),
+            ("ftLastAccessTime", wt.FILETIME),
+            ("ftLastWriteTime", wt.FILETIME),
+            ("nFileSizeHigh", wt.DWORD),
+            ("nFileSizeLow", wt.DWORD),
+            ("dwReserved0", wt.DWORD),
+            ("dwReserved1", wt.DWORD),
+            ("cFileName", ctypes.c_wchar * 260),
+            ("cAlternateFileName", ctypes.c_wchar * 14),
+        ]
+
+    _k32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _FindFirstFileW = _k32.FindFirstFileW
+    _FindFirstFileW.argtypes = [wt.LPCWSTR, ctypes.POINTER(WIN32_FIND_DATAW)]
+    _FindFirstFileW.restype = wt.HANDLE
+    _FindNextFileW = _k32.FindNextFileW
+    _FindNextFileW.argtypes = [wt.HANDLE, ctypes.POINTER(WIN32_FIND_DATAW)]
+    _FindNextFileW.restype = wt.BOOL
+    _FindClose = _k32.FindClose
+    _FindClose.argtypes = [wt.HANDLE]
+    _FindClose.restype = wt.BOOL
 
-_k32 = ctypes.WinDLL("kernel32", use_last_error=True)
-_FindFirstFileW = _k32.FindFirstFileW
-_FindFirstFileW.argtypes = [wt.LPCWSTR, ctypes.POINTER(WIN32_FIND_DATAW)]
-_FindFirstFileW.restype = wt.HANDLE
-_FindNextFileW = _k32.FindNextFileW
-_FindNextFileW.argtypes = [wt.HANDLE, ctypes.POINTER(WIN32_FIND_DATAW)]
-_FindNextFileW.restype = wt.BOOL
-_FindClose = _k32.FindClose
-_FindClose.argtypes = [wt.HANDLE]
-_FindClose.restype = wt.BOOL
-
-try:
-    _FindFirstFileExW = _k32.FindFirstFileExW
-    _FindFirstFileExW.argtypes = [
-        wt.LPCWSTR,
-        ctypes.c_int,
-        ctypes.POINTER(WIN32_FIND_DATAW),
-        ctypes.c_int,
-        ctypes.c_void_p,
-        wt.DWORD,
-    ]
-    _FindFirstFileExW.restype = wt.HANDLE
-except AttributeError:
-    _FindFirstFileExW = None
-
-def _win_find_names(dirp: Path, pattern: str) -> tuple[str, ...]:
-    query = str(dirp / pattern)
-    data = WIN32_FIND_DATAW()
-    h = _FindFirstFileW(query, ctypes.byref(data))
-    if h == INVALID_HANDLE_VALUE:
-        return tuple()
-    names: list[str] = []
     try:
-        while True:
-            nm = data.cFileName
-            if nm not in (".", "..") and not (data.dwFileAttributes & FILE_ATTRIBUTE_DIRECTORY):
-                names.append(nm)
-            if not _FindNextFileW(h, ctypes.byref(data)):
-                break
-    finally:
-        _FindClose(h)
-    return tuple(names)
-
-def _win_find_names_ex(dirp: Path, pattern: str) -> tuple[str, ...]:
-    if _FindFirstFileExW is None:
-        return _win_find_names(dirp, pattern)
-    query = str(dirp / pattern)
-    data = WIN32_FIND_DATAW()
-    h = _FindFirstFileExW(
-        query,
-        FindExInfoBasic,
-        ctypes.byref(data),
-        FindExSearchNameMatch,
-        None,
-        FIND_FIRST_EX_LARGE_FETCH,
-    )
-    if h == INVALID_HANDLE_VALUE:
-        err = ctypes.get_last_error()
-        if err in (ERROR_FILE_NOT_FOUND, ERROR_PATH_NOT_FOUND):
+        _FindFirstFileExW = _k32.FindFirstFileExW
+        _FindFirstFileExW.argtypes = [
+            wt.LPCWSTR,
+            ctypes.c_int,
+            ctypes.POINTER(WIN32_FIND_DATAW),
+            ctypes.c_int,
+            ctypes.c_void_p,
+            wt.DWORD,
+        ]
+        _FindFirstFileExW.restype = wt.HANDLE
+    except AttributeError:
+        _FindFirstFileExW = None
+
+    def _win_find_names(dirp: Path, pattern: str) -> tuple[str, ...]:
+        query = str(dirp / pattern)
+        data = WIN32_FIND_DATAW()
+        h = _FindFirstFileW(query, ctypes.byref(data))
+        if h == INVALID_HANDLE_VALUE:
             return tuple()
-        return _win_find_names(dirp, pattern)
-    names: list[str] = []
+        names: list[str] = []
+        try:
+            while True:
+                nm = data.cFileName
+                if nm not in (".", "..") and not (data.dwFileAttributes & FILE_ATTRIBUTE_DIRECTORY):
+                    names.append(nm)
+                if not _FindNextFileW(h, ctypes.byref(data)):
+                    break
+        finally:
+            _FindClose(h)
+        return tuple(names)
+
+    def _win_find_names_ex(dirp: Path, pattern: str) -> tuple[str, ...]:
+        if _FindFirstFileExW is None:
+            return _win_find_names(dirp, pattern)
+        query = str(dirp / pattern)
+        data = WIN32_FIND_DATAW()
+        h = _FindFirstFileExW(
+            query,
+            FindExInfoBasic,
+            ctypes.byref(data),
+            FindExSearchNameMatch,
+            None,
+            FIND_FIRST_EX_LARGE_FETCH,
+        )
+        if h == INVALID_HANDLE_VALUE:
+            err = ctypes.get_last_error()
+            if err in (ERROR_FILE_NOT_FOUND, ERROR_PATH_NOT_FOUND):
+                return tuple()
+            return _win_find_names(dirp, pattern)
+        names: list[str] = []
+        try:
+            while True:
+                nm = data.cFileName
+                if nm not in (".", "..") and not (data.dwFileAttributes & FILE_ATTRIBUTE_DIRECTORY):
+                    names.append(nm)
+                if not _FindNextFileW(h, ctypes.byref(data)):
+                    break
+        finally:
+            _FindClose(h)
+        return tuple(names)
+
+    # ---- CopyFile2 + fallback CopyFileW -----------------------------------------
+
+    class COPYFILE2_EXTENDED_PARAMETERS(ctypes.Structure):
+        _fields_ = [
+            ("dwSize", wt.DWORD),
+            ("dwCopyFlags", wt.DWORD),
+            ("pfCancel", ctypes.POINTER(wt.BOOL)),
+            ("pProgressRoutine", ctypes.c_void_p),
+            ("pvCallbackContext", ctypes.c_void_p),
+        ]
+
+    COPY_FILE_FAIL_IF_EXISTS  = 0x00000001
+    COPY_FILE_RESTARTABLE     = 0x00000002
+
     try:
-        while True:
-            nm = data.cFileName
-            if nm not in (".", "..") and not (data.dwFileAttributes & FILE_ATTRIBUTE_DIRECTORY):
-                names.append(nm)
-            if not _FindNextFileW(h, ctypes.byref(data)):
-                break
-    finally:
-        _FindClose(h)
-    return tuple(names)
-
-# ---- CopyFile2 + fallback CopyFileW -----------------------------------------
-
-class COPYFILE2_EXTENDED_PARAMETERS(ctypes.Structure):
-    _fields_ = [
-        ("dwSize", wt.DWORD),
-        ("dwCopyFlags", wt.DWORD),
-        ("pfCancel", ctypes.POINTER(wt.BOOL)),
-        ("pProgressRoutine", ctypes.c_void_p),
-        ("pvCallbackContext", ctypes.c_void_p),
-    ]
+        _CopyFile2 = _k32.CopyFile2
+        _CopyFile2.argtypes = [wt.LPCWSTR, wt.LPCWSTR, ctypes.POINTER(COPYFILE2_EXTENDED_PARAMETERS)]
+        _CopyFile2.restype  = wt.HRESULT
+        _HAS_COPYFILE2 = True
+    except AttributeError:
+        _CopyFile2 = None
+        _HAS_COPYFILE2 = False
 
-COPY_FILE_FAIL_IF_EXISTS  = 0x00000001
-COPY_FILE_RESTARTABLE     = 0x00000002
-
-try:
-    _CopyFile2 = _k32.CopyFile2
-    _CopyFile2.argtypes = [wt.LPCWSTR, wt.LPCWSTR, ctypes.POINTER(COPYFILE2_EXTENDED_PARAMETERS)]
-    _CopyFile2.restype  = wt.HRESULT
-    _HAS_COPYFILE2 = True
-except AttributeError:
-    _CopyFile2 = None
-    _HAS_COPYFILE2 = False
-
-_k32.CopyFileW.argtypes = [wt.LPCWSTR, wt.LPCWSTR, wt.BOOL]
-_k32.CopyFileW.restype  = wt.BOOL
-
-def _win_copyfile_basic(src: Path, dst: Path, *, overwrite: bool = True) -> None:
-    ok = _k32.CopyFileW(str(src), str(dst), wt.BOOL(not overwrite))
-    if not ok:
-        err = ctypes.get_last_error()
-        raise OSError(err, f"CopyFileW failed {src} -> {dst} (err={err})")
-
-def _copy_file_best(src: Path, dst: Path, *, overwrite: bool = True) -> None:
-    if _HAS_COPYFILE2:
-        try:
-            params = COPYFILE2_EXTENDED_PARAMETERS()
-            params.dwSize = ctypes.sizeof(COPYFILE2_EXTENDED_PARAMETERS)
-            params.dwCopyFlags = COPY_FILE_RESTARTABLE | (COPY_FILE_FAIL_IF_EXISTS if not overwrite else 0)
-            params.pfCancel = None
-            params.pProgressRoutine = None
-            params.pvCallbackContext = None
-            hr = _CopyFile2(str(src), str(dst), ctypes.byref(params))
-            if hr == 0:  # S_OK
-                return
-            logging.debug("CopyFile2 hr=0x%08X for %s -> %s; fallback a CopyFileW", hr & 0xFFFFFFFF, src, dst)
-        except Exception as ex:
-            logging.debug("CopyFile2 exception %r for %s -> %s; fallback a CopyFileW", ex, src, dst)
-    _win_copyfile_basic(src, dst, overwrite=overwrite)
+    _k32.CopyFileW.argtypes = [wt.LPCWSTR, wt.LPCWSTR, wt.BOOL]
+    _k32.CopyFileW.restype  = wt.BOOL
+
+    def _win_copyfile_basic(src: Path, dst: Path, *, overwrite: bool = True) -> None:
+        ok = _k32.CopyFileW(str(src), str(dst), wt.BOOL(not overwrite))
+        if not ok:
+            err = ctypes.get_last_error()
+            raise OSError(err, f"CopyFileW failed {src} -> {dst} (err={err})")
+
+    def _copy_file_best(src: Path, dst: Path, *, overwrite: bool = True) -> None:
+        if _HAS_COPYFILE2:
+            try:
+                params = COPYFILE2_EXTENDED_PARAMETERS()
+                params.dwSize = ctypes.sizeof(COPYFILE2_EXTENDED_PARAMETERS)
+                params.dwCopyFlags = COPY_FILE_RESTARTABLE | (COPY_FILE_FAIL_IF_EXISTS if not overwrite else 0)
+                params.pfCancel = None
+                params.pProgressRoutine = None
+                params.pvCallbackContext = None
+                hr = _CopyFile2(str(src), str(dst), ctypes.byref(params))
+                if hr == 0:  # S_OK
+                    return
+                logging.debug("CopyFile2 hr=0x%08X for %s -> %s; fallback a CopyFileW", hr & 0xFFFFFFFF, src, dst)
+            except Exception as ex:
+                logging.debug("CopyFile2 exception %r for %s -> %s; fallback a CopyFileW", ex, src, dst)
+        _win_copyfile_basic(src, dst, overwrite=overwrite)
+
+else:
+    # Fallback POSIX (test/benchmark multi-processo su Linux): stessa semantica, API standard.
+    import fnmatch, shutil
+
+    def _win_find_names_ex(dirp: Path, pattern: str) -> tuple[str, ...]:
+        pat = pattern.lower()
+        try:
+            with os.scandir(dirp) as it:
+                return tuple(de.name for de in it
+                             if fnmatch.fnmatchcase(de.name.lower(), pat) and de.is_file())
+        except (FileNotFoundError, NotADirectoryError):
+            return tuple()
+
+    def _copy_file_best(src: Path, dst: Path, *, overwrite: bool = True) -> None:
+        if not overwrite and os.path.exists(dst):
+            raise FileExistsError(17, f"copy failed {src} -> {dst}: destinazione esistente")
+        shutil.copy2(src, dst)
 
 # ---- UTILS PREFISSO ---------------------------------------------------------
 
 def _docno_from_match(m: re.Match) -> str:
     return f"D{m.group(1)}{m.group(2)}{m.group(3)}"
 
-def _parse_prefixed(names: tuple[str, ...]) -> list[tuple[str, str, str, str]]:
-    """-> [(rev, name, metric, sheet)]  (rev='02', metric in {M,I,D,N}, sheet='01')"""
-    out: list[tuple[str, str, str, str]] = []
+METRIC_GROUP = {"M": "MI", "I": "MI", "D": "DN", "N": "DN"}
+
+class ArchEntry:
+    """File d'archivio di un docno: rev/sheet interi, metric = lettera maiuscola (M/I/D/N);
+    dir = cartella in cui è stato trovato (shard o cartella piatta in migrazione)."""
+    __slots__ = ("rev", "sheet", "metric", "name", "dir")
+
+    def __init__(self, rev: int, sheet: int, metric: str, name: str, dir: Optional[Path] = None):
+        self.rev = rev
+        self.sheet = sheet
+        self.metric = metric
+        self.name = name
+        self.dir = dir
+
+    def __repr__(self) -> str:
+        return f"ArchEntry({self.name})"
+
+class SheetSummary:
+    """Vista per (docno, sheet): max rev per metrica e per gruppo (MI/DN) in O(1),
+    con il primo file (in ordine di enumerazione) che la detiene come riferimento."""
+    __slots__ = ("entries", "top_metric", "top_group")
+
+    def __init__(self, entries: List[ArchEntry]):
+        self.entries = entries
+        self.top_metric: Dict[str, ArchEntry] = {}
+        self.top_group: Dict[str, ArchEntry] = {}
+        for e in entries:
+            top = self.top_metric.get(e.metric)
+            if top is None or e.rev > top.rev:
+                self.top_metric[e.metric] = e
+            grp = METRIC_GROUP.get(e.metric)
+            if grp is not None:
+                top = self.top_group.get(grp)
+                if top is None or e.rev > top.rev:
+                    self.top_group[grp] = e
+
+    def max_metric(self, metric: str) -> Optional[int]:
+        e = self.top_metric.get(metric)
+        return e.rev if e is not None else None
+
+    def max_group(self, group: str) -> Optional[int]:
+        e = self.top_group.get(group)
+        return e.rev if e is not None else None
+
+    def in_group(self, group: str):
+        return (e for e in self.entries if METRIC_GROUP.get(e.metric) == group)
+
+def _parse_prefixed(names: tuple[str, ...], dirp: Optional[Path] = None) -> List[ArchEntry]:
+    out: List[ArchEntry] = []
     for nm in names:
         mm = BASE_NAME.fullmatch(nm)
         if mm:
-            out.append((mm.group(4), nm, mm.group(6).upper(), mm.group(5)))
+            out.append(ArchEntry(int(mm.group(4)), int(mm.group(5)), mm.group(6).upper(), nm, dirp))
     return out
 
-def _list_same_doc_prefisso(dirp: Path, m: re.Match) -> list[tuple[str, str, str, str]]:
-    """Riduce i round-trip SMB enumerando docno* una sola volta e filtrando in RAM, senza ordinare."""
-    docno = _docno_from_match(m)
-    names_all = _win_find_names_ex(dirp, f"{docno}*")
-    if not names_all:
-        return []
-    names = tuple(nm for nm in names_all if nm.lower().endswith((".tif", ".pdf")))
-    return _parse_prefixed(names)
+def _sheet_summary(entries: List[ArchEntry], sheet: int) -> SheetSummary:
+    return SheetSummary([e for e in entries if e.sheet == sheet])
+
+def _list_same_doc_prefisso(dirp: Path, docno: str, flat: Optional[Path] = None) -> List[ArchEntry]:
+    """Riduce i round-trip SMB enumerando docno* una sola volta e filtrando in RAM, senza ordinare.
+    Se la cartella non è cambiata dall'ultima enumerazione l'elenco arriva dalla cache.
+    flat = cartella piatta non ancora migrata agli shard, enumerata anche lei e per prima:
+    migrate-shards sposta solo piatta → shard, quindi un file spostato tra le due enumerazioni
+    compare in entrambe (vale la copia nello shard) invece di mancare da tutte e due."""
+    out: List[ArchEntry] = []
+    seen: Dict[str, int] = {}
+    for d in (flat, dirp) if flat is not None else (dirp,):
+        names_all = _DIRCACHE.find_names(d, f"{docno}*")
+        if names_all:
+            names = tuple(nm for nm in names_all if nm.lower().endswith((".tif", ".pdf")))
+            for e in _parse_prefixed(names, d):
+                j = seen.get(e.name.lower())
+                if j is None:
+                    seen[e.name.lower()] = len(out)
+                    out.append(e)
+                else:
+                    out[j] = e
+    return out
+
+# ---- CACHE ELENCHI CARTELLA (persistente, validata dall'mtime della cartella) --------
+
+class _ServerClock:
+    """Ora del server di una share: scarto tra l'mtime di un file sonda (.swarky_clock) appena
+    riscritto e l'orologio locale. L'mtime di una cartella lo mette il server, quindi va
+    confrontato con il suo orologio. La sonda si scrive solo in LOG_DIR e in paths.clock_probe
+    (mai nelle share di archivio, PLM, ...) e vale per le cartelle dello stesso host. Per un
+    host senza sonda, o con sonda non scrivibile, l'ora è quella locale meno SKEW_NS: finestra
+    "racy" prudente, le cartelle cambiate negli ultimi minuti si rileggono."""
+    PROBE = ".swarky_clock"
+    REPROBE_SEC = 300.0
+    SKEW_NS = 120_000_000_000
+
+    def __init__(self):
+        self.probes: Dict[str, Path] = {}
+        self.offset: Dict[str, tuple[Optional[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, cfg: Config) -> None:
+        probes: Dict[str, Path] = {}
+        for d in (cfg.CLOCK_PROBE_DIR, cfg.LOG_DIR):
+            if d is not None:
+                probes.setdefault(_fs_host(d), d)
+        if probes != self.probes:
+            self.probes, self.offset = probes, {}
+
+    def now_ns(self, dirp: Path) -> int:
+        host = _fs_host(dirp)
+        root = self.probes.get(host)
+        if root is None:
+            return time.time_ns() - self.SKEW_NS
+        with self._lock:
+            off, t = self.offset.get(host, (None, -self.REPROBE_SEC))
+            if time.monotonic() - t >= self.REPROBE_SEC:
+                off = self._probe(root)
+                self.offset[host] = (off, time.monotonic())
+        return time.time_ns() + off if off is not None else time.time_ns() - self.SKEW_NS
+
+    def _probe(self, root: Path) -> Optional[int]:
+        probe = root / self.PROBE
+        def _touch() -> int:
+            root.mkdir(parents=True, exist_ok=True)
+            with open(probe, "wb") as f:
+                f.write(b"swarky")
+            return os.stat(probe).st_mtime_ns
+        try:
+            t0 = time.time_ns()
+            mtime = _fs_call("write", probe, _touch)
+            return mtime - (t0 + time.time_ns()) // 2
+        except FsTimeout:
+            raise
+        except OSError as e:
+            logging.debug("Orologio server di %s non leggibile (%s): finestra prudente", root, e)
+            return None
+
+_CLOCK = _ServerClock()
+
+class _DirListCache:
+    """cartella -> {chiave: valore calcolato dall'elenco}, riusato finché l'mtime della
+    cartella non cambia (un cambio di mtime scarta tutte le chiavi della cartella). Un mtime
+    troppo vicino all'ora del server al momento della lettura non è affidabile (granularità
+    del timestamp su SMB/FAT): quelle voci vengono ricalcolate. Sfratto LRU per cartella;
+    il file si riscrive solo se qualcosa è cambiato."""
+    RACY_NS = 2_000_000_000
+    MAX_ENTRIES = 50_000
+    MAX_TAGS = 256      # chiavi per cartella (find:<docno>* su cartelle d'archivio grandi)
+
+    def __init__(self):
+        self.path: Optional[Path] = None
+        self.enabled = False
+        self.data: "OrderedDict[str, list]" = OrderedDict()   # [mtime, ora server, {chiave: valore}]
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def bind(self, cfg: Config) -> None:
+        suffix = f"_{cfg.NODE_ID}" if cfg.NODE_ID else ""
+        path = (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / f"Swarky{suffix}_dircache.json"
+        self.enabled = cfg.DIR_CACHE
+        _CLOCK.bind(cfg)
+        if path == self.path:
+            return
+        self.path = path
+        self.data = OrderedDict()
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            if isinstance(data, dict):
+                self.data = OrderedDict((k, v) for k, v in data.items()
+                                        if isinstance(v, list) and len(v) == 3 and isinstance(v[2], dict))
+        except (OSError, ValueError):
+            pass
+        self.dirty = False
+
+    def cached(self, dirp: Path, tag: str, compute):
+        if not self.enabled:
+            return _fs_call("list", dirp, compute)
+        try:
+            mtime = _fs_call("stat", dirp, os.stat, dirp).st_mtime_ns
+        except FsTimeout:
+            raise
+        except OSError:
+            return _fs_call("list", dirp, compute)
+        key = str(dirp).lower()
+        with self._lock:
+            ent = self.data.get(key)
+            if ent is not None and ent[0] == mtime and ent[1] - mtime > self.RACY_NS and tag in ent[2]:
+                self.data.move_to_end(key)
+                return ent[2][tag]
+        val = _fs_call("list", dirp, compute)
+        now = _CLOCK.now_ns(dirp)
+        with self._lock:
+            ent = self.data.get(key)
+            if ent is None or ent[0] != mtime:
+                ent = self.data[key] = [mtime, now, {}]
+                self.dirty = True
+            elif now > ent[1]:
+                if ent[1] - mtime <= self.RACY_NS < now - mtime:
+                    self.dirty = True       # voce diventata affidabile
+                ent[1] = now
+            tags = ent[2]
+            if tags.get(tag) != val:
+                tags.pop(tag, None)
+                tags[tag] = val
+                if len(tags) > self.MAX_TAGS:
+                    tags.pop(next(iter(tags)))
+                self.dirty = True
+            self.data.move_to_end(key)
+            while len(self.data) > self.MAX_ENTRIES:
+                self.data.popitem(last=False)
+        return val
+
+    def find_names(self, dirp: Path, pattern: str) -> tuple[str, ...]:
+        return tuple(self.cached(dirp, f"find:{pattern.lower()}", lambda: list(_win_find_names_ex(dirp, pattern))))
+
+    def save(self) -> None:
+        if not (self.enabled and self.dirty and self.path):
+            return
+        with self._lock:
+            text = json.dumps(self.data)
+            self.dirty = False
+        tmp = self.path.with_suffix(".tmp")
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, self.path)
+
+_DIRCACHE = _DirListCache()
+
+def list_dir_cached(dirp: Path, exts: tuple[str, ...]) -> List[str]:
+    """Nomi dei file in dirp con estensione in exts (minuscole), via cache se la cartella è invariata."""
+    def _scan() -> List[str]:
+        with os.scandir(dirp) as it:
+            return [de.name for de in it if de.is_file() and os.path.splitext(de.name)[1].lower() in exts]
+    return list(_DIRCACHE.cached(dirp, "list:" + ",".join(exts), _scan))
+
+def list_dir_head(dirp: Path, exts: tuple[str, ...], limit: int) -> Tuple[List[str], int]:
+    """Primi `limit` nomi in ordine alfabetico (case-insensitive) e totale, senza tenere in
+    memoria l'elenco intero: per le viste su cartelle con decine di migliaia di file."""
+    import heapq
+    def _scan() -> list:
+        total = 0
+        def _names():
+            nonlocal total
+            with os.scandir(dirp) as it:
+                for de in it:
+                    if de.is_file() and os.path.splitext(de.name)[1].lower() in exts:
+                        total += 1
+                        yield de.name
+        head = heapq.nsmallest(limit, _names(), key=str.lower)
+        return [total, head]
+    total, head = _DIRCACHE.cached(dirp, f"head{limit}:" + ",".join(exts), _scan)
+    return list(head), int(total)
+
+# ---- FILTRO DOCNO (Bloom): primo arrivo di un docno senza enumerare l'archivio -------
+
+class _DocnoFilter:
+    """Bloom filter dei docno presenti in archivio, costruito da `build-docno-filter` e
+    aggiornato a ogni archiviazione. "Assente" è una risposta certa solo per le cartelle il cui
+    mtime è quello registrato dopo l'ultima scrittura di Swarky: una scrittura altrui (a mano,
+    altro processo, ripristino journal) toglie la cartella dal filtro fino alla ricostruzione.
+    Come in _DirListCache, un mtime registrato troppo vicino all'ora del server (RACY_NS) non
+    basta: un file aggiunto subito dopo, nella stessa granularità, non lo cambierebbe. Quella
+    cartella non è affidabile finché la finestra non è passata; poi una sola rilettura ne
+    aggiunge i docno al filtro e rinnova la registrazione.
+    Non usato in multi-nodo: gli altri nodi archiviano senza aggiornare questo filtro."""
+    FP_RATE = 0.001
+
+    def __init__(self):
+        self.path: Optional[Path] = None
+        self.enabled = False
+        self.m = 0
+        self.k = 0
+        self.n = 0
+        self.cap = 0
+        self.bits = bytearray()
+        self.dirs: Dict[str, list] = {}   # cartella -> [mtime, ora server alla registrazione]
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def file_for(cfg: Config) -> Path:
+        return (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / "Swarky_docnos.bloom"
+
+    def bind(self, cfg: Config) -> None:
+        path = self.file_for(cfg)
+        if path != self.path:
+            self.path = path
+            self._load()
+        self.enabled = cfg.DOCNO_FILTER and not cfg.NODE_ID and self.m > 0
+
+    def _load(self) -> None:
+        self.m = self.k = self.n = self.cap = 0
+        self.bits, self.dirs, self.dirty = bytearray(), {}, False
+        try:
+            raw = self.path.read_bytes()
+            head, _, bits = raw.partition(b"\n")
+            meta = json.loads(head)
+            if len(bits) != (int(meta["m"]) + 7) // 8:
+                raise ValueError("dimensione non coerente")
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Filtro docno illeggibile (%s): ignorato", e)
+            return
+        self.m, self.k, self.n, self.cap = int(meta["m"]), int(meta["k"]), int(meta["n"]), int(meta["cap"])
+        self.bits = bytearray(bits)
+        self.dirs = {str(d): ([int(t), int(t)] if isinstance(t, int) else [int(t[0]), int(t[1])])
+                     for d, t in meta.get("dirs", {}).items()}
+
+    def reset(self, capacity: int) -> None:
+        import math
+        cap = max(1000, capacity)
+        m = int(-cap * math.log(self.FP_RATE) / (math.log(2) ** 2))
+        self.m, self.k, self.n, self.cap = m, max(1, round(m / cap * math.log(2))), 0, cap
+        self.bits = bytearray((m + 7) // 8)
+        self.dirs = {}
+        self.dirty = True
+
+    def _positions(self, docno: str):
+        h = hashlib.blake2b(docno.upper().encode("ascii", "replace"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(h[:8], "little"), int.from_bytes(h[8:], "little") | 1
+        return ((h1 + j * h2) % self.m for j in range(self.k))
+
+    def add(self, docno: str) -> None:
+        with self._lock:
+            for b in self._positions(docno):
+                self.bits[b >> 3] |= 1 << (b & 7)
+            self.n += 1
+            self.dirty = True
+
+    def maybe(self, docno: str) -> bool:
+        return all(self.bits[b >> 3] & (1 << (b & 7)) for b in self._positions(docno))
+
+    def _mtime(self, dirp: Path) -> Optional[int]:
+        try:
+            return _fs_call("stat", dirp, os.stat, dirp).st_mtime_ns
+        except FsTimeout:
+            raise
+        except OSError:
+            return None
+
+    def _drop(self, key: str) -> None:
+        with self._lock:
+            self.dirs.pop(key, None)
+            self.dirty = True
+
+    def _trusted(self, dirp: Path) -> bool:
+        key = str(dirp).lower()
+        rec = self.dirs.get(key)
+        if rec is None:
+            return False
+        mtime = self._mtime(dirp)
+        if mtime != rec[0]:
+            self._drop(key)
+            return False
+        if rec[1] - mtime > _DirListCache.RACY_NS:
+            return True
+        now = _CLOCK.now_ns(dirp)
+        if now - mtime <= _DirListCache.RACY_NS:
+            return False            # ancora nella finestra: percorso normale, registrazione tenuta
+        return self._verify(dirp, key, mtime, now)
+
+    def _verify(self, dirp: Path, key: str, mtime: int, now: int) -> bool:
+        """Rilegge una cartella registrata nella finestra racy: i suoi docno entrano nel filtro."""
+        def _scan() -> set[str]:
+            out: set[str] = set()
+            with os.scandir(dirp) as it:
+                for de in it:
+                    mm = BASE_NAME.fullmatch(de.name)
+                    if mm and de.is_file():
+                        out.add(_docno_from_match(mm).upper())
+            return out
+        try:
+            docnos = _fs_call("list", dirp, _scan)
+        except FsTimeout:
+            raise
+        except OSError:
+            self._drop(key)
+            return False
+        if self._mtime(dirp) != mtime:
+            self._drop(key)
+            return False
+        for dn in docnos:
+            if not self.maybe(dn):
+                self.add(dn)
+        with self._lock:
+            self.dirs[key] = [mtime, now]
+            self.dirty = True
+        return True
+
+    def absent(self, docno: str, *dirs: Optional[Path]) -> bool:
+        """True solo se docno certamente non è in nessuna delle cartelle (None = ignorata)."""
+        if not self.enabled or self.maybe(docno):
+            return False
+        if not all(self._trusted(d) for d in dirs if d is not None):
+            return False
+        return not self.maybe(docno)    # una rilettura può averlo appena aggiunto
+
+    def record(self, dirp: Path) -> None:
+        mtime = self._mtime(dirp)
+        if mtime is None:
+            return
+        now = _CLOCK.now_ns(dirp)
+        with self._lock:
+            self.dirs[str(dirp).lower()] = [mtime, now]
+            self.dirty = True
+
+    @contextmanager
+    def writing(self, dirs, docno: Optional[str] = None):
+        """Intorno a una scrittura di Swarky in cartelle d'archivio: le cartelle ancora affidabili
+        prima della scrittura lo restano (nuovo mtime registrato), le altre restano fuori."""
+        if not self.enabled:
+            yield
+            return
+        keep = [d for d in dict.fromkeys(dirs) if d is not None and self._trusted(d)]
+        try:
+            yield
+        finally:
+            if docno:
+                self.add(docno)
+            for d in keep:
+                self.record(d)
+
+    def save(self) -> None:
+        if not (self.dirty and self.path and self.m):
+            return
+        with self._lock:
+            meta = {"v": 2, "m": self.m, "k": self.k, "n": self.n, "cap": self.cap, "dirs": dict(self.dirs)}
+            bits = bytes(self.bits)
+            self.dirty = False
+        if self.n > self.cap:
+            logging.warning("Filtro docno oltre capacità (%d/%d): ricostruire con build-docno-filter", self.n, self.cap)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_bytes(json.dumps(meta).encode("utf-8") + b"\n" + bits)
+        os.replace(tmp, self.path)
+
+_DOCNOS = _DocnoFilter()
 
 # ---- LOGGING -------------------------------------------------------------------------
 
@@ -277,16 +760,521 @@ def setup_logging(cfg: Config):
 def _append_filelog_line(line: str) -> None:
     _FILE_LOG_BUF.append(line)
 
-def _flush_file_log(cfg: Config) -> None:
+def _flush_file_log(cfg: Config) -> bool:
+    """Scrive le righe del batch; se la scrittura fallisce restano nel buffer per il batch
+    successivo (e i passi 'log' del journal restano aperti). -> True se tutto è su file."""
     if not _FILE_LOG_BUF:
-        return
+        return True
     log_path = (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / f"Swarky_{month_tag()}.log"
-    try:
+    text = "\n".join(_FILE_LOG_BUF) + "\n"
+    def _append() -> None:
         log_path.parent.mkdir(parents=True, exist_ok=True)
         with log_path.open("a", encoding="utf-8") as f:
-            f.write("\n".join(_FILE_LOG_BUF) + "\n")
+            f.write(text)
+    try:
+        _fs_call("append", log_path, _append)
+    except OSError as e:        # FsTimeout compreso: righe ripetute al prossimo flush piuttosto che perse
+        logging.error("Log %s non scritto (%d righe, riprovo al prossimo batch): %s",
+                      log_path.name, len(_FILE_LOG_BUF), e)
+        return False
+    _FILE_LOG_BUF.clear()
+    return True
+
+# ---- FS CON SCADENZA: timeout per operazione + circuit breaker per host ---------------
+#
+# Una chiamata SMB appesa non si può interrompere: _fs_call la esegue in un pool fisso di
+# thread daemon e, scaduto il tempo, la abbandona sollevando FsTimeout. Una chiamata ancora in
+# coda viene annullata; una modifica (rename, copy, unlink, ...) già partita può invece
+# concludersi dopo: resta in _FS.inflight finché il thread non torna, e replay_journal non
+# chiude i piani che la riguardano. BREAKER_FAILS timeout entro BREAKER_COOLDOWN_SEC
+# sospendono l'host per BREAKER_COOLDOWN_SEC (ShareDown, senza tentare): una share che
+# appende solo alcune operazioni va comunque isolata.
+
+class FsTimeout(OSError):
+    """Operazione su share oltre la scadenza (il thread resta appeso in background)."""
+
+class ShareDown(FsTimeout):
+    """Host sospeso dal circuit breaker: operazione non tentata."""
+
+_SLOW_OPS = frozenset(("copy", "read", "link"))
+_READ_OPS = frozenset(("stat", "list", "scan", "read"))
+
+class _FsTask:
+    __slots__ = ("fn", "args", "kw", "op", "path", "state", "result", "error", "done")
+
+    def __init__(self, op: str, path: Path, fn, args, kw):
+        self.op, self.path, self.fn, self.args, self.kw = op, path, fn, args, kw
+        self.state = "queued"       # queued | running | cancelled | abandoned | done
+        self.result = self.error = None
+        self.done = threading.Event()
+
+def _fs_host(path: Path) -> str:
+    s = str(path)
+    if s.startswith(("\\\\", "//")):
+        return s[2:].replace("/", "\\").split("\\", 1)[0].lower()
+    return os.path.splitdrive(s)[0].lower() or "local"
+
+class _FsGuard:
+    WORKERS = 16
+
+    def __init__(self):
+        self.timeout = 0.0
+        self.copy_timeout = 0.0
+        self.max_fails = 3
+        self.cooldown = 300.0
+        self.fails: Dict[str, deque] = {}
+        self.down_until: Dict[str, float] = {}
+        self.inflight: Dict[int, _FsTask] = {}    # modifiche scadute ma ancora in corso
+        self._lock = threading.Lock()
+        self._q: "queue.Queue[_FsTask]" = queue.Queue()
+        self._workers = 0
+        self._local = threading.local()
+
+    def bind(self, cfg: Config) -> None:
+        _FSSIM.bind(cfg)
+        self.timeout = cfg.FS_TIMEOUT_SEC
+        self.copy_timeout = max(cfg.FS_COPY_TIMEOUT_SEC, cfg.FS_TIMEOUT_SEC)
+        self.max_fails = max(1, cfg.BREAKER_FAILS)
+        self.cooldown = float(cfg.BREAKER_COOLDOWN_SEC)
+
+    def host_down(self, host: str) -> bool:
+        until = self.down_until.get(host)
+        return until is not None and time.monotonic() < until
+
+    def _worker(self) -> None:
+        self._local.worker = True
+        while True:
+            t = self._q.get()
+            with self._lock:
+                if t.state == "cancelled":
+                    continue
+                t.state = "running"
+            try:
+                t.result = t.fn(*t.args, **t.kw)
+            except BaseException as e:
+                t.error = e
+            with self._lock:
+                t.state = "done"
+                self.inflight.pop(id(t), None)
+            t.done.set()
+
+    def busy(self, *paths: Path) -> bool:
+        """True se una modifica scaduta su uno di questi percorsi può ancora concludersi."""
+        keys = {str(p).lower() for p in paths}
+        with self._lock:
+            return any(str(t.path).lower() in keys or any(str(a).lower() in keys for a in t.args
+                                                          if isinstance(a, (str, Path)))
+                       for t in self.inflight.values())
+
+    def call(self, op: str, path: Path, fn, *args, **kw):
+        if self.timeout <= 0 or getattr(self._local, "worker", False):
+            return fn(*args, **kw)      # senza scadenze, o annidata: vale la scadenza di fuori
+        host = _fs_host(path)
+        if self.host_down(host):
+            raise ShareDown(f"{op}: host {host} sospeso: {path}")
+        t = _FsTask(op, path, fn, args, kw)
+        with self._lock:
+            if self._workers < self.WORKERS:
+                self._workers += 1
+                threading.Thread(target=self._worker, name=f"swarky-fs{self._workers}", daemon=True).start()
+        self._q.put(t)
+        limit = self.copy_timeout if op in _SLOW_OPS else self.timeout
+        if not t.done.wait(limit):
+            with self._lock:
+                if t.state == "queued":
+                    t.state = "cancelled"
+                elif t.state == "running" and op not in _READ_OPS:
+                    t.state = "abandoned"
+                    self.inflight[id(t)] = t
+            if t.state != "done":
+                self._timed_out(host, op, path, limit)
+        if t.error is not None:
+            raise t.error
+        return t.result
+
+    def _timed_out(self, host: str, op: str, path: Path, limit: float):
+        now = time.monotonic()
+        with self._lock:
+            recent = self.fails.setdefault(host, deque())
+            recent.append(now)
+            while recent and now - recent[0] > self.cooldown:
+                recent.popleft()
+            n = len(recent)
+            if n >= self.max_fails:
+                self.down_until[host] = now + self.cooldown
+                recent.clear()
+        if n >= self.max_fails:
+            logging.error("Host %s non risponde (%d timeout): sospeso per %ds", host, n, int(self.cooldown))
+        raise FsTimeout(f"{op} oltre {limit:g}s: {path}")
+
+_FS = _FsGuard()
+
+# ---- SIMULAZIONE SHARE: latenza iniettata (benchmark/CI su disco locale) --------------
+#
+# SWARKY_FS_SIM=<profilo.json> fa precedere ogni _fs_call da un ritardo che imita una share SMB,
+# dentro la scadenza di _FsGuard (uno stallo lungo produce un vero FsTimeout). Profilo:
+#   {"seed": 1,
+#    "*":        {"latency_ms": 2},
+#    "archivio": {"latency_ms": 25, "jitter_ms": 10, "mbps": 40, "stall_p": 0.001, "stall_sec": 8,
+#                 "rtt": {"copy": 3, "list": 2}}}
+# chiavi = nomi di config.json/paths (hplotter, archivio, plm, storico, ...) o prefissi di percorso;
+# rtt = round trip per tipo di operazione (default 1), mbps = MB/s per copy e read.
+# Profilo assente o non valido: errore nel log e simulazione spenta. Passano da _fs_call anche
+# log, journal, claim, lease e la scansione a fette dello streaming; restano fuori solo i file
+# di servizio in LOG_DIR (eventi JSON, cache elenchi, filtro docno, statistiche, trace).
+
+_SIM_PATH_KEYS = {
+    "hplotter": "DIR_HPLOTTER", "archivio": "ARCHIVIO_DISEGNI", "error_dir": "ERROR_DIR",
+    "pari_rev": "PARI_REV_DIR", "plm": "PLM_DIR", "storico": "ARCHIVIO_STORICO", "iss": "DIR_ISS",
+    "fiv": "DIR_FIV_LOADING", "heng": "DIR_HENGELO", "error_plm": "DIR_PLM_ERROR",
+    "tab": "DIR_TABELLARI", "log_dir": "LOG_DIR",
+}
+
+class _FsSim:
+    def __init__(self):
+        self.source: Optional[str] = None
+        self.rules: List[Tuple[str, dict]] = []
+        self.default: Optional[dict] = None
+        self.rnd = None     # random.Random del profilo (import solo con SWARKY_FS_SIM)
+        self._lock = threading.Lock()
+
+    def bind(self, cfg: Config) -> None:
+        source = os.environ.get("SWARKY_FS_SIM") or None
+        if source == self.source:
+            return
+        self.source, self.rules, self.default = source, [], None
+        if source is None:
+            return
+        try:
+            prof = json.loads(Path(source).read_text(encoding="utf-8"))
+            if not isinstance(prof, dict) or not all(isinstance(v, dict) for k, v in prof.items() if k != "seed"):
+                raise ValueError("atteso {chiave: {regola}}")
+            import random
+            rnd = random.Random(prof.get("seed"))
+            rules: List[Tuple[str, dict]] = []
+            for key, rule in prof.items():
+                if key in ("seed", "*"):
+                    continue
+                attr = _SIM_PATH_KEYS.get(key)
+                base = getattr(cfg, attr) if attr else Path(key)
+                if base is not None:
+                    rules.append((os.path.normcase(str(base)).rstrip("\\/"), rule))
+        except (OSError, ValueError, TypeError) as e:
+            logging.error("Simulazione FS %s non valida, disattivata: %s", source, e)
+            return
+        self.rnd, self.default = rnd, prof.get("*")
+        self.rules = sorted(rules, key=lambda r: -len(r[0]))
+        logging.warning("Simulazione FS attiva (%s): %d regole", source, len(self.rules) + bool(self.default))
+
+    def _rule(self, path: Path) -> Optional[dict]:
+        s = os.path.normcase(str(path))
+        for prefix, rule in self.rules:
+            if s == prefix or s.startswith(prefix) and s[len(prefix)] in "\\/":
+                return rule
+        return self.default
+
+    def delay(self, op: str, path: Path, args: tuple) -> float:
+        rule = self._rule(path)
+        if not rule:
+            return 0.0
+        with self._lock:
+            jitter = self.rnd.uniform(-1.0, 1.0)
+            stall = self.rnd.random() < float(rule.get("stall_p", 0.0))
+        rtt = float(rule.get("rtt", {}).get(op, 1))
+        sec = rtt * max(0.0, float(rule.get("latency_ms", 0.0)) + jitter * float(rule.get("jitter_ms", 0.0))) / 1000.0
+        mbps = float(rule.get("mbps", 0.0))
+        if mbps > 0 and op in ("copy", "read"):
+            src = args[0] if args and isinstance(args[0], Path) else path
+            try:
+                sec += src.stat().st_size / (mbps * 1_000_000)
+            except OSError:
+                pass
+        if stall:
+            sec += float(rule.get("stall_sec", 0.0))
+        return sec
+
+    def wrap(self, op: str, path: Path, fn, args: tuple):
+        if not (self.rules or self.default):
+            return fn
+        def _slow(*a, **kw):
+            time.sleep(self.delay(op, path, args))
+            return fn(*a, **kw)
+        return _slow
+
+_FSSIM = _FsSim()
+
+def _fs_call(op: str, path: Path, fn, *args, **kw):
+    fn = _FSSIM.wrap(op, path, fn, args)
+    if not (_FSSTATS.enabled or _TRACE.enabled):
+        return _FS.call(op, path, fn, *args, **kw)
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        r = _FS.call(op, path, fn, *args, **kw)
+        ok = True
+        return r
     finally:
-        _FILE_LOG_BUF.clear()
+        t1 = time.perf_counter()
+        if _FSSTATS.enabled:
+            _FSSTATS.add(op, path, t1 - t0, ok)
+        if _TRACE.enabled:
+            _TRACE.span(op, "fs", t0, t1, {"path": str(path), "ok": ok})
+
+# ---- CONTABILITÀ FS: chiamate e tempi per tipo, host, fase e file --------------------
+#
+# Ogni _fs_call (più le scritture degli eventi JSON, senza scadenza) viene attribuita alla fase
+# ui_phase in corso nel thread chiamante: "<file> • <fase>" dà file e fase; fuori fase vale il
+# file in lavorazione (_process_candidate), le fasi di batch (scan, ISS, ...) restano senza file. Un record per batch in Swarky_fsstats.jsonl.
+
+_PHASE = threading.local()
+
+def _phase_owner(label: str) -> tuple[str, str]:
+    """(file, fase) di un'etichetta ui_phase; senza "file • " vale il file in lavorazione."""
+    if " • " in label:
+        file, phase = label.split(" • ", 1)
+        return file, phase
+    return getattr(_PHASE, "file", ""), label
+
+class _FsStats:
+    def __init__(self):
+        self.enabled = False
+        self.path: Optional[Path] = None
+        self.ops: Dict[tuple[str, str, str], list] = {}
+        self.files: Dict[str, Dict[str, list]] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, cfg: Config) -> None:
+        self.enabled = cfg.FS_STATS
+        suffix = f"_{cfg.NODE_ID}" if cfg.NODE_ID else ""
+        self.path = (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / f"Swarky{suffix}_fsstats.jsonl"
+
+    def reset(self) -> None:
+        with self._lock:
+            self.ops, self.files = {}, {}
+
+    def add(self, op: str, path: Path, dt: float, ok: bool = True) -> None:
+        file, phase = _phase_owner(getattr(_PHASE, "label", ""))
+        key = (op, _fs_host(path), phase)
+        with self._lock:
+            st = self.ops.get(key)
+            if st is None:
+                st = self.ops[key] = [0, 0.0, 0]
+            st[0] += 1; st[1] += dt; st[2] += not ok
+            if file:
+                fs = self.files.setdefault(file, {}).setdefault(op, [0, 0.0])
+                fs[0] += 1; fs[1] += dt
+
+    @contextmanager
+    def timed(self, op: str, path: Path):
+        """Per le scritture che non passano da _fs_call (eventi JSON): solo conteggio."""
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.add(op, path, time.perf_counter() - t0, ok)
+
+    def flush(self, elapsed: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            ops, files = self.ops, self.files
+            self.ops, self.files = {}, {}
+        calls = sum(v[0] for v in ops.values())
+        sec = sum(v[1] for v in ops.values())
+        by_op: Dict[str, list] = {}
+        for (op, _h, _ph), v in ops.items():
+            t = by_op.setdefault(op, [0, 0.0])
+            t[0] += v[0]; t[1] += v[1]
+        rec = {
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "batch_sec": round(elapsed, 3),
+            "calls": calls,
+            "fs_sec": round(sec, 3),
+            "files": len(files),
+            "ops": [{"op": op, "host": h, "phase": ph, "n": v[0], "sec": round(v[1], 4), "err": v[2]}
+                    for (op, h, ph), v in sorted(ops.items(), key=lambda kv: -kv[1][1])],
+            "per_file": {f: {op: [v[0], round(v[1], 4)] for op, v in d.items()} for f, d in files.items()},
+        }
+        if files:
+            per = sum(sum(v[0] for v in d.values()) for d in files.values()) / len(files)
+            logging.info("FS: %d chiamate in %.2fs, %.1f per file (%s)", calls, sec, per,
+                         ", ".join(f"{op} {v[0]}" for op, v in sorted(by_op.items(), key=lambda kv: -kv[1][0])))
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(rec) + "\n")
+        except OSError as e:
+            logging.warning("Statistiche FS non scritte: %s", e)
+
+_FSSTATS = _FsStats()
+
+# ---- TRACE PER BATCH: formato trace-event di Chrome/Perfetto ----------------------------
+#
+# Con TRACE le fasi ui_phase e le _fs_call diventano eventi "X" (inizio + durata, µs dall'inizio
+# del batch) sul thread che le esegue; le fasi annidate si vedono una dentro l'altra. Un file
+# per batch con candidati (anche se nessuno è andato a buon fine) o durato almeno SLOW_SEC,
+# traces/Swarky_trace.<batch>.json nella cartella log (ultimi KEEP), da aprire in
+# chrome://tracing o ui.perfetto.dev.
+
+class _Tracer:
+    KEEP = 200
+    SLOW_SEC = 10.0     # un batch a vuoto ma lento (share appese, scan lunghi) lascia comunque il trace
+
+    def __init__(self):
+        self.enabled = False
+        self.dir: Optional[Path] = None
+        self.t0 = 0.0
+        self.events: List[dict] = []
+        self.threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, cfg: Config) -> None:
+        self.enabled = cfg.TRACE
+        self.dir = (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / "traces"
+
+    def begin(self) -> None:
+        with self._lock:
+            self.events, self.threads = [], {}
+        self.t0 = time.perf_counter()
+
+    def span(self, name: str, cat: str, t0: float, t1: float, args: Optional[dict] = None) -> None:
+        th = threading.current_thread()
+        ev = {"name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": th.ident,
+              "ts": round((t0 - self.t0) * 1e6, 1), "dur": round((t1 - t0) * 1e6, 1)}
+        if args:
+            ev["args"] = args
+        with self._lock:
+            self.events.append(ev)
+            self.threads.setdefault(th.ident, th.name)
+
+    def had_files(self) -> bool:
+        with self._lock:
+            return any(ev["cat"] == "file" for ev in self.events)
+
+    def save(self, batch: str) -> None:
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        with self._lock:
+            events, threads = self.events, self.threads
+            self.events, self.threads = [], {}
+        pid = os.getpid()
+        meta = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"Swarky {batch}"}}]
+        meta += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": nm}}
+                 for tid, nm in threads.items()]
+        meta.append({"name": "batch", "cat": "batch", "ph": "X", "pid": pid,
+                     "tid": threading.main_thread().ident, "ts": 0, "dur": round((end - self.t0) * 1e6, 1)})
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            path = self.dir / f"Swarky_trace.{batch}.json"
+            path.write_text(json.dumps({"traceEvents": meta + events, "displayTimeUnit": "ms"}),
+                            encoding="utf-8")
+            old = sorted(self.dir.glob("Swarky_trace.*.json"), key=lambda p: p.stat().st_mtime)
+            for p in old[:-self.KEEP]:
+                p.unlink(missing_ok=True)
+        except OSError as e:
+            logging.warning("Trace non scritta: %s", e)
+
+_TRACE = _Tracer()
+
+# ---- CACHE NEGATIVA: candidati che falliscono ripetutamente --------------------------
+
+class _FailureCache:
+    """nome -> [size, mtime_ns, tentativi, riprova_dopo (epoch), motivo], persistita accanto
+    ai log. Backoff esponenziale BASE_SEC·2^(n-1) fino a MAX_SEC; se il file cambia
+    (size/mtime) la voce decade e il file torna subito in lavorazione."""
+    BASE_SEC = 60.0
+    MAX_SEC = 6 * 3600.0
+
+    def __init__(self):
+        self.path: Optional[Path] = None
+        self.data: Dict[str, list] = {}
+        self.dirty = False
+        self.reported = 0
+
+    def bind(self, cfg: Config) -> None:
+        suffix = f"_{cfg.NODE_ID}" if cfg.NODE_ID else ""
+        path = (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / f"Swarky{suffix}_failures.json"
+        if path == self.path:
+            return
+        self.path = path
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            self.data = data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            self.data = {}
+        self.dirty = False
+
+    @staticmethod
+    def _sig(p: Path) -> Tuple[Optional[int], Optional[int]]:
+        try:
+            st = _fs_call("stat", p, os.stat, p)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None, None
+
+    def record(self, p: Path, why: str, min_delay: float = 0.0) -> None:
+        size, mtime = self._sig(p)
+        key = p.name.lower()
+        ent = self.data.get(key)
+        n = ent[2] + 1 if ent is not None and (size is None or ent[:2] == [size, mtime]) else 1
+        delay = max(min_delay, min(self.MAX_SEC, self.BASE_SEC * 2 ** (n - 1)))
+        self.data[key] = [size, mtime, n, time.time() + delay, why, p.name]
+        self.dirty = True
+        logging.warning("%s non riuscito (tentativo %d): %s — riprovo fra %ds", p.name, n, why, int(delay))
+
+    def blocked(self, p: Path) -> bool:
+        ent = self.data.get(p.name.lower())
+        if ent is None or time.time() >= ent[3]:
+            return False
+        if ent[0] is not None:
+            size, mtime = self._sig(p)
+            if size is not None and [size, mtime] != ent[:2]:
+                del self.data[p.name.lower()]
+                self.dirty = True
+                return False
+        return True
+
+    def waiting(self, name: str) -> bool:
+        """Come blocked ma senza I/O né modifiche: sicuro da un thread diverso da quello di run_once."""
+        ent = self.data.get(name.lower())
+        return ent is not None and time.time() < ent[3]
+
+    def forget(self, name: str) -> None:
+        if self.data.pop(name.lower(), None) is not None:
+            self.dirty = True
+
+    def prune(self, present: set[str]) -> None:
+        """Via le voci dei file non più in ingresso (archiviati, scartati o rimossi)."""
+        gone = [k for k in self.data if k not in present]
+        for k in gone:
+            del self.data[k]
+        self.dirty |= bool(gone)
+
+    def stuck(self) -> List[dict]:
+        return [{"file": ent[5], "attempts": ent[2], "retry_at": ent[3], "reason": ent[4]}
+                for ent in sorted(self.data.values(), key=lambda e: e[3])]
+
+    def save(self) -> None:
+        if not (self.dirty and self.path):
+            return
+        self.dirty = False
+        tmp = self.path.with_suffix(".tmp")
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps(self.data), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+_FAILURES = _FailureCache()
+
+def stuck_candidates(cfg: Config) -> List[dict]:
+    """File in ingresso in backoff dopo errori ripetuti (per GUI e API di stato)."""
+    _FAILURES.bind(cfg)
+    return _FAILURES.stuck()
 
 # ---- FS UTILS ------------------------------------------------------------------------
 
@@ -298,50 +1286,443 @@ def _is_same_file(src: Path, dst: Path, *, mtime_slack_ns: int = 2_000_000_000)
         return False
     return s1.st_size == s2.st_size and abs(s1.st_mtime_ns - s2.st_mtime_ns) <= mtime_slack_ns
 
+def _scan_files(dirp: Path) -> List[Path]:
+    """File di dirp in una sola enumerazione (il tipo arriva da scandir, niente stat per file)."""
+    with os.scandir(dirp) as it:
+        return [Path(de.path) for de in it if de.is_file()]
+
 def _fast_copy_or_link(src: Path, dst: Path):
     try:
-        os.link(src, dst)
+        _fs_call("link", dst, os.link, src, dst)
         return
+    except FsTimeout:
+        raise
     except OSError:
         pass
-    _copy_file_best(src, dst, overwrite=True)
+    _fs_call("copy", dst, _copy_file_best, src, dst, overwrite=True)
 
 def copy_to(src: Path, dst_dir: Path):
-    dst_dir.mkdir(parents=True, exist_ok=True)
+    _fs_call("mkdir", dst_dir, dst_dir.mkdir, parents=True, exist_ok=True)
     _fast_copy_or_link(src, dst_dir / src.name)
 
 def move_to(src: Path, dst_dir: Path):
-    dst_dir.mkdir(parents=True, exist_ok=True)
+    _fs_call("mkdir", dst_dir, dst_dir.mkdir, parents=True, exist_ok=True)
     dst = dst_dir / src.name
     try:
-        os.replace(src, dst)
+        _fs_call("replace", dst, os.replace, src, dst)
+    except FsTimeout:
+        raise
     except OSError:
-        _copy_file_best(src, dst, overwrite=True)
+        _fs_call("copy", dst, _copy_file_best, src, dst, overwrite=True)
         try:
-            src.unlink(missing_ok=True)
+            _fs_call("unlink", src, src.unlink, missing_ok=True)
         except Exception:
             pass
 
-def move_to_storico_safe(src: Path, dst_dir: Path) -> tuple[bool, int]:
-    dst_dir.mkdir(parents=True, exist_ok=True)
-    dst = dst_dir / src.name
-    if dst.exists():
-        return (False, 0)
+# Cache per batch (azzerata da run_once): cartelle storico già create e nomi già presenti
+# per (cartella, docno). Evita mkdir + exists() a ogni revisione superata. La cache serve solo
+# a saltare i casi noti: lo spostamento vero non sovrascrive mai (link/copia esclusivi), e in
+# multi-nodo la voce del docno si rilegge sotto il suo lease.
+_STORICO_DIRS_OK: set[str] = set()
+_STORICO_NAMES: Dict[tuple[str, str], set[str]] = {}
+
+def _storico_cache_reset() -> None:
+    _STORICO_DIRS_OK.clear()
+    _STORICO_NAMES.clear()
+    _FLAT_MIGRATED.clear()
+
+def _storico_names(dst_dir: Path, nm: str, fresh: bool = False) -> set[str]:
+    docno = nm[:9].upper()
+    key = (str(dst_dir).lower(), docno)
+    names = None if fresh else _STORICO_NAMES.get(key)
+    if names is None:
+        names = {x.lower() for x in _fs_call("list", dst_dir, _win_find_names_ex, dst_dir, f"{docno}*")}
+        zpath = _pack_path(dst_dir, nm)
+        if zpath.name.lower() in names:
+            names |= _fs_call("read", zpath, _pack_names, zpath)
+        _STORICO_NAMES[key] = names
+    return names
+
+def move_many_to_storico(items: List[Tuple[Path, Path, str]],
+                         cfg: Optional["Config"] = None) -> List[Tuple[bool, int]]:
+    """Sposta (src, dst_dir, nome) raggruppando per cartella: un mkdir e un'enumerazione
+    docno* per gruppo, poi i rename in un'unica passata. -> [(copiato, rc)] nell'ordine di items
+    (rc: 0 già presente, 1 spostato, 8 errore). Con cfg, uno shard non ancora migrato
+    considera presenti anche i nomi della cartella piatta."""
+    results: List[Tuple[bool, int]] = [(False, 8)] * len(items)
+    refreshed: set[tuple[Path, str]] = set()
+    by_dest: Dict[Path, List[int]] = {}
+    for i, (_src, dst_dir, _nm) in enumerate(items):
+        by_dest.setdefault(dst_dir, []).append(i)
+    for dst_dir, idxs in by_dest.items():
+        key = str(dst_dir).lower()
+        try:
+            if key not in _STORICO_DIRS_OK:
+                _fs_call("mkdir", dst_dir, dst_dir.mkdir, parents=True, exist_ok=True)
+                _STORICO_DIRS_OK.add(key)
+        except FsTimeout:
+            raise
+        except OSError:
+            continue
+        flat = _pending_flat(cfg, dst_dir) if cfg is not None else None
+        for i in idxs:
+            src, _d, nm = items[i]
+            dst = dst_dir / nm
+            # multi-nodo: un altro nodo può aver storicizzato lo stesso docno dopo che la cache
+            # è stata letta; qui si tiene il lease del docno, quindi una rilettura basta
+            fresh = bool(cfg is not None and cfg.NODE_ID) and (dst_dir, nm[:9].upper()) not in refreshed
+            refreshed.add((dst_dir, nm[:9].upper()))
+            try:
+                present = _storico_names(dst_dir, nm, fresh)
+                in_flat = flat is not None and nm.lower() in _storico_names(flat, nm, fresh)
+            except FsTimeout:
+                raise
+            except OSError:
+                present = {nm.lower()} if _fs_call("stat", dst, dst.exists) else set()
+                in_flat = False
+            if nm.lower() in present or in_flat:
+                results[i] = (False, 0)
+                continue
+            if cfg is not None and cfg.STORICO_PACK:
+                import zipfile
+                zpath = _pack_path(dst_dir, nm)
+                try:
+                    added = _pack_add(zpath, nm, src)
+                except FsTimeout:
+                    raise
+                except (OSError, zipfile.BadZipFile) as e:
+                    logging.error("Storico: %s non aggiunto a %s: %s", nm, zpath.name, e)
+                    continue
+                if not added:
+                    present.update((nm.lower(), zpath.name.lower()))
+                    results[i] = (False, 0)
+                    continue
+                try:
+                    _fs_call("unlink", src, src.unlink, missing_ok=True)
+                except FsTimeout:
+                    raise
+                except OSError:
+                    pass
+                present.update((nm.lower(), zpath.name.lower()))
+                results[i] = (True, 1)
+                continue
+            try:
+                moved = _move_no_clobber(src, dst)
+            except FsTimeout:
+                raise
+            except OSError:
+                try:
+                    _fs_call("copy", dst, _copy_file_best, src, dst, overwrite=False)
+                    _fs_call("unlink", src, src.unlink, missing_ok=True)
+                    moved = True
+                except FileExistsError:
+                    moved = False
+                except FsTimeout:
+                    raise
+                except Exception:
+                    continue
+            present.add(nm.lower())
+            results[i] = (True, 1) if moved else (False, 0)
+    return results
+
+def move_to_storico_safe(src: Path, dst_dir: Path, cfg: Optional["Config"] = None) -> tuple[bool, int]:
+    return move_many_to_storico([(src, dst_dir, src.name)], cfg)[0]
+
+# ---- STORICO A CONTENITORI: <cartella storico>/<DOCNO>.zip ----------------------------
+#
+# Con STORICO_PACK le revisioni superate si accodano (senza compressione) allo zip del loro
+# docno: una voce di cartella per docno invece che per revisione. L'append riscrive solo la
+# central directory in coda; prima se ne salva una copia in <DOCNO>.zip.undo, così un append
+# interrotto si annulla al primo accesso successivo. Un contenitore nuovo nasce da un .tmp.
+# La lettura dei contenitori è sempre attiva: storico misto (sciolti + zip) resta coerente.
+
+_PACK_NAME = re.compile(r"D\w\w\d{6}\.zip$", re.IGNORECASE)
+
+def _pack_path(dst_dir: Path, nm: str) -> Path:
+    return dst_dir / f"{nm[:9].upper()}.zip"
+
+def _pack_undo(zpath: Path) -> Path:
+    return zpath.with_name(zpath.name + ".undo")
+
+def _pack_recover(zpath: Path) -> None:
+    undo = _pack_undo(zpath)
     try:
-        os.replace(src, dst)
-        return (True, 1)
-    except OSError:
+        raw = undo.read_bytes()
+    except FileNotFoundError:
+        return
+    head, _, tail = raw.partition(b"\n")
+    start = int(json.loads(head)["start"])
+    with open(zpath, "r+b") as f:
+        f.truncate(start)
+        f.seek(start)
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+    undo.unlink()
+    logging.warning("Storico: %s ripristinato dopo un append interrotto", zpath)
+
+def _pack_names(zpath: Path) -> set[str]:
+    import zipfile
+    _pack_recover(zpath)
+    try:
+        with zipfile.ZipFile(zpath) as z:
+            return {n.lower() for n in z.namelist()}
+    except FileNotFoundError:
+        return set()
+
+def _pack_write_new(tmp: Path, put) -> None:
+    import zipfile
+    with open(tmp, "wb") as f:
+        with zipfile.ZipFile(f, "w", zipfile.ZIP_STORED, allowZip64=True) as z:
+            put(z)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _pack_tail(zpath: Path, nm: str) -> Optional[tuple[int, bytes]]:
+    """(inizio central directory, coda da lì in poi) o None se nm è già nel contenitore."""
+    import zipfile
+    with open(zpath, "rb") as f:
+        with zipfile.ZipFile(f) as z:
+            if nm.lower() in {n.lower() for n in z.namelist()}:
+                return None
+            start = z.start_dir
+        f.seek(start)
+        return start, f.read()
+
+def _pack_write_undo(undo: Path, start: int, tail: bytes) -> None:
+    tmp = undo.with_name(undo.name + ".tmp")
+    with open(tmp, "wb") as u:
+        u.write(json.dumps({"start": start}).encode("ascii") + b"\n" + tail)
+        u.flush()
+        os.fsync(u.fileno())
+    os.replace(tmp, undo)
+
+def _pack_append(zpath: Path, put) -> None:
+    import zipfile
+    with open(zpath, "r+b") as f:
+        with zipfile.ZipFile(f, "a", zipfile.ZIP_STORED, allowZip64=True) as z:
+            put(z)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _pack_add(zpath: Path, nm: str, src) -> bool:
+    """Accoda src (Path o bytes) come nm. -> False (e nessun effetto) se nm è già nel contenitore.
+    Chi chiama tiene il lease del docno (o il lock di storico_pack): tra lettura della coda e
+    append nessun altro scrive lo stesso contenitore."""
+    import zipfile
+    _fs_call("read", zpath, _pack_recover, zpath)
+    def _put(z: zipfile.ZipFile) -> None:
+        if isinstance(src, bytes):
+            z.writestr(zipfile.ZipInfo(nm, time.localtime()[:6]), src)
+        else:
+            z.write(src, nm)
+    if not _fs_call("stat", zpath, zpath.exists):
+        tmp = zpath.with_name(zpath.name + ".tmp")
+        _fs_call("copy", tmp, _pack_write_new, tmp, _put)
         try:
-            _copy_file_best(src, dst, overwrite=True)
-            src.unlink(missing_ok=True)
-            return (True, 1)
-        except Exception:
-            return (False, 8)
+            _fs_call("link", zpath, os.link, tmp, zpath)    # mai sopra un contenitore creato nel frattempo
+        except FileExistsError:
+            _fs_call("unlink", tmp, tmp.unlink)
+            return _pack_add(zpath, nm, src)
+        except FsTimeout:
+            raise
+        except OSError:
+            _fs_call("replace", zpath, os.replace, tmp, zpath)
+        else:
+            _fs_call("unlink", tmp, tmp.unlink)
+        return True
+    got = _fs_call("read", zpath, _pack_tail, zpath, nm)
+    if got is None:
+        return False
+    undo = _pack_undo(zpath)
+    _fs_call("write", undo, _pack_write_undo, undo, *got)
+    _fs_call("copy", zpath, _pack_append, zpath, _put)
+    _fs_call("unlink", undo, undo.unlink)
+    return True
+
+def _pack_member(z: zipfile.ZipFile, nm: str) -> Optional[zipfile.ZipInfo]:
+    low = nm.lower()
+    return next((zi for zi in z.infolist() if zi.filename.lower() == low), None)
+
+def _pack_digest(zpath: Path, nm: str) -> Optional[Tuple[int, bytes]]:
+    """(dimensione, digest come _file_digest) del membro nm, None se assente."""
+    import zipfile
+    _pack_recover(zpath)
+    with zipfile.ZipFile(zpath) as z:
+        zi = _pack_member(z, nm)
+        if zi is None:
+            return None
+        h = hashlib.blake2b(digest_size=16)
+        with z.open(zi) as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+                h.update(chunk)
+        return zi.file_size, h.digest()
+
+def storico_same_content(p: Path, dst_dir: Path, nm: str) -> bool:
+    """Come same_content contro la copia in storico di nm, sciolta o nel contenitore."""
+    import zipfile
+    zpath = _pack_path(dst_dir, nm)
+    try:
+        packed = _fs_call("read", zpath, _pack_digest, zpath, nm)
+    except FsTimeout:
+        raise
+    except (OSError, zipfile.BadZipFile):
+        packed = None
+    if packed is None:
+        return same_content(p, dst_dir / nm)
+    try:
+        st = _fs_call("stat", p, os.stat, p)
+        return st.st_size == packed[0] and _fs_call("read", p, _file_digest, p, st) == packed[1]
+    except FsTimeout:
+        raise
+    except OSError:
+        return False
+
+def _pack_merge(cfg: Config, src_zip: Path, dst_zip: Path) -> int:
+    """Accoda a dst_zip i membri di src_zip che mancano; un membro presente in entrambi con
+    contenuto diverso va in ERROR_DIR. -> membri in conflitto"""
+    import zipfile
+    conflicts = 0
+    _pack_recover(src_zip)
+    with zipfile.ZipFile(src_zip) as z:
+        for zi in z.infolist():
+            data = z.read(zi)
+            have = _pack_digest(dst_zip, zi.filename)
+            if have is None:
+                _pack_add(dst_zip, zi.filename, data)
+            elif have != (len(data), hashlib.blake2b(data, digest_size=16).digest()):
+                log_error(cfg, zi.filename, "Conflitto Shard", str(dst_zip))
+                cfg.ERROR_DIR.mkdir(parents=True, exist_ok=True)
+                (cfg.ERROR_DIR / zi.filename).write_bytes(data)
+                conflicts += 1
+    return conflicts
+
+def storico_extract(cfg: Config, name: str, out_dir: Path) -> Path:
+    """Copia in out_dir la revisione name dallo storico (contenitore o file sciolto)."""
+    import zipfile
+    dst_dir = _storico_dest_dir_for_name(cfg, name)
+    for d in (_pending_flat(cfg, dst_dir), dst_dir):
+        if d is None:
+            continue
+        zpath = _pack_path(d, name)
+        if zpath.exists():
+            _pack_recover(zpath)
+            with zipfile.ZipFile(zpath) as z:
+                zi = _pack_member(z, name)
+                if zi is not None:
+                    out_dir.mkdir(parents=True, exist_ok=True)
+                    out = out_dir / zi.filename
+                    with z.open(zi) as f, open(out, "wb") as g:
+                        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+                            g.write(chunk)
+                    return out
+        if (d / name).exists():
+            out_dir.mkdir(parents=True, exist_ok=True)
+            _copy_file_best(d / name, out_dir / name, overwrite=True)
+            return out_dir / name
+    raise FileNotFoundError(f"{name} non presente in storico ({dst_dir})")
+
+def _storico_dirs(cfg: Config) -> List[Path]:
+    out: List[Path] = []
+    for d in _subdirs(cfg.ARCHIVIO_STORICO):
+        out.append(d)
+        out.extend(_shard_subdirs(cfg, d))
+    return sorted(out)
+
+def storico_pack(cfg: Config, *, rate: float = 50.0) -> Dict[str, int]:
+    """Converte i file sciolti dello storico nei contenitori per docno (riprendibile)."""
+    import zipfile
+    counts = {"packed": 0, "dup": 0, "conflict": 0, "failed": 0}
+    step = 1.0 / rate if rate > 0 else 0.0
+    with _maint_session(cfg):
+        for d in _storico_dirs(cfg):
+            with ui_phase(f"Storico a contenitori {d}"):
+                with os.scandir(d) as it:
+                    names = sorted(de.name for de in it if BASE_NAME.fullmatch(de.name) and de.is_file())
+                t_next = time.perf_counter()
+                for nm in names:
+                    lease = None
+                    src = d / nm
+                    try:
+                        lease = _maint_lease(cfg, nm[:9].upper())
+                        if lease is None:
+                            counts["failed"] += 1
+                            continue
+                        zpath = _pack_path(d, nm)
+                        have = _fs_call("read", zpath, _pack_digest, zpath, nm) \
+                            if _fs_call("stat", zpath, zpath.exists) else None
+                        if have is None:
+                            _pack_add(zpath, nm, src)
+                            counts["packed"] += 1
+                        else:
+                            st = _fs_call("stat", src, os.stat, src)
+                            if have != (st.st_size, _fs_call("read", src, _file_digest, src, st)):
+                                log_error(cfg, nm, "Conflitto Storico", zpath.name)
+                                move_to(src, cfg.ERROR_DIR)
+                                counts["conflict"] += 1
+                                continue
+                            counts["dup"] += 1
+                        _fs_call("unlink", src, src.unlink)
+                    except (OSError, zipfile.BadZipFile):
+                        logging.exception("Storico: %s non convertito", src)
+                        counts["failed"] += 1
+                    finally:
+                        if lease is not None:
+                            _lease_release(cfg, lease)
+                    t_next += step
+                    delay = t_next - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                logging.info("Storico a contenitori %s: %s", d, counts)
+    return counts
+
+# ---- CONFRONTO CONTENUTO (hash in cache + prefiltro dimensione) ----------------------
+
+_HASH_CACHE: Dict[tuple[str, int, int], bytes] = {}
+_HASH_CACHE_MAX = 4096
+_HASH_CHUNK = 1 << 20
+
+def _file_digest(p: Path, st: os.stat_result) -> bytes:
+    """Digest del contenuto, in cache per (path, size, mtime): un file invariato non si rilegge."""
+    key = (str(p).lower(), st.st_size, st.st_mtime_ns)
+    d = _HASH_CACHE.get(key)
+    if d is not None:
+        return d
+    h = hashlib.blake2b(digest_size=16)
+    with open(p, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    d = h.digest()
+    if len(_HASH_CACHE) >= _HASH_CACHE_MAX:
+        _HASH_CACHE.pop(next(iter(_HASH_CACHE)))
+    _HASH_CACHE[key] = d
+    return d
+
+def same_content(a: Path, b: Path) -> bool:
+    """True se a e b hanno contenuto identico. Dimensioni diverse → False senza leggere i file."""
+    try:
+        sa = _fs_call("stat", a, os.stat, a)
+        sb = _fs_call("stat", b, os.stat, b)
+    except FsTimeout:
+        raise
+    except OSError:
+        return False
+    if sa.st_size != sb.st_size:
+        return False
+    try:
+        return _fs_call("read", a, _file_digest, a, sa) == _fs_call("read", b, _file_digest, b, sb)
+    except FsTimeout:
+        raise
+    except OSError:
+        return False
 
 def write_lines(p: Path, lines: List[str]):
-    p.parent.mkdir(parents=True, exist_ok=True)
-    with p.open("a", encoding="utf-8") as f:
-        f.write("\n".join(lines) + "\n")
+    text = "\n".join(lines) + "\n"
+    def _append() -> None:
+        with p.open("a", encoding="utf-8") as f:
+            f.write(text)
+    _fs_call("mkdir", p.parent, p.parent.mkdir, parents=True, exist_ok=True)
+    _fs_call("write", p, _append)
 
 # ---- MAPPATURE, VALIDAZIONI E LOG WRITERS --------------------------------------------
 
@@ -360,20 +1741,187 @@ LOCATION_MAP = {
 DEFAULT_LOCATION = ("unknown", "Unknown", "m", "Customer Drawings", "English")
 
 def map_location(m: re.Match, cfg: Config) -> dict:
-    first = m.group(3)[0]
-    l2 = m.group(2).upper()
-    loc = (
+    return _with_shard(_map_location_parts(m.group(1), m.group(2), m.group(3)[0], cfg), m.group(3), cfg)
+
+def _location_entry(l2: str, first: str) -> tuple:
+    l2 = l2.upper()
+    return (
         LOCATION_MAP.get((l2, first))
         or LOCATION_MAP.get((l2, "*"))
         or LOCATION_MAP.get(("*", first))
         or DEFAULT_LOCATION
     )
-    folder, log_name, subloc, doctype, lang = loc
-    arch_tif_loc = m.group(1).upper() + subloc
+
+def _map_location_parts(size: str, l2: str, first: str, cfg: Config) -> dict:
+    folder, log_name, subloc, doctype, lang = _location_entry(l2, first)
+    arch_tif_loc = size.upper() + subloc
     dir_tif_loc = cfg.ARCHIVIO_DISEGNI / folder / arch_tif_loc
     return dict(folder=folder, log_name=log_name, subloc=subloc, doctype=doctype, lang=lang,
                 arch_tif_loc=arch_tif_loc, dir_tif_loc=dir_tif_loc)
 
+# ---- LAYOUT A SHARD -----------------------------------------------------------------
+#
+# Con SHARD_DIGITS = k un file di <cartella> sta in <cartella>/<prime k cifre del numero>/.
+# Finché migrate-shards non ha svuotato la cartella piatta (marcatore .swarky_sharded)
+# ricerche e controlli di presenza guardano sia lo shard sia la cartella piatta.
+
+_SHARD_MARKER = ".swarky_sharded"
+_FLAT_MIGRATED: Dict[str, bool] = {}
+
+def _shard_dir(cfg: Config, base: Path, number: str) -> Path:
+    return base / number[:cfg.SHARD_DIGITS] if cfg.SHARD_DIGITS > 0 else base
+
+def _with_shard(loc: dict, number: str, cfg: Config) -> dict:
+    if cfg.SHARD_DIGITS <= 0:
+        return loc
+    return dict(loc, dir_tif_loc=_shard_dir(cfg, loc["dir_tif_loc"], number))
+
+def _pending_flat(cfg: Config, dirp: Path) -> Optional[Path]:
+    """Cartella piatta sopra lo shard dirp ancora da migrare, altrimenti None."""
+    k = cfg.SHARD_DIGITS
+    if k <= 0 or len(dirp.name) != k or not dirp.name.isdigit():
+        return None
+    flat = dirp.parent
+    key = str(flat).lower()
+    migrated = _FLAT_MIGRATED.get(key)
+    if migrated is None:
+        migrated = _FLAT_MIGRATED[key] = _fs_call("stat", flat, (flat / _SHARD_MARKER).exists)
+    return None if migrated else flat
+
+def archived_path(cfg: Config, name: str) -> Optional[Path]:
+    """Percorso in archivio di name (shard o cartella piatta in migrazione), None se assente."""
+    m = BASE_NAME.fullmatch(name)
+    if not m:
+        return None
+    dirp = map_location(m, cfg)["dir_tif_loc"]
+    for d in (_pending_flat(cfg, dirp), dirp):    # piatta prima: migrate-shards sposta verso lo shard
+        if d is not None and _fs_call("stat", d, (d / name).exists):
+            return d / name
+    return None
+
+# ---- CLASSIFICAZIONE NOMI A BLOCCHI -------------------------------------------------
+
+_VALID_SIZES = frozenset("ABCDE")
+_VALID_LOCS = frozenset("MKFTESNP")
+_VALID_METRICS = frozenset("MIDN")
+
+@dataclass
+class NameBatch:
+    """Esito colonnare di classify_names: la riga i descrive names[i].
+    rev/sheet sono interi (-1 se il nome non è conforme); reason è "" per i nomi validi,
+    altrimenti il motivo di scarto usato nel log; loc è il dict di map_location,
+    condiviso tra tutti i nomi con stessa (size, location, prima cifra)."""
+    names: List[str]
+    docno: List[str]
+    size: List[str]
+    location: List[str]
+    number: List[str]
+    rev: array
+    sheet: array
+    metric: List[str]
+    reason: List[str]
+    loc: List[Optional[dict]]
+    orient: Optional[List[Optional[bool]]] = None  # orientamento già letto (pipeline streaming)
+    tiff_err: Optional[List[Optional[str]]] = None  # DEEP_TIFF_CHECK: "" integro, motivo, None = da verificare
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+def classify_names(names: List[str], cfg: Config) -> NameBatch:
+    """Una sola passata su tutti i nomi: regex, controlli formali e cartella d'archivio."""
+    n = len(names)
+    out = NameBatch(names=list(names), docno=[""] * n, size=[""] * n, location=[""] * n,
+                    number=[""] * n, rev=array("h", [-1]) * n, sheet=array("h", [-1]) * n,
+                    metric=[""] * n, reason=[""] * n, loc=[None] * n)
+    loc_memo: Dict[tuple[str, str, str], dict] = {}
+    fullmatch = BASE_NAME.fullmatch
+    for i, nm in enumerate(names):
+        m = fullmatch(nm)
+        if m is None:
+            out.reason[i] = "Nome File Errato"
+            continue
+        size, l2, num, rev, sheet, met = m.group(1, 2, 3, 4, 5, 6)
+        size_u, l2_u, met_u = size.upper(), l2.upper(), met.upper()
+        out.docno[i] = f"D{size}{l2}{num}"
+        out.size[i] = size_u
+        out.location[i] = l2_u
+        out.number[i] = num
+        out.rev[i] = int(rev)
+        out.sheet[i] = int(sheet)
+        out.metric[i] = met_u
+        if size_u not in _VALID_SIZES:
+            out.reason[i] = "Formato Errato"
+        elif l2_u not in _VALID_LOCS:
+            out.reason[i] = "Location Errata"
+        elif met_u not in _VALID_METRICS:
+            out.reason[i] = "Metrica Errata"
+        else:
+            key = (size_u, l2_u, num[0])
+            loc = loc_memo.get(key)
+            if loc is None:
+                loc = loc_memo[key] = _map_location_parts(size_u, l2_u, num[0], cfg)
+            out.loc[i] = _with_shard(loc, num, cfg)
+    return out
+
+class SupersedePlan:
+    """Ordine di lavorazione del batch e, per riga, gli arrivi dello stesso batch che la superano
+    (revisione più alta prima). Le righe di un (docno, sheet) sono lavorate per revisione
+    decrescente ma decise come in ordine crescente: view() nasconde ciò che le revisioni più
+    alte hanno già archiviato e rimette ciò che hanno già storicizzato (dir=None)."""
+    __slots__ = ("order", "by", "accepted", "archived", "storicized")
+
+    def __init__(self, order: List[int], by: Dict[int, List[str]]):
+        self.order = order
+        self.by = by
+        self.accepted: set[str] = set()
+        self.archived: Dict[tuple[str, int], List[tuple[int, str]]] = {}
+        self.storicized: Dict[tuple[str, int], List[tuple[int, ArchEntry]]] = {}
+
+    def superseded_by(self, i: int) -> Optional[str]:
+        return next((x for x in self.by.get(i, ()) if x.lower() in self.accepted), None)
+
+    def accept(self, name: str, docno: str, sheet: int, rev: int, archived: bool) -> None:
+        self.accepted.add(name.lower())
+        if archived:
+            self.archived.setdefault((docno.upper(), sheet), []).append((rev, name.lower()))
+
+    def left_archive(self, docno: str, rev: int, e: ArchEntry) -> None:
+        e.dir = None
+        self.storicized.setdefault((docno.upper(), e.sheet), []).append((rev, e))
+
+    def view(self, docno: str, sheet: int, rev: int, entries: List[ArchEntry]) -> List[ArchEntry]:
+        key = (docno.upper(), sheet)
+        hidden = {nm for r, nm in self.archived.get(key, ()) if r > rev}
+        back = [e for r, e in self.storicized.get(key, ()) if r > rev]
+        if not hidden and not back:
+            return entries
+        return [e for e in entries if e.name.lower() not in hidden] + back
+
+def plan_supersedes(batch: NameBatch) -> SupersedePlan:
+    """X supera Y (stesso docno e sheet) se rev_X > rev_Y ed è della stessa metrica o dell'altro
+    gruppo: è la revisione che al suo arrivo sposterebbe Y in storico. Ogni (docno, sheet)
+    viene lavorato compatto, per revisione decrescente, al posto del suo primo file."""
+    n = len(batch)
+    groups: Dict[tuple[str, int], List[int]] = {}
+    for i in range(n):
+        if not batch.reason[i]:
+            groups.setdefault((batch.docno[i].upper(), batch.sheet[i]), []).append(i)
+    rank = list(range(n))
+    by: Dict[int, List[str]] = {}
+    for idxs in groups.values():
+        if len(idxs) < 2:
+            continue
+        for y in idxs:
+            rank[y] = idxs[0]
+            grp_y = METRIC_GROUP[batch.metric[y]]
+            xs = [x for x in idxs if batch.rev[x] > batch.rev[y]
+                  and (batch.metric[x] == batch.metric[y] or METRIC_GROUP[batch.metric[x]] != grp_y)]
+            if xs:
+                xs.sort(key=lambda x: -batch.rev[x])
+                by[y] = [batch.names[x] for x in xs]
+    order = sorted(range(n), key=lambda i: (rank[i], -batch.rev[i], i))
+    return SupersedePlan(order, by)
+
 def size_from_letter(ch: str) -> str:
     return dict(A="A4",B="A3",C="A2",D="A1",E="A0").get(ch.upper(),"A4")
 
@@ -445,6 +1993,373 @@ def check_orientation_ok(tif_path: Path) -> bool:
     w, h = wh
     return w > h
 
+# ---- VERIFICA TIFF PROFONDA: struttura via mmap, senza decodificare l'immagine ------------
+#
+# Con DEEP_TIFF_CHECK ogni TIFF valido nel nome passa da tiff_deep_check prima di archivio e
+# PLM: catena degli IFD (niente cicli), tag, strip/tile (offset + byte count dentro il file,
+# numero atteso), compressione nota, dati non compressi completi. Si leggono solo intestazioni
+# e tabelle, quindi il costo non dipende dalla dimensione della scansione; i file del batch
+# si verificano in anticipo in un pool di thread (_deep_check_batch).
+
+_TIFF_COMPRESSIONS = frozenset((1, 2, 3, 4, 5, 6, 7, 8, 32773, 32946, 34712, 34925, 50000, 50001))
+_TIFF_TYPES = {1: "B", 2: "B", 3: "H", 4: "I", 5: "Q", 6: "b", 7: "B", 8: "h", 9: "i", 10: "q",
+               11: "f", 12: "d", 13: "I", 16: "Q", 17: "q", 18: "Q"}
+_TIFF_MAX_PAGES = 10000
+_DEEP_TIFF_WORKERS = 4
+
+def _tiff_validate(mm, size: int) -> Tuple[int, Optional[str]]:
+    """(pagine, motivo) per il buffer mm di `size` byte; motivo None = struttura integra."""
+    if size < 8:
+        return 0, "file troncato"
+    e = {b"II": "<", b"MM": ">"}.get(bytes(mm[:2]))
+    if e is None:
+        return 0, "intestazione non TIFF"
+    magic = struct.unpack_from(e + "H", mm, 2)[0]
+    if magic == 42:
+        big, ent_sz, cnt_fmt, off_fmt = False, 12, "H", "I"
+        ifd = struct.unpack_from(e + "I", mm, 4)[0]
+    elif magic == 43 and size >= 16:
+        big, ent_sz, cnt_fmt, off_fmt = True, 20, "Q", "Q"
+        ifd = struct.unpack_from(e + "Q", mm, 8)[0]
+    else:
+        return 0, "intestazione non TIFF"
+    inline = 8 if big else 4
+    cnt_sz, off_sz = struct.calcsize(cnt_fmt), struct.calcsize(off_fmt)
+    seen: set[int] = set()
+    pages = 0
+    while ifd:
+        page = f"pagina {pages + 1}: "
+        if ifd in seen:
+            return pages, page + "IFD ciclico"
+        if ifd + cnt_sz > size or len(seen) >= _TIFF_MAX_PAGES:
+            return pages, page + "IFD fuori dal file"
+        seen.add(ifd)
+        n = struct.unpack_from(e + cnt_fmt, mm, ifd)[0]
+        end = ifd + cnt_sz + n * ent_sz
+        if n == 0:
+            return pages, page + "IFD vuoto"
+        if end + off_sz > size:
+            return pages, page + "IFD troncato"
+        tags: Dict[int, tuple] = {}
+        for k in range(n):
+            at = ifd + cnt_sz + k * ent_sz
+            if big:
+                tag, typ, cnt = struct.unpack_from(e + "HHQ", mm, at)
+            else:
+                tag, typ, cnt = struct.unpack_from(e + "HHI", mm, at)
+            fmt = _TIFF_TYPES.get(typ)
+            if fmt is None:
+                continue   # tipo sconosciuto: da ignorare (specifica TIFF 6.0)
+            unit = struct.calcsize(fmt) * (2 if typ in (5, 10) else 1)
+            data = at + 4 + (8 if big else 4)
+            if unit * cnt > inline:
+                data = struct.unpack_from(e + off_fmt, mm, data)[0]
+                if data + unit * cnt > size:
+                    return pages + 1, page + f"tag {tag} fuori dal file"
+            if tag in (256, 257, 258, 259, 273, 277, 278, 279, 284, 322, 323, 324, 325) and typ not in (5, 10):
+                tags[tag] = struct.unpack_from(f"{e}{cnt}{fmt}", mm, data)
+        pages += 1
+        one = lambda tag, default: (tags.get(tag) or (default,))[0]
+        w, h = one(256, 0), one(257, 0)
+        if not w or not h:
+            return pages, page + "dimensioni mancanti"
+        comp = one(259, 1)
+        if comp not in _TIFF_COMPRESSIONS:
+            return pages, page + f"compressione {comp} sconosciuta"
+        spp = one(277, 1) or 1
+        planes = spp if one(284, 1) == 2 else 1
+        if 324 in tags or 322 in tags:
+            offs, counts = tags.get(324, ()), tags.get(325, ())
+            tw, th = one(322, 0), one(323, 0)
+            if not tw or not th:
+                return pages, page + "dimensioni tile mancanti"
+            expected = -(-w // tw) * -(-h // th) * planes
+            what = "tile"
+        else:
+            offs, counts = tags.get(273, ()), tags.get(279, ())
+            rps = min(one(278, h) or h, h)
+            expected = -(-h // rps) * planes
+            what = "strip"
+        if not offs:
+            return pages, page + f"{what} mancanti"
+        if len(offs) != len(counts):
+            return pages, page + f"{len(offs)} offset {what} ma {len(counts)} byte count"
+        if len(offs) != expected:
+            return pages, page + f"{len(offs)} {what}, attese {expected}"
+        for k, (off, nb) in enumerate(zip(offs, counts)):
+            if nb == 0:
+                return pages, page + f"{what} {k + 1} vuota"
+            if off + nb > size:
+                return pages, page + f"{what} {k + 1} fuori dal file (file troncato)"
+        if comp == 1 and what == "strip":
+            bps = sum(tags.get(258) or (1,)) if planes == 1 else one(258, 1)
+            need = -(-w * bps // 8) * h * (spp if planes > 1 else 1)
+            if sum(counts) < need:
+                return pages, page + "dati non compressi incompleti"
+        ifd = struct.unpack_from(e + off_fmt, mm, end)[0]
+    if not pages:
+        return 0, "nessuna pagina"
+    return pages, None
+
+def tiff_deep_check(path: Path) -> Tuple[int, Optional[str]]:
+    """Struttura del TIFF via mmap: (pagine, motivo) con motivo None se integro."""
+    import mmap
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 8:
+            return 0, "file troncato"
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                return _tiff_validate(mm, size)
+            except struct.error:
+                return 0, "struttura TIFF illeggibile"
+
+_DEEP_POOL = None
+_DEEP_POOL_LOCK = threading.Lock()
+
+def _deep_check_one(p: Path) -> Optional[str]:
+    prev, _PHASE.label = getattr(_PHASE, "label", ""), f"{p.name} • verifica_tiff"
+    try:
+        pages, err = _fs_call("read", p, tiff_deep_check, p)
+        if pages > 1 and err is None:
+            logging.debug("%s: %d pagine", p.name, pages)
+        return err or ""
+    except Exception:
+        return None   # illeggibile ora (timeout, file sparito): lo rivede _process_candidate
+    finally:
+        _PHASE.label = prev
+
+def _deep_check_batch(paths: List[Path], batch: NameBatch, cfg: Config) -> None:
+    """Verifica in anticipo, in parallelo, i TIFF con nome valido del batch (batch.tiff_err)."""
+    global _DEEP_POOL
+    if not cfg.DEEP_TIFF_CHECK:
+        return
+    todo = [i for i, p in enumerate(paths)
+            if not batch.reason[i] and p.suffix.lower() in (".tif", ".tiff") and not _FAILURES.waiting(p.name)]
+    res: List[Optional[str]] = [None] * len(paths)
+    if todo:
+        with _DEEP_POOL_LOCK:
+            if _DEEP_POOL is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _DEEP_POOL = ThreadPoolExecutor(max_workers=_DEEP_TIFF_WORKERS, thread_name_prefix="swarky-tiff")
+        for i, err in zip(todo, _DEEP_POOL.map(_deep_check_one, [paths[i] for i in todo])):
+            res[i] = err
+    batch.tiff_err = res
+
+# ---- ANTEPRIME: miniature locali per la revisione a vista (Pillow opzionale) ---------
+#
+# PNG ridotti in una cache locale (non sulla share), chiave = percorso + size + mtime del
+# sorgente: un file cambiato produce una nuova anteprima, quella vecchia esce per LRU.
+# Generazione in un pool di thread; senza Pillow (o per i PDF) non c'è anteprima.
+
+class _ThumbCache:
+    SIZE = (360, 260)
+    WORKERS = 2
+    MAX_PIXELS = 2_500_000_000     # A0 a 1200 dpi: il limite anti "decompression bomb" di Pillow è ~179 Mpx
+    _PIL_LOCK = threading.Lock()
+
+    def __init__(self):
+        self.dir: Optional[Path] = None
+        self.max_bytes = 0
+        self.added = 0
+        self._pool = None
+        self._pending: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def bind(self, cfg: Config) -> None:
+        base = os.environ.get("LOCALAPPDATA") or str(Path.home() / ".cache")
+        self.dir = Path(base) / "Swarky" / "thumbs"
+        self.max_bytes = max(0, cfg.THUMB_CACHE_MB) * 1024 * 1024
+
+    @staticmethod
+    def available() -> bool:
+        try:
+            import PIL.Image  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def get(self, src: Path) -> Optional[Path]:
+        """Anteprima di src (generata se manca) o None se non disponibile."""
+        if not self.max_bytes or self.dir is None or src.suffix.lower() != ".tif":
+            return None
+        try:
+            st = _fs_call("stat", src, os.stat, src)
+        except OSError:
+            return None
+        key = hashlib.blake2b(f"{str(src).lower()}|{st.st_size}|{st.st_mtime_ns}".encode("utf-8"),
+                              digest_size=12).hexdigest()
+        out = self.dir / f"{key}.png"
+        try:
+            os.utime(out)  # LRU: l'mtime è l'ultimo uso
+            return out
+        except OSError:
+            pass
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+        try:
+            img = _fs_call("read", src, self._render, src, Image)
+            self.dir.mkdir(parents=True, exist_ok=True)
+            tmp = out.with_suffix(".tmp")
+            img.save(tmp, "PNG", optimize=True)
+            os.replace(tmp, out)
+        except Exception as e:
+            logging.warning("Anteprima non generata per %s: %s", src, e)
+            return None
+        with self._lock:
+            self.added += out.stat().st_size
+            evict = self.added > self.max_bytes // 10
+            if evict:
+                self.added = 0
+        if evict:
+            self._evict(keep=out)
+        return out
+
+    def _render(self, src: Path, Image):
+        # il limite è un globale di Pillow: alzato solo attorno all'apertura (dove viene controllato)
+        with self._PIL_LOCK:
+            prev, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, self.MAX_PIXELS
+            try:
+                im = Image.open(src)
+            finally:
+                Image.MAX_IMAGE_PIXELS = prev
+        with im:
+            im.draft("L", self.SIZE)  # solo JPEG/OJPEG: decodifica già ridotta
+            im = im.convert("L") if im.mode not in ("1", "L") else im.copy()
+        im.thumbnail(self.SIZE)
+        return im
+
+    def _evict(self, keep: Path) -> None:
+        try:
+            files = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.dir)
+                     if e.name.endswith(".png") and e.name != keep.name]
+        except OSError:
+            return
+        total = sum(f[1] for f in files)
+        target = self.max_bytes * 9 // 10
+        for _mt, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+    def submit(self, src: Path, done=None) -> None:
+        """Genera in background; done(src, png|None) dal thread del pool."""
+        if not self.max_bytes:
+            return
+        key = str(src).lower()
+        with self._lock:
+            if key in self._pending and done is None:
+                return
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix="swarky-thumb")
+            fut = self._pool.submit(self.get, src)
+            self._pending[key] = fut
+        def _finish(f):
+            with self._lock:
+                if self._pending.get(key) is f:
+                    del self._pending[key]
+            if done is not None:
+                done(src, None if f.exception() else f.result())
+        fut.add_done_callback(_finish)
+
+_THUMBS = _ThumbCache()
+
+def thumbnail_cache(cfg: Config) -> _ThumbCache:
+    _THUMBS.bind(cfg)
+    return _THUMBS
+
+# ---- EVENTI JSON-LINES: una riga per log_swarky/log_error -----------------------------
+#
+# Swarky{_nodo}_events.<YYYY-MM-DD>.jsonl nella cartella log (un file per giorno). Ogni evento
+# porta i campi del nome (docno, rev, sheet, metrica), esito, riferimento, destinazione, id del
+# batch e le durate delle fasi ui_phase del file fino a quel momento. Bufferizzato: scritto a
+# fine batch, ogni BUF_MAX eventi e all'uscita.
+
+class _EventLog:
+    BUF_MAX = 500
+
+    def __init__(self):
+        self.enabled = False
+        self.dir: Optional[Path] = None
+        self.suffix = ""
+        self.batch = ""
+        self.seq = 0
+        self.buf: List[tuple[str, str]] = []
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._atexit = False
+
+    def bind(self, cfg: Config) -> None:
+        self.enabled = cfg.EVENT_LOG
+        self.dir = cfg.LOG_DIR or cfg.DIR_HPLOTTER
+        self.suffix = f"_{cfg.NODE_ID}" if cfg.NODE_ID else ""
+        if self.enabled and not self._atexit:
+            import atexit
+            atexit.register(self.flush)
+            self._atexit = True
+
+    def begin(self) -> None:
+        """Nuovo batch: id <data-ora>-<pid>-<n>, durate delle fasi azzerate."""
+        self.seq += 1
+        self.batch = f"{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}-{self.seq}"
+        with self._lock:
+            self.phases = {}
+
+    def phase(self, label: str, dt: float) -> None:
+        if not self.enabled:
+            return
+        file, phase = _phase_owner(label)
+        if not file:
+            return
+        with self._lock:
+            d = self.phases.setdefault(file, {})
+            d[phase] = d.get(phase, 0.0) + dt
+
+    def emit(self, file: str, loc: str, outcome: str, ref: str = "", dest: str = "",
+             error: bool = False) -> None:
+        if not self.enabled:
+            return
+        now = datetime.now()
+        ev: Dict[str, Any] = {"ts": now.isoformat(timespec="milliseconds"), "batch": self.batch,
+                              "file": file, "outcome": outcome, "error": error}
+        m = BASE_NAME.fullmatch(file)
+        if m:
+            ev.update(docno=_docno_from_match(m).upper(), rev=m.group(4), sheet=m.group(5),
+                      metric=m.group(6).upper())
+        ev.update(loc=loc, ref=ref, dest=dest)
+        with self._lock:
+            ev["phases_ms"] = {k: round(v * 1000, 1) for k, v in self.phases.get(file, {}).items()}
+            self.buf.append((now.strftime("%Y-%m-%d"), json.dumps(ev, ensure_ascii=False)))
+            full = len(self.buf) >= self.BUF_MAX
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            buf, self.buf = self.buf, []
+        if not buf or self.dir is None:
+            return
+        by_day: Dict[str, List[str]] = {}
+        for day, line in buf:
+            by_day.setdefault(day, []).append(line)
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            for day, lines in by_day.items():
+                path = self.dir / f"Swarky{self.suffix}_events.{day}.jsonl"
+                with _FSSTATS.timed("append", path), path.open("a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            logging.warning("Eventi JSON non scritti: %s", e)
+
+_EVENTS = _EventLog()
+
 # ---- LOG WRAPPERS (GUI + buffer file) --------------------------------------
 
 def _now_ddmonYYYY() -> str:
@@ -456,12 +2371,14 @@ def log_swarky(cfg: Config, file_name: str, loc: str, process: str,
                archive_dwg: str = "", dest: str = ""):
     line = f"{_now_ddmonYYYY()} # {_now_HHMMSS()} # {file_name}\t# {loc}\t# {process}\t# {archive_dwg}"
     _append_filelog_line(line)  # TXT batch
+    _EVENTS.emit(file_name, loc, process, archive_dwg, dest)
     logging.info("processed %s", file_name,
                  extra={"ui": ("processed", file_name, process, archive_dwg, dest)})
 
 def log_error(cfg: Config, file_name: str, err: str, archive_dwg: str = ""):
     line = f"{_now_ddmonYYYY()} # {_now_HHMMSS()} # {file_name}\t# ERRORE\t# {err}\t# {archive_dwg}"
     _append_filelog_line(line)  # TXT batch
+    _EVENTS.emit(file_name, "ERRORE", err, archive_dwg, error=True)
     logging.error("anomaly %s", file_name,
                   extra={"ui": ("anomaly", file_name, err)})
 
@@ -471,14 +2388,23 @@ class _UIPhase:
     def __init__(self, label: str):
         self.label = label
         self.t0 = 0.0
+        self.prev = ""
 
     def __enter__(self):
         logging.info(self.label, extra={"ui": ("phase", self.label)})
+        self.prev = getattr(_PHASE, "label", "")
+        _PHASE.label = self.label
         self.t0 = time.perf_counter()
         return self
 
     def __exit__(self, exc_type, exc, tb):
-        elapsed_ms = int((time.perf_counter() - self.t0) * 1000)
+        _PHASE.label = self.prev
+        t1 = time.perf_counter()
+        dt = t1 - self.t0
+        elapsed_ms = int(dt * 1000)
+        _EVENTS.phase(self.label, dt)
+        if _TRACE.enabled:
+            _TRACE.span(self.label, "phase", self.t0, t1)
         logging.info(f"{self.label} finita in {elapsed_ms} ms",
                      extra={"ui": ("phase_done", elapsed_ms)})
         return False
@@ -552,43 +2478,542 @@ def write_edi(
     loc: Optional[dict] = None
 ) -> None:
     edi = out_dir / (Path(file_name).stem + ".DESEDI")
-    if edi.exists():
+    if _fs_call("stat", edi, edi.exists):
+        return
+    if iss_match is not None:
+        g1 = iss_match.group(1); g2 = iss_match.group(2); g3 = iss_match.group(3)
+        rev = iss_match.group(4); sheet = iss_match.group(5)
+        docno = f"G{g1}{g2}{g3}"
+        body = _edi_body(
+            document_no=docno, rev=rev, sheet=sheet,
+            description=" Impeller Specification Sheet",
+            actual_size="A4", uom="Metric", doctype="DETAIL", lang="English",
+            file_name=file_name, file_type="Pdf",
+        )
+        write_lines(edi, body)
+        return
+    if m is None or loc is None:
+        raise ValueError("write_edi: per STANDARD/FIV servono 'm' (BASE_NAME) e 'loc' (map_location)")
+    document_no = f"D{m.group(1)}{m.group(2)}{m.group(3)}"
+    rev = m.group(4); sheet = m.group(5)
+    file_type = "Pdf" if Path(file_name).suffix.lower() == ".pdf" else "Tiff"
+    body = _edi_body(
+        document_no=document_no, rev=rev, sheet=sheet, description="",
+        actual_size=size_from_letter(m.group(1)), uom=uom_from_letter(m.group(6)),
+        doctype=loc["doctype"], lang=loc["lang"],
+        file_name=file_name, file_type=file_type,
+    )
+    write_lines(edi, body)
+
+# ---- STORICO: routing ---------------------------------------------------------------
+
+def _storico_dest_dir_for_name(cfg: Config, nm: str) -> Path:
+    mm = BASE_NAME.fullmatch(nm)
+    if not mm:
+        return cfg.ARCHIVIO_STORICO / "unknown"
+    return _shard_dir(cfg, cfg.ARCHIVIO_STORICO / f"D{mm.group(1).upper()}", mm.group(3))
+
+# ---- MULTI-NODO: claim per rename atomico + lease docno su share -------------------
+#
+# DIR_HPLOTTER/.swarky_nodes/<node>/   staging: un file è del nodo che lo rinomina per primo
+# DIR_HPLOTTER/.swarky_nodes/<node>/.alive   heartbeat (thread _KEEPALIVE); staging di nodi morti torna in hplotter
+# DIR_HPLOTTER/.swarky_leases/<chiave>/<gen>.lease  lease con scadenza sulle decisioni d'archivio
+#
+# Lease a generazioni: vale il file con <gen> più alto. Chi lo trova scaduto (o rilasciato)
+# crea <gen+1> con O_EXCL: per ogni generazione vince un solo nodo e nessuno tocca mai il file
+# di un altro, quindi non esiste il "furto" di un lease appena rinnovato. Il vincitore cancella
+# le generazioni precedenti; il rilascio azzera la scadenza senza cancellare il file (il
+# contatore resta). Heartbeat e rinnovo dei lease tenuti girano in un thread, indipendenti da
+# quanto dura il file in lavorazione.
+
+_NODES_DIRNAME = ".swarky_nodes"
+_LEASES_DIRNAME = ".swarky_leases"
+
+def _node_stage_dir(cfg: Config, node: Optional[str] = None) -> Path:
+    return cfg.DIR_HPLOTTER / _NODES_DIRNAME / (node or cfg.NODE_ID or "")
+
+def _node_heartbeat(cfg: Config) -> None:
+    stage = _node_stage_dir(cfg)
+    _fs_call("mkdir", stage, stage.mkdir, parents=True, exist_ok=True)
+    alive = stage / ".alive"
+    _fs_call("write", alive, alive.write_text, f"{time.time():.0f}", encoding="utf-8")
+
+def _move_no_clobber(src: Path, dst: Path) -> bool:
+    """Sposta src in dst solo se dst non esiste (link + unlink; senza hard link, exists + rename)."""
+    try:
+        _fs_call("link", dst, os.link, src, dst)
+    except FileExistsError:
+        return False
+    except FsTimeout:
+        raise
+    except OSError:
+        if _fs_call("stat", dst, dst.exists):
+            return False
+        _fs_call("rename", dst, os.rename, src, dst)
+        return True
+    _fs_call("unlink", src, src.unlink, missing_ok=True)
+    return True
+
+def _recover_dead_nodes(cfg: Config) -> None:
+    """Riporta in DIR_HPLOTTER i file reclamati da nodi senza heartbeat da 2×LEASE_SEC.
+    Un file con lo stesso nome già in ingresso resta nello staging (nuovo arrivo, non si sovrascrive)."""
+    root = cfg.DIR_HPLOTTER / _NODES_DIRNAME
+    try:
+        nodes = [de for de in _fs_call("list", root, lambda: list(os.scandir(root)))
+                 if de.is_dir() and de.name != cfg.NODE_ID]
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for de in nodes:
+        try:
+            alive = _fs_call("stat", Path(de.path), os.stat, os.path.join(de.path, ".alive")).st_mtime
+        except FileNotFoundError:
+            alive = 0.0
+        if now - alive < 2 * cfg.LEASE_SEC:
+            continue
+        for f in _fs_call("list", Path(de.path), lambda: list(os.scandir(de.path))):
+            if f.is_file() and f.name != ".alive":
+                try:
+                    if _move_no_clobber(Path(f.path), cfg.DIR_HPLOTTER / f.name):
+                        logging.warning("Nodo %s inattivo: %s rimesso in coda", de.name, f.name)
+                    else:
+                        logging.warning("Nodo %s inattivo: %s già presente in ingresso, lasciato nello staging",
+                                        de.name, f.name)
+                except OSError:
+                    pass
+
+class _Keepalive:
+    """Thread daemon: heartbeat del nodo e rinnovo dei lease tenuti ogni LEASE_SEC/4."""
+    def __init__(self):
+        self.cfg: Optional[Config] = None
+        self.held: Dict[Path, str] = {}   # lease -> nonce
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def ensure(self, cfg: Config) -> None:
+        self.cfg = cfg
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="swarky-keepalive")
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            cfg = self.cfg
+            interval = max(1.0, cfg.LEASE_SEC / 4)
+            try:
+                if cfg.NODE_ID:
+                    _node_heartbeat(cfg)
+            except Exception as e:
+                logging.warning("Heartbeat nodo non scritto: %s", e)
+            with self._lock:
+                held = list(self.held.items())
+            for lp, nonce in held:
+                try:
+                    if not _lease_write(lp, nonce, cfg, time.time() + cfg.LEASE_SEC):
+                        logging.warning("Lease perso: %s", lp.parent.name)
+                        self.forget(lp)
+                except Exception as e:
+                    logging.warning("Lease %s non rinnovato: %s", lp.parent.name, e)
+            time.sleep(interval)
+
+    def hold(self, lp: Path, nonce: str) -> None:
+        with self._lock:
+            self.held[lp] = nonce
+
+    def forget(self, lp: Path) -> Optional[str]:
+        with self._lock:
+            return self.held.pop(lp, None)
+
+_KEEPALIVE = _Keepalive()
+
+def _claim_candidates(cfg: Config, candidates: List[Path]) -> List[Path]:
+    """Sposta i candidati nello staging del nodo; chi perde la corsa riceve FileNotFoundError."""
+    stage = _node_stage_dir(cfg)
+    claimed: List[Path] = []
+    for p in candidates:
+        dst = stage / p.name
+        try:
+            _fs_call("rename", dst, os.rename, p, dst)
+        except FileNotFoundError:
+            continue  # già reclamato da un altro nodo
+        except OSError as e:
+            logging.debug("Claim fallito per %s: %s", p.name, e)
+            continue
+        claimed.append(dst)
+    return claimed
+
+def _unclaim(cfg: Config, p: Path) -> None:
+    try:
+        if p.parent != cfg.DIR_HPLOTTER and _fs_call("stat", p, p.exists):
+            _fs_call("rename", cfg.DIR_HPLOTTER, os.rename, p, cfg.DIR_HPLOTTER / p.name)
+    except OSError:
+        logging.exception("Impossibile rimettere in coda %s", p)
+
+def _lease_read(lp: Path) -> Optional[dict]:
+    """Contenuto del lease; {} se vuoto/illeggibile (appena creato), None se sparito."""
+    try:
+        return json.loads(_fs_call("read", lp, lp.read_text, encoding="utf-8") or "{}")
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        return {}
+
+def _lease_gens(d: Path) -> List[int]:
+    try:
+        names = _fs_call("list", d, os.listdir, d)
+    except FileNotFoundError:
+        return []
+    return sorted(int(n[:-6]) for n in names if n.endswith(".lease") and n[:-6].isdigit())
+
+def _lease_write(lp: Path, nonce: str, cfg: Config, expires: float) -> bool:
+    """Aggiorna la scadenza del proprio lease (stesso nonce); False se non è più nostro."""
+    info = _lease_read(lp)
+    if not info or info.get("nonce") != nonce:
+        return False
+    def _w():
+        with open(lp, "r+", encoding="utf-8") as f:   # r+: mai ricreare un lease cancellato
+            f.write(json.dumps({"node": cfg.NODE_ID, "nonce": nonce, "expires": expires}))
+            f.truncate()
+    _fs_call("write", lp, _w)
+    return True
+
+def _lease_acquire(cfg: Config, key: str, wait_sec: float = 10.0) -> Optional[Path]:
+    """Lease esclusivo su 'key' (es. docno). None se occupato da un altro nodo oltre wait_sec."""
+    import random
+    d = cfg.DIR_HPLOTTER / _LEASES_DIRNAME / key
+    _fs_call("mkdir", d, d.mkdir, parents=True, exist_ok=True)
+    _KEEPALIVE.ensure(cfg)
+    nonce = f"{cfg.NODE_ID or ''}:{os.getpid()}:{os.urandom(8).hex()}"
+    deadline = time.monotonic() + wait_sec
+    while True:
+        gens = _lease_gens(d)
+        top = gens[-1] if gens else 0
+        free = top == 0
+        if not free:
+            cur = d / f"{top}.lease"
+            info = _lease_read(cur)
+            if info:
+                free = float(info.get("expires", 0)) < time.time()
+            elif info is not None:
+                # creato ma non ancora scritto: scaduto solo se vecchio
+                try:
+                    free = time.time() - _fs_call("stat", cur, os.stat, cur).st_mtime > cfg.LEASE_SEC
+                except FileNotFoundError:
+                    pass
+            if free and info and float(info.get("expires", 0)) > 0:
+                logging.warning("Lease scaduto rilevato: %s", key)
+        fd = None
+        if free:
+            lp = d / f"{top + 1}.lease"
+            try:
+                fd = _fs_call("open", lp, os.open, lp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                pass
+        if fd is not None:
+            try:
+                os.write(fd, json.dumps({"node": cfg.NODE_ID, "nonce": nonce,
+                                         "expires": time.time() + cfg.LEASE_SEC}).encode())
+            finally:
+                os.close(fd)
+            for g in gens:
+                try:
+                    old = d / f"{g}.lease"
+                    _fs_call("unlink", old, old.unlink, missing_ok=True)
+                except OSError:
+                    pass
+            _KEEPALIVE.hold(lp, nonce)
+            return lp
+        # occupato, generazione appena sostituita (lease sparito tra elenco e lettura) o vinta
+        # da un altro nodo: stessa scadenza e stessa pausa, mai un giro a vuoto sulla share
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.05 + random.random() * 0.2)
+
+def _lease_held(lp: Optional[Path]) -> bool:
+    """Il lease è ancora nostro: stesso nonce e nessuna generazione successiva."""
+    if lp is None:
+        return False
+    nonce = _KEEPALIVE.held.get(lp)
+    info = _lease_read(lp)
+    if nonce is None or not info or info.get("nonce") != nonce:
+        return False
+    gens = _lease_gens(lp.parent)
+    return bool(gens) and gens[-1] == int(lp.name[:-6])
+
+def _lease_live(cfg: Config, key: str) -> bool:
+    """Qualcuno tiene 'key' con scadenza futura. Solo letture, nessuna attesa."""
+    d = cfg.DIR_HPLOTTER / _LEASES_DIRNAME / key
+    gens = _lease_gens(d)
+    if not gens:
+        return False
+    cur = d / f"{gens[-1]}.lease"
+    info = _lease_read(cur)
+    if info is None:
+        return False
+    if not info:   # creato ma non ancora scritto: vivo se recente
+        try:
+            return time.time() - _fs_call("stat", cur, os.stat, cur).st_mtime <= cfg.LEASE_SEC
+        except FileNotFoundError:
+            return False
+    return float(info.get("expires", 0)) >= time.time()
+
+# Nodo singolo: storico-pack / migrate-shards tengono _ARCHIVIO per tutto il comando.
+# run_once non lo prende (niente scritture né attese nel giro normale, niente lease orfano
+# dopo un crash del demone): lo legge prima della passata e prima di ogni candidato e, se
+# è vivo, lascia i file in hplotter per il batch successivo. La manutenzione parte dopo
+# _MAINT_GRACE_SEC, così il candidato eventualmente già in corso fa in tempo a finire.
+_SINGLE_NODE_LEASE = "_ARCHIVIO"
+_MAINT_GRACE_SEC = 10.0
+
+def _archive_paused(cfg: Config) -> bool:
+    if cfg.NODE_ID:
+        return False
+    try:
+        return _lease_live(cfg, _SINGLE_NODE_LEASE)
+    except OSError as e:
+        logging.warning("Lease %s non leggibile (%s): batch senza esclusione", _SINGLE_NODE_LEASE, e)
+        return False
+
+@contextmanager
+def _maint_session(cfg: Config):
+    """Esclusione di un comando di manutenzione dal batch d'archivio (solo nodo singolo)."""
+    if cfg.NODE_ID:
+        yield
+        return
+    lp = _lease_acquire(cfg, _SINGLE_NODE_LEASE, wait_sec=600)
+    if lp is None:
+        raise RuntimeError(f"Lease {_SINGLE_NODE_LEASE} occupato: manutenzione già in corso")
+    try:
+        time.sleep(_MAINT_GRACE_SEC)
+        yield
+    finally:
+        _lease_release(cfg, lp)
+
+def _maint_lease(cfg: Config, docno: str) -> Optional[Path]:
+    """Lease del docno per un passo di manutenzione (esclude i nodi che lavorano lo stesso docno)."""
+    return _lease_acquire(cfg, docno)
+
+def _lease_release(cfg: Config, lp: Optional[Path]) -> None:
+    if lp is None:
         return
-    if iss_match is not None:
-        g1 = iss_match.group(1); g2 = iss_match.group(2); g3 = iss_match.group(3)
-        rev = iss_match.group(4); sheet = iss_match.group(5)
-        docno = f"G{g1}{g2}{g3}"
-        body = _edi_body(
-            document_no=docno, rev=rev, sheet=sheet,
-            description=" Impeller Specification Sheet",
-            actual_size="A4", uom="Metric", doctype="DETAIL", lang="English",
-            file_name=file_name, file_type="Pdf",
-        )
-        write_lines(out_dir / (Path(file_name).stem + ".DESEDI"), body)
+    nonce = _KEEPALIVE.forget(lp)
+    if nonce is None:
         return
-    if m is None or loc is None:
-        raise ValueError("write_edi: per STANDARD/FIV servono 'm' (BASE_NAME) e 'loc' (map_location)")
-    document_no = f"D{m.group(1)}{m.group(2)}{m.group(3)}"
-    rev = m.group(4); sheet = m.group(5)
-    file_type = "Pdf" if Path(file_name).suffix.lower() == ".pdf" else "Tiff"
-    body = _edi_body(
-        document_no=document_no, rev=rev, sheet=sheet, description="",
-        actual_size=size_from_letter(m.group(1)), uom=uom_from_letter(m.group(6)),
-        doctype=loc["doctype"], lang=loc["lang"],
-        file_name=file_name, file_type=file_type,
-    )
-    write_lines(edi, body)
+    try:
+        _lease_write(lp, nonce, cfg, 0.0)
+    except OSError:
+        pass
 
-# ---- STORICO: routing ---------------------------------------------------------------
+# ---- JOURNAL: write-ahead dei passi post-accettazione ---------------------------------
+#
+# Prima di spostare un file in archivio si scrive (fsync) il piano dei passi successivi:
+# archive, storico:<nome>, plm, edi, log. Ogni passo riuscito aggiunge un record 'done';
+# quando non resta nulla si scrive 'end'. All'avvio di run_once i piani aperti vengono
+# ripresi eseguendo solo i passi mancanti. I passi che producono una riga di log (log,
+# storico:*) si chiudono solo dopo che _flush_file_log l'ha scritta (done_logged + flushed):
+# un crash in mezzo ripete la riga invece di perderla.
 
-def _storico_dest_dir_for_name(cfg: Config, nm: str) -> Path:
-    mm = BASE_NAME.fullmatch(nm)
-    if not mm:
-        return cfg.ARCHIVIO_STORICO / "unknown"
-    return cfg.ARCHIVIO_STORICO / f"D{mm.group(1).upper()}"
+class _Journal:
+    def __init__(self, path: Path):
+        self.path = path
+        self._f = None
+        self.open_plans: Dict[str, dict] = {}
+        self.unflushed: List[tuple[str, str]] = []
+
+    def _write(self, rec: dict, sync: bool = False) -> None:
+        line = json.dumps(rec) + "\n"
+        def _append() -> None:
+            if self._f is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._f = self.path.open("a", encoding="utf-8")
+            self._f.write(line)
+            self._f.flush()
+            if sync:
+                os.fsync(self._f.fileno())
+        _fs_call("journal", self.path, _append)
+
+    def plan(self, name: str, src: Path, dir_tif_loc: Path, storico: List[str],
+             tail: tuple[str, ...] = ("plm", "edi", "log"), superseded: Optional[str] = None) -> str:
+        """superseded: nome che supera il file nello stesso batch; dir_tif_loc è allora la
+        cartella di storico e il passo 'log' è la sua riga Rev superata."""
+        jid = f"{time.time_ns():x}-{name}"
+        steps = ["archive", *(f"storico:{nm}" for nm in storico), *tail]
+        rec = {"op": "plan", "id": jid, "name": name, "src": str(src), "dir": str(dir_tif_loc), "steps": steps}
+        if superseded:
+            rec["superseded"] = superseded
+        self._write(rec, sync=True)
+        self.open_plans[jid] = dict(rec, steps=list(steps))
+        return jid
+
+    def done(self, jid: str, step: str) -> None:
+        plan = self.open_plans.get(jid)
+        if plan is None or step not in plan["steps"]:
+            return
+        plan["steps"].remove(step)
+        self._write({"op": "done", "id": jid, "step": step})
+        if not plan["steps"]:
+            self._write({"op": "end", "id": jid})
+            del self.open_plans[jid]
+
+    def done_logged(self, jid: str, step: str) -> None:
+        """Passo fatto, ma la sua riga è ancora nel buffer del log: 'done' a flush avvenuto."""
+        if jid:
+            self.unflushed.append((jid, step))
+
+    def flushed(self) -> None:
+        pending, self.unflushed = self.unflushed, []
+        for jid, step in pending:
+            self.done(jid, step)
+
+    def load_pending(self) -> None:
+        """Ricostruisce dal file i piani non conclusi (dopo un crash)."""
+        try:
+            text = _fs_call("read", self.path, self.path.read_text, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        for ln in text.splitlines():
+            try:
+                rec = json.loads(ln)
+            except ValueError:
+                continue  # ultima riga troncata dal crash
+            jid = rec.get("id")
+            if rec.get("op") == "plan":
+                self.open_plans[jid] = dict(rec, steps=list(rec["steps"]))
+            elif rec.get("op") == "done" and jid in self.open_plans:
+                steps = self.open_plans[jid]["steps"]
+                if rec.get("step") in steps:
+                    steps.remove(rec["step"])
+            elif rec.get("op") == "end":
+                self.open_plans.pop(jid, None)
+
+    def compact(self) -> None:
+        """Riscrive il journal con i soli piani aperti (vuoto → file rimosso)."""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if not self.open_plans:
+            _fs_call("unlink", self.path, self.path.unlink, missing_ok=True)
+            return
+        tmp = self.path.with_suffix(".tmp")
+        text = "".join(json.dumps(dict(plan, op="plan")) + "\n" for plan in self.open_plans.values())
+        def _rewrite() -> None:
+            with tmp.open("w", encoding="utf-8") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+        _fs_call("journal", tmp, _rewrite)
+        _fs_call("replace", self.path, os.replace, tmp, self.path)
+
+class _NoJournal:
+    def plan(self, *a, **k) -> str:
+        return ""
+    def done(self, jid: str, step: str) -> None:
+        pass
+    def done_logged(self, jid: str, step: str) -> None:
+        pass
+    def flushed(self) -> None:
+        pass
+    def compact(self) -> None:
+        pass
+
+_JOURNAL: Optional[_Journal] = None
+
+def _journal(cfg: Config):
+    global _JOURNAL
+    if not cfg.JOURNAL:
+        return _NoJournal()
+    suffix = f"_{cfg.NODE_ID}" if cfg.NODE_ID else ""
+    path = (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / f"Swarky{suffix}.journal"
+    if _JOURNAL is None or _JOURNAL.path != path:
+        _JOURNAL = _Journal(path)
+        _JOURNAL.load_pending()
+    return _JOURNAL
+
+def replay_journal(cfg: Config) -> int:
+    """Completa i piani rimasti aperti: esegue solo i passi non registrati come fatti."""
+    jr = _journal(cfg)
+    if not isinstance(jr, _Journal) or not jr.open_plans:
+        return 0
+    n = 0
+    with ui_phase(f"Ripristino journal ({len(jr.open_plans)} piani aperti)"):
+        for jid, plan in list(jr.open_plans.items()):
+            name = plan["name"]
+            dir_tif_loc = Path(plan["dir"])
+            new_path = dir_tif_loc / name
+            m = BASE_NAME.fullmatch(name)
+            if _FS.busy(Path(plan["src"]), new_path, dir_tif_loc):
+                logging.warning("Journal: %s ha ancora un'operazione scaduta in corso, piano tenuto", name)
+                continue
+            if plan.get("superseded"):
+                # superato nello stesso batch: destinazione storico, anche dentro il contenitore
+                present = name.lower() in _storico_names(dir_tif_loc, name, fresh=True)
+            else:
+                present = _fs_call("stat", new_path, new_path.exists)
+            if "archive" in plan["steps"]:
+                if present:
+                    jr.done(jid, "archive")
+                else:
+                    # crash prima dello spostamento: il file è ancora in ingresso e verrà riprocessato
+                    logging.warning("Journal: %s non archiviato, piano annullato", name)
+                    jr.open_plans.pop(jid, None)
+                    continue
+            if m is None or not present:
+                logging.warning("Journal: %s non più in archivio, piano annullato", name)
+                jr.open_plans.pop(jid, None)
+                continue
+            loc = map_location(m, cfg)
+            tiflog = loc["log_name"]
+            try:
+                for step in list(plan["steps"]):
+                    if (jid, step) in jr.unflushed:
+                        continue        # riga già nel buffer di un flush non riuscito
+                    if step.startswith("storico:"):
+                        nm = step.split(":", 1)[1]
+                        old_path = archived_path(cfg, nm)
+                        dest = _storico_dest_dir_for_name(cfg, nm)
+                        if old_path is not None:
+                            copied, rc = move_to_storico_safe(old_path, dest, cfg)
+                            if rc >= 8:
+                                continue
+                            if copied:
+                                log_swarky(cfg, name, tiflog, "Rev superata", nm, "Storico")
+                        elif nm.lower() in _storico_names(dest, nm):
+                            # spostato prima del crash, riga di log persa con il buffer
+                            log_swarky(cfg, name, tiflog, "Rev superata", nm, "Storico")
+                        jr.done_logged(jid, step)
+                    elif step == "plm":
+                        plm_path = cfg.PLM_DIR / name
+                        if not _fs_call("stat", plm_path, plm_path.exists):
+                            _fast_copy_or_link(new_path, plm_path)
+                        jr.done(jid, step)
+                    elif step == "edi":
+                        write_edi(cfg, name, cfg.PLM_DIR, m=m, loc=loc)
+                        jr.done(jid, step)
+                    elif step == "log" and plan.get("superseded"):
+                        log_swarky(cfg, plan["superseded"], tiflog, "Rev superata", name, "Storico")
+                        jr.done_logged(jid, step)
+                    elif step == "log":
+                        log_swarky(cfg, name, tiflog, "Archiviato", "Ripristino", dest=tiflog)
+                        jr.done_logged(jid, step)
+                n += 1
+            except Exception:
+                logging.exception("Journal: ripristino incompleto per %s", name)
+    jr.compact()
+    return n
 
 # ---- PIPELINE PRINCIPALE -------------------------------------------------------------
 
+def _scan_slice(it, exts: set, n: int = 256) -> tuple[bool, List[Path]]:
+    """Fino a n voci dell'iteratore scandir -> (finito, candidati): una _fs_call per fetta."""
+    out: List[Path] = []
+    for k, de in enumerate(it, 1):
+        if de.is_file() and os.path.splitext(de.name)[1].lower() in exts:
+            out.append(Path(de.path))
+        if k >= n:
+            return False, out
+    return True, out
+
 def _iter_candidates(dirp: Path, accept_pdf: bool):
     exts = {".tif"}
     if accept_pdf:
@@ -600,20 +3025,24 @@ def _iter_candidates(dirp: Path, accept_pdf: bool):
                 if suf in exts:
                     yield Path(de.path)
 
-def _process_candidate(p: Path, cfg: Config) -> bool:
+def _process_candidate(p: Path, cfg: Config, batch: Optional[NameBatch] = None, i: int = 0,
+                       plan: Optional[SupersedePlan] = None) -> bool:
+    """plan (plan_supersedes): se una revisione dello stesso batch che supera questo file è già
+    stata accettata, il file segue le regole normali ma, invece di archivio/PLM/EDI, va dritto
+    in storico dopo aver storicizzato ciò che avrebbe superato lui."""
+    lease: Optional[Path] = None
+    superseded_by = plan.superseded_by(i) if plan is not None else None
+    _PHASE.file = p.name
+    t_file = time.perf_counter()
     try:
         # --- normalizzazione estensione on-the-fly ---
         suf = p.suffix
-        if suf == ".TIF":
-            q = p.with_suffix(".tif")
-            try:
-                p.rename(q); p = q
-            except Exception:
-                pass
-        elif suf.lower() == ".tiff":
+        if suf == ".TIF" or suf.lower() == ".tiff":
             q = p.with_suffix(".tif")
             try:
-                p.rename(q); p = q
+                _fs_call("rename", p, p.rename, q); p = q
+            except FsTimeout:
+                raise
             except Exception:
                 pass
 
@@ -621,145 +3050,178 @@ def _process_candidate(p: Path, cfg: Config) -> bool:
 
         # ---- ORIENTAMENTO: subito in testa ----
         with ui_phase(f"{name} • orientamento"):
-            if not check_orientation_ok(p):
+            pre = batch.orient[i] if batch is not None and batch.orient is not None \
+                and batch.names[i].lower() == name.lower() else None
+            if not (pre if pre is not None else _fs_call("read", p, check_orientation_ok, p)):
                 log_error(cfg, name, "Immagine Girata")
                 move_to(p, cfg.ERROR_DIR)
                 return True
 
-        # ---- Regex + validazioni ----
+        # ---- Regex + validazioni (già calcolate in blocco da classify_names) ----
         with ui_phase(f"{name} • regex+validate"):
-            m = BASE_NAME.fullmatch(name)
-            if not m:
-                log_error(cfg, name, "Nome File Errato"); move_to(p, cfg.ERROR_DIR); return True
-            if m.group(1).upper() not in "ABCDE":
-                log_error(cfg, name, "Formato Errato"); move_to(p, cfg.ERROR_DIR); return True
-            if m.group(2).upper() not in "MKFTESNP":
-                log_error(cfg, name, "Location Errata"); move_to(p, cfg.ERROR_DIR); return True
-            if m.group(6).upper() not in "MIDN":
-                log_error(cfg, name, "Metrica Errata"); move_to(p, cfg.ERROR_DIR); return True
-
-        new_rev    = m.group(4)
-        new_sheet  = m.group(5)
-        new_metric = m.group(6).upper()
-        MI = {"M","I"}; DN = {"D","N"}
-        new_group = "MI" if new_metric in MI else "DN"
-        new_rev_i = int(new_rev)
+            if batch is None or batch.names[i].lower() != name.lower():
+                batch, i = classify_names([name], cfg), 0
+            reason = batch.reason[i]
+            if reason:
+                log_error(cfg, name, reason); move_to(p, cfg.ERROR_DIR); return True
+
+        # ---- Struttura TIFF (DEEP_TIFF_CHECK; di norma già verificata in blocco) ----
+        if cfg.DEEP_TIFF_CHECK and p.suffix.lower() == ".tif":
+            with ui_phase(f"{name} • verifica_tiff"):
+                err = batch.tiff_err[i] if batch.tiff_err is not None \
+                    and batch.names[i].lower() == name.lower() else None
+                if err is None:
+                    err = _fs_call("read", p, tiff_deep_check, p)[1] or ""
+            if err:
+                log_error(cfg, name, "TIFF Danneggiato", err)
+                move_to(p, cfg.ERROR_DIR)
+                return True
+
+        docno       = batch.docno[i]
+        new_rev_i   = batch.rev[i]
+        new_sheet_i = batch.sheet[i]
+        new_metric  = batch.metric[i]
+        new_group   = METRIC_GROUP[new_metric]
 
         # ---- Mappatura destinazione archivio ----
-        with ui_phase(f"{name} • map_location"):
-            loc = map_location(m, cfg)
-            dir_tif_loc = loc["dir_tif_loc"]
-            tiflog      = loc["log_name"]
+        loc = batch.loc[i]
+        dir_tif_loc = loc["dir_tif_loc"]
+        tiflog      = loc["log_name"]
+
+        # ---- Multi-nodo: lease sul docno per tutta la decisione d'archivio ----
+        if cfg.NODE_ID:
+            with ui_phase(f"{name} • lease_docno"):
+                lease = _lease_acquire(cfg, docno)
+            if lease is None:
+                logging.info("Docno %s occupato da un altro nodo, %s rimandato", docno, name)
+                return False
 
         # ---- Elenco file con stesso DOCNO ----
         with ui_phase(f"{name} • list_same_doc_prefisso"):
-            same_doc = _list_same_doc_prefisso(dir_tif_loc, m)
+            flat = _pending_flat(cfg, dir_tif_loc)
+            if _DOCNOS.absent(docno, dir_tif_loc, flat):
+                same_doc = []
+            else:
+                same_doc = _list_same_doc_prefisso(dir_tif_loc, docno, flat)
+
+        # ---- Stesso (docno, sheet) nel batch: si decide come se le revisioni più alte non ci fossero ancora ----
+        if plan is not None:
+            same_doc = plan.view(docno, new_sheet_i, new_rev_i, same_doc)
 
         with ui_phase(f"{name} • derive_same_sheet"):
-            same_sheet = [(r, nm, met, sh) for (r, nm, met, sh) in same_doc if sh == new_sheet]
+            summ = _sheet_summary(same_doc, new_sheet_i)
 
         # ---- Pari revisione (verifica via lista) ----
         with ui_phase(f"{name} • check_same_filename"):
-            if any((nm == name and r == new_rev) for (r, nm, met, sh) in same_sheet):
-                log_error(cfg, name, "Pari Revisione")
+            hit = next((e for e in summ.entries if e.name == name and e.rev == new_rev_i), None)
+            if hit is not None:
+                with ui_phase(f"{name} • confronto_contenuto"):
+                    if hit.dir is not None:
+                        identical = same_content(p, hit.dir / name)
+                    else:
+                        identical = storico_same_content(p, _storico_dest_dir_for_name(cfg, name), name)
+                if identical and cfg.PARI_REV_DISCARD_IDENTICAL:
+                    _fs_call("unlink", p, p.unlink)
+                    log_swarky(cfg, name, tiflog, "Pari Revisione Identica", name, "Scartato")
+                    return True
+                log_error(cfg, name, "Pari Revisione Identica" if identical else "Pari Revisione")
                 move_to(p, cfg.PARI_REV_DIR)
                 return True
 
-        # ---- Partizionamento e max rev ----
-        same_sheet_mi = [(int(r), nm, met) for (r, nm, met, sh) in same_sheet if met in MI]
-        same_sheet_dn = [(int(r), nm, met) for (r, nm, met, sh) in same_sheet if met in DN]
-        same_sheet_same_metric = [(int(r), nm, met) for (r, nm, met, sh) in same_sheet if met == new_metric]
-
-        def _max_rev(entries: List[Tuple[int,str,str]]) -> Optional[int]:
-            return max((rv for (rv, _, _) in entries), default=None)
-
-        max_mi = _max_rev(same_sheet_mi)
-        max_dn = _max_rev(same_sheet_dn)
-        own_max = _max_rev(same_sheet_same_metric)
+        # ---- Max rev per gruppo e per metrica (O(1) dal riepilogo) ----
+        other_group = "DN" if new_group == "MI" else "MI"
+        own_max = summ.max_metric(new_metric)
+        other_max = summ.max_group(other_group)
 
         # ---- Revisioni precedenti rispetto all'altro gruppo ----
-        other_entries = same_sheet_dn if new_group == "MI" else same_sheet_mi
-        other_max = max_dn if new_group == "MI" else max_mi
         if other_max is not None and new_rev_i < other_max:
-            ref = next((nm for (rv, nm, _met) in other_entries if rv == other_max), "")
-            log_error(cfg, name, "Revisione Precendente", ref)
+            log_error(cfg, name, "Revisione Precendente", summ.top_group[other_group].name)
             move_to(p, cfg.ERROR_DIR)
             return True
 
         # ---- Revisioni precedenti rispetto stessa metrica ----
         if own_max is not None and new_rev_i < own_max:
-            ref = next((nm for (rv, nm, _met) in same_sheet_same_metric if rv == own_max), "")
-            log_error(cfg, name, "Revisione Precendente", ref)
+            log_error(cfg, name, "Revisione Precendente", summ.top_metric[new_metric].name)
             move_to(p, cfg.ERROR_DIR)
             return True
 
         # ---- Conflitti pari rev tra gruppi/metrica ----
-        same_rev_mi = [(rv, nm, met) for (rv, nm, met) in same_sheet_mi if rv == new_rev_i]
-        same_rev_dn = [(rv, nm, met) for (rv, nm, met) in same_sheet_dn if rv == new_rev_i]
+        same_rev_other = next((e for e in summ.in_group(other_group) if e.rev == new_rev_i), None)
+        same_rev_own = next((e for e in summ.in_group(new_group)
+                             if e.rev == new_rev_i and e.metric != new_metric), None)
 
         if new_group == "MI":
-            if same_rev_dn:
-                ref = same_rev_dn[0][1]
-                log_error(cfg, name, "Conflitto Metrica (DN a pari revisione)", ref)
+            if same_rev_other is not None:
+                log_error(cfg, name, "Conflitto Metrica (DN a pari revisione)", same_rev_other.name)
                 move_to(p, cfg.ERROR_DIR)
                 return True
-            other_mi = next((nm for (_rv, nm, met) in same_rev_mi if met != new_metric), None)
-            if other_mi:
-                log_swarky(cfg, name, tiflog, "Metrica Diversa", other_mi)
+            if same_rev_own is not None:
+                log_swarky(cfg, name, tiflog, "Metrica Diversa", same_rev_own.name)
         else:
-            if same_rev_mi:
-                ref = same_rev_mi[0][1]
-                log_error(cfg, name, "Conflitto Metrica (MI a pari revisione)", ref)
+            if same_rev_other is not None:
+                log_error(cfg, name, "Conflitto Metrica (MI a pari revisione)", same_rev_other.name)
                 move_to(p, cfg.ERROR_DIR)
                 return True
-            other_dn = next((nm for (_rv, nm, met) in same_rev_dn if met != new_metric), None)
-            if other_dn:
-                log_error(cfg, name, "Conflitto Metrica (D/N a pari revisione)", other_dn)
+            if same_rev_own is not None:
+                log_error(cfg, name, "Conflitto Metrica (D/N a pari revisione)", same_rev_own.name)
                 move_to(p, cfg.ERROR_DIR)
                 return True
 
-        # ---- ACCETTAZIONE del NUOVO ----
-        with ui_phase(f"{name} • move_to_archivio"):
-            move_to(p, dir_tif_loc)
-            new_path = dir_tif_loc / name
-
-        # ---- STORICIZZAZIONI (dopo l'accettazione) ----
+        # ---- STORICIZZAZIONI da fare dopo l'accettazione ----
         to_storico_same: list[tuple[Path, Path, str]] = []
         to_storico_other: list[tuple[Path, Path, str]] = []
         if own_max is None or new_rev_i > own_max:
-            for rv, nm, _met in same_sheet_same_metric:
-                if rv < new_rev_i:
-                    to_storico_same.append((dir_tif_loc / nm, _storico_dest_dir_for_name(cfg, nm), nm))
+            for e in summ.entries:
+                if e.metric == new_metric and e.rev < new_rev_i and e.dir is not None:
+                    to_storico_same.append((e.dir / e.name, _storico_dest_dir_for_name(cfg, e.name), e.name))
         if other_max is not None and new_rev_i > other_max:
-            for rv, nm, _met in other_entries:
-                if rv < new_rev_i:
-                    to_storico_other.append((dir_tif_loc / nm, _storico_dest_dir_for_name(cfg, nm), nm))
+            for e in summ.in_group(other_group):
+                if e.rev < new_rev_i and e.dir is not None:
+                    to_storico_other.append((e.dir / e.name, _storico_dest_dir_for_name(cfg, e.name), e.name))
 
-        if to_storico_same:
-            with ui_phase(f"{name} • move_old_revs_same_metric"):
-                for old_path, dest_dir, nm in to_storico_same:
-                    try:
-                        copied, rc = move_to_storico_safe(old_path, dest_dir)
-                        if rc >= 8:
-                            logging.exception("Storico (same metric) errore: %s → %s", old_path, dest_dir)
-                        elif copied:
-                            log_swarky(cfg, name, tiflog, "Rev superata", nm, "Storico")
-                        else:
-                            log_error(cfg, nm, "Presente in Storico")
-                            try:
-                                move_to(old_path, cfg.ERROR_DIR)
-                            except FileNotFoundError:
-                                pass
-                    except Exception as e:
-                        logging.exception("Storico (same metric): %s → %s: %s", old_path, dest_dir, e)
+        # ---- JOURNAL: piano scritto prima di toccare l'archivio ----
+        if cfg.NODE_ID and not _lease_held(lease):
+            logging.warning("Lease su %s perso prima dell'archiviazione, %s rimandato", docno, name)
+            return False
+        jr = _journal(cfg)
+        olds = [nm for (_o, _d, nm) in to_storico_same + to_storico_other]
+        if superseded_by is not None:
+            dest_dir = _storico_dest_dir_for_name(cfg, name)
+            jid = jr.plan(name, p, dest_dir, olds, tail=("log",), superseded=superseded_by)
+            with ui_phase(f"{name} • superata_nel_batch"):
+                copied, rc = move_to_storico_safe(p, dest_dir, cfg)
+            if rc >= 8:
+                logging.error("Storico errore: %s → %s", p, dest_dir)
+                _FAILURES.record(p, "Storico non raggiungibile")
+                return False
+            if copied:
+                log_swarky(cfg, superseded_by, tiflog, "Rev superata", name, "Storico")
+            else:
+                log_error(cfg, name, "Presente in Storico")
+                move_to(p, cfg.ERROR_DIR)
+            jr.done(jid, "archive")
+            jr.done_logged(jid, "log")
+        else:
+            jid = jr.plan(name, p, dir_tif_loc, olds)
+
+            # ---- ACCETTAZIONE del NUOVO ----
+            with ui_phase(f"{name} • move_to_archivio"), _DOCNOS.writing((dir_tif_loc, flat), docno):
+                move_to(p, dir_tif_loc)
+                new_path = dir_tif_loc / name
+            jr.done(jid, "archive")
+        if plan is not None:
+            plan.accept(name, docno, new_sheet_i, new_rev_i, archived=superseded_by is None)
 
-        if to_storico_other:
-            with ui_phase(f"{name} • move_old_revs_other_group"):
-                for old_path, dest_dir, nm in to_storico_other:
+        to_storico = to_storico_same + to_storico_other
+        if to_storico:
+            with ui_phase(f"{name} • move_old_revs_storico"), \
+                    _DOCNOS.writing([o.parent for (o, _d, _n) in to_storico]):
+                results = move_many_to_storico(to_storico, cfg)
+                for (old_path, dest_dir, nm), (copied, rc) in zip(to_storico, results):
                     try:
-                        copied, rc = move_to_storico_safe(old_path, dest_dir)
                         if rc >= 8:
-                            logging.exception("Storico (other grp) errore: %s → %s", old_path, dest_dir)
+                            logging.error("Storico errore: %s → %s", old_path, dest_dir)
+                            continue
                         elif copied:
                             log_swarky(cfg, name, tiflog, "Rev superata", nm, "Storico")
                         else:
@@ -768,35 +3230,53 @@ def _process_candidate(p: Path, cfg: Config) -> bool:
                                 move_to(old_path, cfg.ERROR_DIR)
                             except FileNotFoundError:
                                 pass
+                        jr.done_logged(jid, f"storico:{nm}")
+                        if plan is not None:
+                            plan.left_archive(docno, new_rev_i, next(e for e in summ.entries if e.name == nm))
                     except Exception as e:
-                        logging.exception("Storico (other grp): %s → %s: %s", old_path, dest_dir, e)
+                        logging.exception("Storico: %s → %s: %s", old_path, dest_dir, e)
+        if superseded_by is not None:
+            return True
 
         # ---- PLM + EDI ----
         with ui_phase(f"{name} • link/copy_to_PLM"):
             try:
                 _fast_copy_or_link(new_path, cfg.PLM_DIR / name)
+                jr.done(jid, "plm")
             except Exception as e:
                 logging.exception("PLM copy/link fallita per %s: %s", new_path, e)
 
         with ui_phase(f"{name} • write_EDI"):
             try:
-                write_edi(cfg, name, cfg.PLM_DIR, m=m, loc=loc)
+                write_edi(cfg, name, cfg.PLM_DIR, m=BASE_NAME.fullmatch(name), loc=loc)
+                jr.done(jid, "edi")
             except Exception as e:
                 logging.exception("Impossibile creare DESEDI per %s: %s", name, e)
 
         log_swarky(cfg, name, tiflog, "Archiviato", "", dest=tiflog)
+        jr.done_logged(jid, "log")
         return True
 
-    except Exception:
+    except FsTimeout as e:
+        _FAILURES.record(p, str(e), min_delay=_FS.cooldown)
+        return False
+    except Exception as e:
         logging.exception("Errore inatteso per %s", p)
+        _FAILURES.record(p, f"{type(e).__name__}: {e}")
         return False
+    finally:
+        _lease_release(cfg, lease)
+        if _TRACE.enabled:
+            _TRACE.span(_PHASE.file, "file", t_file, time.perf_counter())
+        _PHASE.file = ""
 
 # ---- ISS / FIV ----------------------------------------------------------------------
 
 def iss_loading(cfg: Config) -> bool:
     did = False
     try:
-        candidates = [p for p in cfg.DIR_ISS.iterdir() if p.is_file() and p.suffix.lower() == ".pdf"]
+        candidates = [p for p in _fs_call("scan", cfg.DIR_ISS, _scan_files, cfg.DIR_ISS)
+                      if p.suffix.lower() == ".pdf"]
     except Exception as e:
         logging.exception("ISS: impossibile leggere la cartella %s: %s", cfg.DIR_ISS, e)
         return False
@@ -826,7 +3306,7 @@ def iss_loading(cfg: Config) -> bool:
 def fiv_loading(cfg: Config) -> bool:
     did = False
     try:
-        files = [p for p in cfg.DIR_FIV_LOADING.iterdir() if p.is_file()]
+        files = _fs_call("scan", cfg.DIR_FIV_LOADING, _scan_files, cfg.DIR_FIV_LOADING)
     except Exception as e:
         logging.exception("FIV: lettura cartella fallita: %s", e)
         return False
@@ -855,9 +3335,11 @@ def fiv_loading(cfg: Config) -> bool:
 _LAST_STATS_TS: float = 0.0
 
 def _count_files_quick(d: Path, exts: tuple[str, ...]) -> int:
-    try:
+    def _count() -> int:
         with os.scandir(d) as it:
             return sum(1 for de in it if de.is_file() and os.path.splitext(de.name)[1].lower() in exts)
+    try:
+        return _DIRCACHE.cached(d, "count:" + ",".join(exts), _count)
     except (OSError, FileNotFoundError):
         return 0
 
@@ -878,6 +3360,8 @@ def _should_emit_stats() -> bool:
     return False
 
 def count_tif_files(cfg: Config) -> dict:
+    _DIRCACHE.bind(cfg)
+    _FS.bind(cfg)
     return {
         "Same Rev Dwg": _count_files_quick(cfg.PARI_REV_DIR, (".tif", ".pdf")),
         "Check Dwg": _count_files_quick(cfg.ERROR_DIR, (".tif", ".pdf")),
@@ -888,46 +3372,1124 @@ def count_tif_files(cfg: Config) -> dict:
 
 # ---- LOOP ----------------------------------------------------------------------------
 
+def _archive_pass(cfg: Config) -> bool:
+    """Ripristino journal + scan e processing dei candidati (streaming, multi-nodo o batch)."""
+    # passi rimasti a metà da un'esecuzione interrotta
+    try:
+        replay_journal(cfg)
+    except Exception:
+        logging.exception("Journal: ripristino fallito")
+
+    if cfg.STREAM_CHUNK > 0 and not cfg.NODE_ID:
+        did_something = _run_streaming(cfg)
+    else:
+        with ui_phase("Scan candidati (hplotter)"):
+            try:
+                candidates: List[Path] = _fs_call("scan", cfg.DIR_HPLOTTER,
+                                                  lambda: list(_iter_candidates(cfg.DIR_HPLOTTER, cfg.ACCEPT_PDF)))
+            except FsTimeout as e:
+                logging.error("Scan hplotter non riuscito: %s", e)
+                candidates = []
+        _FAILURES.prune({p.name.lower() for p in candidates})
+        candidates = [p for p in candidates if not _FAILURES.blocked(p)]
+        logging.info("Batch: %d candidati", len(candidates), extra={"ui": ("batch", len(candidates))})
+
+        did_something = False
+        if cfg.NODE_ID:
+            did_something = _run_claimed(cfg, candidates)
+        else:
+            with ui_phase("Classificazione nomi"):
+                batch = classify_names([p.name for p in candidates], cfg)
+                plan = plan_supersedes(batch)
+            if cfg.DEEP_TIFF_CHECK:
+                with ui_phase("Verifica TIFF"):
+                    _deep_check_batch(candidates, batch, cfg)
+            for i in plan.order:
+                if _archive_paused(cfg):
+                    logging.info("Archivio occupato da una manutenzione: resto del batch rimandato")
+                    break
+                try:
+                    ok = _process_candidate(candidates[i], cfg, batch, i, plan)
+                    if ok:
+                        _FAILURES.forget(candidates[i].name)
+                    did_something |= ok
+                except Exception:
+                    logging.exception("Errore nel processing")
+    return did_something
+
 def run_once(cfg: Config) -> bool:
     start_all = time.time()
 
-    with ui_phase("Scan candidati (hplotter)"):
-        candidates: List[Path] = list(_iter_candidates(cfg.DIR_HPLOTTER, cfg.ACCEPT_PDF))
+    _storico_cache_reset()
+    _DIRCACHE.bind(cfg)
+    _FS.bind(cfg)
+    _FAILURES.bind(cfg)
+    _DOCNOS.bind(cfg)
+    _FSSTATS.bind(cfg)
+    _FSSTATS.reset()
+    _EVENTS.bind(cfg)
+    _EVENTS.begin()
+    _TRACE.bind(cfg)
+    _TRACE.begin()
 
-    did_something = False
-    for p in candidates:
-        try:
-            did_something |= _process_candidate(p, cfg)
-        except Exception:
-            logging.exception("Errore nel processing")
+    if _archive_paused(cfg):
+        logging.info("Archivio occupato da una manutenzione: batch rimandato")
+        did_something = False
+    else:
+        did_something = _archive_pass(cfg)
 
     did_arch = did_something
-    did_iss  = iss_loading(cfg)
-    did_fiv  = fiv_loading(cfg)
+    did_iss = did_fiv = False
+    iss_lease = _lease_acquire(cfg, "_ISS_FIV", wait_sec=0) if cfg.NODE_ID else None
+    if iss_lease is not None or not cfg.NODE_ID:
+        try:
+            did_iss  = iss_loading(cfg)
+            did_fiv  = fiv_loading(cfg)
+        finally:
+            _lease_release(cfg, iss_lease)
 
     elapsed_all = time.time() - start_all
     minutes = int(elapsed_all // 60)
     seconds = int(elapsed_all % 60)
     _append_filelog_line(f"ProcessTime # {minutes:02d}:{seconds:02d}")
 
-    _flush_file_log(cfg)
+    if _flush_file_log(cfg):
+        try:
+            _journal(cfg).flushed()
+        except Exception:
+            logging.exception("Journal: chiusura passi di log fallita")
+    _EVENTS.flush()
+    try:
+        _journal(cfg).compact()
+    except Exception:
+        logging.exception("Journal: compattazione fallita")
+    try:
+        _DIRCACHE.save()
+    except Exception:
+        logging.exception("Cache cartelle: salvataggio fallito")
+    try:
+        _FAILURES.save()
+    except Exception:
+        logging.exception("Cache errori: salvataggio fallito")
+    try:
+        _DOCNOS.save()
+    except Exception:
+        logging.exception("Filtro docno: salvataggio fallito")
+    _FSSTATS.flush(elapsed_all)
+    if _TRACE.enabled and (did_arch or did_iss or did_fiv or _TRACE.had_files()
+                           or elapsed_all >= _TRACE.SLOW_SEC):
+        _TRACE.save(_EVENTS.batch)
+    stuck = _FAILURES.stuck()
+    if stuck or _FAILURES.reported:
+        logging.info("File bloccati: %d", len(stuck), extra={"ui": ("stuck", stuck)})
+    _FAILURES.reported = len(stuck)
+    logging.info("Batch finito in %.1fs", elapsed_all, extra={"ui": ("batch_done", elapsed_all)})
 
     if logging.getLogger().isEnabledFor(logging.DEBUG) and _should_emit_stats():
         logging.debug("Counts: %s", count_tif_files(cfg))
 
     return did_arch or did_iss or did_fiv
 
+# ---- PIPELINE STREAMING: scan -> classificazione/orientamento -> processing ----------
+
+def _q_put(q: "queue.Queue", item, stop: threading.Event) -> bool:
+    """put bloccante (contropressione) che si arrende se il consumatore ha smesso."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _stream_scan(cfg: Config, out_q: "queue.Queue", seen: set, stop: threading.Event,
+                 scanned: threading.Event) -> None:
+    """Stadio 1: scandir dell'hplotter a blocchi di STREAM_CHUNK. Un nome già visto
+    (es. rinominato .TIF -> .tif mentre la scansione è in corso) non viene riproposto;
+    scanned segnala che seen contiene l'intera cartella."""
+    chunk: List[Path] = []
+    exts = {".tif", ".pdf"} if cfg.ACCEPT_PDF else {".tif"}
+    hp = cfg.DIR_HPLOTTER
+    try:
+        it = _fs_call("scan", hp, os.scandir, hp)
+        end = False
+        while not end:
+            # a fette con scadenza; su FsTimeout l'iteratore resta al thread appeso (non si chiude sotto di lui)
+            end, paths = _fs_call("scan", hp, _scan_slice, it, exts)
+            for p in paths:
+                key = p.name.lower()
+                if key in seen:
+                    continue
+                seen.add(key)
+                chunk.append(p)
+                if len(chunk) >= cfg.STREAM_CHUNK:
+                    logging.info("Scan: +%d candidati", len(chunk), extra={"ui": ("batch_more", len(chunk))})
+                    if not _q_put(out_q, chunk, stop):
+                        it.close()
+                        return
+                    chunk = []
+        it.close()
+        if chunk:
+            logging.info("Scan: +%d candidati", len(chunk), extra={"ui": ("batch_more", len(chunk))})
+            _q_put(out_q, chunk, stop)
+        scanned.set()
+    except Exception as e:
+        logging.error("Scan hplotter non riuscito: %s", e)
+    finally:
+        _q_put(out_q, None, stop)
+
+def _stream_prepare(cfg: Config, in_q: "queue.Queue", out_q: "queue.Queue", stop: threading.Event) -> None:
+    """Stadio 2: classificazione dei nomi e lettura dell'orientamento, fuori dal thread di processing.
+    Un orientamento non leggibile resta None: lo rilegge (e gestisce) _process_candidate."""
+    try:
+        while not stop.is_set():
+            try:
+                chunk = in_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                break
+            batch = classify_names([p.name for p in chunk], cfg)
+            orient: List[Optional[bool]] = [None] * len(chunk)
+            for i, p in enumerate(chunk):
+                if stop.is_set():
+                    return
+                if batch.reason[i] or _FAILURES.waiting(p.name):
+                    continue
+                prev, _PHASE.label = getattr(_PHASE, "label", ""), f"{p.name} • orientamento"
+                try:
+                    orient[i] = bool(_fs_call("read", p, check_orientation_ok, p))
+                except Exception:
+                    pass
+                finally:
+                    _PHASE.label = prev
+            batch.orient = orient
+            _deep_check_batch(chunk, batch, cfg)
+            if not _q_put(out_q, (chunk, batch), stop):
+                return
+    finally:
+        _q_put(out_q, None, stop)
+
+def _run_streaming(cfg: Config) -> bool:
+    """Nodo singolo con STREAM_CHUNK > 0: i tre stadi girano in parallelo collegati da code
+    di STREAM_QUEUE blocchi, così l'archiviazione parte mentre la scansione è ancora in corso
+    e la memoria resta limitata a pochi blocchi. Le revisioni superate si coalescono
+    all'interno del blocco (plan_supersedes), non tra blocchi diversi."""
+    depth = max(1, cfg.STREAM_QUEUE)
+    scan_q: queue.Queue = queue.Queue(maxsize=depth)
+    work_q: queue.Queue = queue.Queue(maxsize=depth)
+    stop, scanned = threading.Event(), threading.Event()
+    seen: set[str] = set()
+    logging.info("Batch: streaming a blocchi di %d", cfg.STREAM_CHUNK, extra={"ui": ("batch", 0)})
+    scanner = threading.Thread(target=_stream_scan, args=(cfg, scan_q, seen, stop, scanned), daemon=True, name="swarky-scan")
+    preparer = threading.Thread(target=_stream_prepare, args=(cfg, scan_q, work_q, stop), daemon=True, name="swarky-prep")
+    scanner.start(); preparer.start()
+
+    # uno stadio a monte appeso (scandir su share morta) non deve bloccare la passata
+    idle_limit = max(cfg.FS_TIMEOUT_SEC, cfg.FS_COPY_TIMEOUT_SEC) * 2 or None
+    did = False
+    n = 0
+    try:
+        while True:
+            try:
+                item = work_q.get(timeout=idle_limit)
+            except queue.Empty:
+                logging.error("Pipeline: nessun blocco da %ds, passata interrotta", int(idle_limit))
+                break
+            if item is None:
+                break
+            chunk, batch = item
+            plan = plan_supersedes(batch)
+            paused = False
+            for i in plan.order:
+                p = chunk[i]
+                if _FAILURES.blocked(p):
+                    continue
+                if _archive_paused(cfg):
+                    logging.info("Archivio occupato da una manutenzione: resto della passata rimandato")
+                    paused = True
+                    break
+                n += 1
+                try:
+                    ok = _process_candidate(p, cfg, batch, i, plan)
+                    if ok:
+                        _FAILURES.forget(p.name)
+                    did |= ok
+                except Exception:
+                    logging.exception("Errore nel processing")
+            if paused:
+                break
+    finally:
+        stop.set()
+    if scanned.is_set():
+        _FAILURES.prune(seen)
+    logging.info("Batch: %d candidati (streaming)", n)
+    return did
+
+def _run_claimed(cfg: Config, candidates: List[Path]) -> bool:
+    """Multi-nodo: reclama a blocchi di CLAIM_BATCH e processa solo i file vinti."""
+    import random
+    _node_heartbeat(cfg)
+    _KEEPALIVE.ensure(cfg)
+    _recover_dead_nodes(cfg)
+    # prima gli orfani di un nostro crash precedente, poi il resto in ordine casuale
+    stage = _node_stage_dir(cfg)
+    own = _fs_call("scan", stage, lambda: list(_iter_candidates(stage, cfg.ACCEPT_PDF)))
+    pending = list(candidates)
+    random.shuffle(pending)
+    step = cfg.CLAIM_BATCH if cfg.CLAIM_BATCH > 0 else max(1, len(pending))
+    did = False
+    while own or pending:
+        if own:
+            claimed, own = own, []
+        else:
+            with ui_phase("Claim candidati (multi-nodo)"):
+                claimed = _claim_candidates(cfg, pending[:step])
+            pending = pending[step:]
+        batch = classify_names([p.name for p in claimed], cfg)
+        plan = plan_supersedes(batch)
+        if cfg.DEEP_TIFF_CHECK:
+            with ui_phase("Verifica TIFF"):
+                _deep_check_batch(claimed, batch, cfg)
+        for i in plan.order:
+            p = claimed[i]
+            try:
+                ok = _process_candidate(p, cfg, batch, i, plan)
+            except Exception:
+                logging.exception("Errore nel processing")
+                ok = False
+            if ok:
+                _FAILURES.forget(p.name)
+            else:
+                _unclaim(cfg, p)
+            did |= ok
+    return did
+
 def watch_loop(cfg: Config, interval: int):
     logging.info("Watch ogni %ds...", interval)
     while True:
         run_once(cfg); time.sleep(interval)
 
+# ---- SERVIZIO HEADLESS: stato + API locale -------------------------------------------
+
+class _StatusHandler(logging.Handler):
+    """Raccoglie gli eventi 'ui' (gli stessi che consuma la GUI) in uno stato interrogabile."""
+    def __init__(self, max_events: int = 500):
+        super().__init__()
+        self._lock = threading.Lock()
+        self.events: deque = deque(maxlen=max_events)
+        self.seq = 0
+        self.phase = ""
+        self.running = False
+        self.queue_total = 0
+        self.batch_files: set[str] = set()
+        self.batch_t0 = 0.0
+        self.batches = 0
+        self.files_total = 0
+        self.busy_sec = 0.0
+        self.last_batch_sec = 0.0
+        self.stuck: list = []
+        self.started = time.time()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        ui = getattr(record, "ui", None)
+        if not ui:
+            return
+        kind = ui[0]
+        with self._lock:
+            if kind == "phase":
+                self.phase = ui[1] if len(ui) > 1 else ""
+            elif kind == "batch":
+                self.running = True
+                self.queue_total = int(ui[1])
+                self.batch_files = set()
+                self.batch_t0 = time.monotonic()
+            elif kind == "batch_more":
+                self.queue_total += int(ui[1])
+            elif kind == "batch_done":
+                self.running = False
+                self.batches += 1
+                self.last_batch_sec = float(ui[1])
+                self.busy_sec += self.last_batch_sec
+                self.phase = ""
+            elif kind == "stuck":
+                self.stuck = list(ui[1])
+            elif kind in ("processed", "anomaly"):
+                file_name = ui[1]
+                if file_name not in self.batch_files:
+                    self.batch_files.add(file_name)
+                    self.files_total += 1
+                self.seq += 1
+                ev = {"seq": self.seq, "ts": record.created, "kind": kind, "file": file_name}
+                if kind == "processed":
+                    ev.update(process=ui[2] if len(ui) > 2 else "",
+                              compare=ui[3] if len(ui) > 3 else "",
+                              dest=ui[4] if len(ui) > 4 else "")
+                else:
+                    ev.update(error=ui[2] if len(ui) > 2 else "")
+                self.events.append(ev)
+
+    def status(self) -> dict:
+        with self._lock:
+            busy = self.busy_sec + (time.monotonic() - self.batch_t0 if self.running else 0.0)
+            return {
+                "running": self.running,
+                "phase": self.phase,
+                "queue_depth": max(0, self.queue_total - len(self.batch_files)) if self.running else 0,
+                "batches": self.batches,
+                "files_total": self.files_total,
+                "files_per_min": round(self.files_total * 60.0 / busy, 2) if busy > 0 else 0.0,
+                "last_batch_sec": round(self.last_batch_sec, 2),
+                "last_seq": self.seq,
+                "uptime_sec": int(time.time() - self.started),
+                "started": self.started,
+                "stuck": list(self.stuck),
+            }
+
+    def events_since(self, seq: int) -> list[dict]:
+        with self._lock:
+            return [ev for ev in self.events if ev["seq"] > seq]
+
+def _make_status_server(status: _StatusHandler, wake: threading.Event, port: int):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit, parse_qs
+
+    class _Api(BaseHTTPRequestHandler):
+        def _send(self, code: int, body: str, ctype: str = "application/json") -> None:
+            data = body.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", f"{ctype}; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/status":
+                self._send(200, json.dumps(status.status()))
+            elif url.path == "/events":
+                try:
+                    since = int(parse_qs(url.query).get("since", ["0"])[0])
+                except ValueError:
+                    since = 0
+                lines = [json.dumps(ev) for ev in status.events_since(since)]
+                self._send(200, "".join(ln + "\n" for ln in lines), "application/x-ndjson")
+            else:
+                self._send(404, json.dumps({"error": "not found"}))
+
+        def do_POST(self):
+            if urlsplit(self.path).path == "/run":
+                wake.set()
+                self._send(202, json.dumps({"queued": True}))
+            else:
+                self._send(404, json.dumps({"error": "not found"}))
+
+        def log_message(self, fmt, *args):
+            logging.debug("api: " + fmt, *args)
+
+    return ThreadingHTTPServer(("127.0.0.1", port), _Api)
+
+def serve(cfg: Config, interval: int, port: int) -> None:
+    """Modalità servizio: watch senza GUI + API locale (GET /status, GET /events?since=N, POST /run)."""
+    status = _StatusHandler()
+    logging.getLogger().addHandler(status)
+    wake = threading.Event()
+    server = _make_status_server(status, wake, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Servizio su http://127.0.0.1:%d, watch ogni %ds...", port, interval)
+    try:
+        while True:
+            try:
+                run_once(cfg)
+            except Exception:
+                logging.exception("Errore nel batch")
+            wake.wait(interval)
+            wake.clear()
+    finally:
+        server.shutdown()
+
+# ---- AUDIT ARCHIVIO: scansione parallela, a blocchi, riprendibile ---------------------
+#
+# Unità di lavoro = (cartella d'archivio, prime due cifre del numero): l'enumerazione
+# D??NN* tiene in RAM ~1% di una cartella per volta. Le violazioni vanno in JSON lines;
+# le unità completate in <out>.done, così una scansione interrotta riparte da lì.
+
+def _subdirs(dirp: Path) -> List[Path]:
+    try:
+        with os.scandir(dirp) as it:
+            return [Path(de.path) for de in it if de.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+def _shard_subdirs(cfg: Config, dirp: Path) -> List[Path]:
+    k = cfg.SHARD_DIGITS
+    return [d for d in _subdirs(dirp) if len(d.name) == k and d.name.isdigit()] if k > 0 else []
+
+def _archive_dirs(cfg: Config, shards: bool = True) -> List[Path]:
+    """Cartelle <folder>/<size><subloc> presenti sotto ARCHIVIO_DISEGNI e, con shards, i loro shard."""
+    folders = sorted({v[0] for v in LOCATION_MAP.values()} | {DEFAULT_LOCATION[0]})
+    out: List[Path] = []
+    for folder in folders:
+        for d in _subdirs(cfg.ARCHIVIO_DISEGNI / folder):
+            out.append(d)
+            if shards:
+                out.extend(_shard_subdirs(cfg, d))
+    return sorted(out)
+
+def _audit_units(cfg: Config, d: Path):
+    """(cartella, NN) da enumerare: in uno shard solo i NN compatibili con il suo prefisso."""
+    k = cfg.SHARD_DIGITS
+    sharded = k > 0 and len(d.name) == k and d.name.isdigit()
+    for nn in range(100):
+        nn_s = f"{nn:02d}"
+        if not sharded or nn_s[:k] == d.name[:2]:
+            yield d, nn_s
+
+def _audit_sheet(summ: SheetSummary) -> List[Tuple[str, str, str]]:
+    """Violazioni delle regole README su un (docno, sheet) -> [(file, violazione, riferimento)]."""
+    out: List[Tuple[str, str, str]] = []
+    for e in summ.entries:
+        top = summ.top_metric[e.metric]
+        if e.rev < top.rev:
+            out.append((e.name, "Revisione multipla stessa metrica (da storicizzare)", top.name))
+            continue
+        grp = METRIC_GROUP.get(e.metric)
+        if grp is None:
+            out.append((e.name, "Metrica Errata", ""))
+            continue
+        other = summ.top_group.get("DN" if grp == "MI" else "MI")
+        if other is not None and e.rev < other.rev:
+            out.append((e.name, "Revisione superata dall'altro gruppo (da storicizzare)", other.name))
+        elif other is not None and e.rev == other.rev:
+            out.append((e.name, "Conflitto Metrica (MI e DN a pari revisione)", other.name))
+        elif grp == "DN":
+            twin = next((x for x in summ.in_group("DN") if x.rev == e.rev and x.metric != e.metric), None)
+            if twin is not None:
+                out.append((e.name, "Conflitto Metrica (D/N a pari revisione)", twin.name))
+    return out
+
+def _audit_unit(cfg: Config, dirp: Path, nn: str, check_plm: bool) -> List[dict]:
+    entries = _parse_prefixed(_win_find_names_ex(dirp, f"D??{nn}*"))
+    by_sheet: Dict[tuple[str, int], List[ArchEntry]] = {}
+    for e in entries:
+        by_sheet.setdefault((e.name[:9].upper(), e.sheet), []).append(e)
+    plm = {x.lower() for x in _win_find_names_ex(cfg.PLM_DIR, f"D??{nn}*")} if check_plm else None
+    out: List[dict] = []
+    for group in by_sheet.values():
+        summ = SheetSummary(group)
+        for nm, what, ref in _audit_sheet(summ):
+            out.append({"dir": str(dirp), "file": nm, "violation": what, "ref": ref})
+        if plm is not None:
+            for top in summ.top_metric.values():
+                if top.name.lower() not in plm:
+                    out.append({"dir": str(dirp), "file": top.name, "violation": "Assente in PLM", "ref": ""})
+    return out
+
+def _audit_trim(out_path: Path, done: set[str]) -> None:
+    """Ripresa: toglie da out_path le righe di unità senza marcatore in .done (interrotte a metà,
+    verrebbero riscritte) e un'eventuale ultima riga troncata."""
+    if not out_path.exists():
+        return
+    keep: List[str] = []
+    dropped = 0
+    with out_path.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+                ok = line.endswith("\n") and f"{row['dir']}|{row['file'][3:5]}" in done
+            except (ValueError, KeyError, TypeError):
+                ok = False
+            if ok:
+                keep.append(line)
+            else:
+                dropped += 1
+    if dropped:
+        tmp = out_path.with_name(out_path.name + ".tmp")
+        tmp.write_text("".join(keep), encoding="utf-8")
+        os.replace(tmp, out_path)
+        logging.info("Audit: %d righe di unità non concluse scartate prima della ripresa", dropped)
+
+def audit_archive(cfg: Config, out_path: Path, *, workers: int = 8,
+                  check_plm: bool = False, restart: bool = False) -> int:
+    """Scansione parallela dell'archivio; ritorna il numero di violazioni trovate in questa esecuzione."""
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    done_path = out_path.with_name(out_path.name + ".done")
+    if restart:
+        out_path.unlink(missing_ok=True)
+        done_path.unlink(missing_ok=True)
+    done: set[str] = set()
+    if done_path.exists():
+        text = done_path.read_text(encoding="utf-8")
+        if not text.endswith("\n"):
+            text = text[:text.rfind("\n") + 1]       # marcatore troncato: unità da rifare
+            done_path.write_text(text, encoding="utf-8")
+        done = set(text.splitlines())
+    _audit_trim(out_path, done)
+    units = (u for d in _archive_dirs(cfg) for u in _audit_units(cfg, d))
+    units = (u for u in units if f"{u[0]}|{u[1]}" not in done)
+
+    found = 0
+    n_units = 0
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with out_path.open("a", encoding="utf-8") as out_f, done_path.open("a", encoding="utf-8") as done_f, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        inflight: Dict[Any, str] = {}
+        def _fill():
+            for d, nn in units:
+                inflight[pool.submit(_audit_unit, cfg, d, nn, check_plm)] = f"{d}|{nn}"
+                if len(inflight) >= 2 * workers:
+                    break
+        _fill()
+        while inflight:
+            ready, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+            for fut in ready:
+                key = inflight.pop(fut)
+                try:
+                    rows = fut.result()
+                except Exception:
+                    logging.exception("Audit: unità %s fallita", key)
+                    continue
+                for row in rows:
+                    out_f.write(json.dumps(row) + "\n")
+                found += len(rows)
+                out_f.flush()
+                done_f.write(key + "\n")
+                done_f.flush()
+                n_units += 1
+                if n_units % 100 == 0:
+                    logging.info("Audit: %d unità, %d violazioni", n_units, found)
+            _fill()
+    logging.info("Audit completato: %d unità, %d violazioni → %s", n_units, found, out_path)
+    return found
+
+# ---- MIGRAZIONE AL LAYOUT A SHARD: online, a blocchi, riprendibile --------------------
+#
+# Sposta i file delle cartelle piatte (archivio e storico) nel loro shard, a blocchi e con
+# un tetto di file/s per non saturare la share mentre la pipeline lavora. Riprendibile per
+# costruzione: ogni passata riparte da ciò che è rimasto nella cartella piatta; svuotata
+# la cartella scrive il marcatore e la pipeline smette di enumerarla.
+
+def _flat_dirs(cfg: Config) -> List[Path]:
+    storico = [d for d in _subdirs(cfg.ARCHIVIO_STORICO) if d.name.lower() != "unknown"]
+    return _archive_dirs(cfg, shards=False) + sorted(storico)
+
+def _migrate_one(cfg: Config, flat: Path, nm: str) -> str:
+    """-> "moved" | "dup" (già nello shard, identico) | "conflict" (diverso, in ERROR_DIR)."""
+    dst_dir = _shard_dir(cfg, flat, nm[3:9])
+    dst = dst_dir / nm
+    src = flat / nm
+    exists = _fs_call("stat", dst, dst.exists)
+    if _PACK_NAME.fullmatch(nm) and exists:
+        conflicts = _pack_merge(cfg, src, dst)
+        _fs_call("unlink", src, src.unlink)
+        return "conflict" if conflicts else "dup"
+    if exists:
+        if same_content(src, dst):
+            _fs_call("unlink", src, src.unlink)
+            return "dup"
+        log_error(cfg, nm, "Conflitto Shard", str(dst_dir))
+        move_to(src, cfg.ERROR_DIR)
+        return "conflict"
+    move_to(src, dst_dir)
+    return "moved"
+
+def migrate_shards(cfg: Config, *, batch: int = 200, rate: float = 50.0) -> Dict[str, int]:
+    """Migra tutte le cartelle piatte agli shard; ritorna i conteggi per esito."""
+    if cfg.SHARD_DIGITS <= 0:
+        raise ValueError("migrate-shards: impostare SHARD_DIGITS > 0 in config.json")
+    counts = {"moved": 0, "dup": 0, "conflict": 0, "failed": 0}
+    step = 1.0 / rate if rate > 0 else 0.0
+    with _maint_session(cfg):
+        for flat in _flat_dirs(cfg):
+            if (flat / _SHARD_MARKER).exists():
+                continue
+            failed: set[str] = set()
+            with ui_phase(f"Migrazione shard {flat}"):
+                while True:
+                    chunk: List[str] = []
+                    with os.scandir(flat) as it:
+                        for de in it:
+                            if de.name not in failed and (BASE_NAME.fullmatch(de.name) or _PACK_NAME.fullmatch(de.name)) \
+                                    and de.is_file():
+                                chunk.append(de.name)
+                                if len(chunk) >= batch:
+                                    break
+                    if not chunk:
+                        break
+                    t_next = time.perf_counter()
+                    for nm in chunk:
+                        lease = None
+                        try:
+                            lease = _maint_lease(cfg, nm[:9].upper())
+                            if lease is None:
+                                failed.add(nm)
+                                counts["failed"] += 1
+                                continue
+                            counts[_migrate_one(cfg, flat, nm)] += 1
+                        except OSError:
+                            logging.exception("Migrazione shard: %s non spostato", flat / nm)
+                            failed.add(nm)
+                            counts["failed"] += 1
+                        finally:
+                            if lease is not None:
+                                _lease_release(cfg, lease)
+                        t_next += step
+                        delay = t_next - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    logging.info("Migrazione shard %s: %s", flat, counts)
+            if failed:
+                logging.warning("Migrazione shard %s incompleta: %d file da riprovare", flat, len(failed))
+            else:
+                (flat / _SHARD_MARKER).write_text(str(cfg.SHARD_DIGITS), encoding="utf-8")
+    return counts
+
+# ---- COSTRUZIONE FILTRO DOCNO ---------------------------------------------------------
+
+def build_docno_filter(cfg: Config) -> Tuple[int, int]:
+    """Ricostruisce il filtro docno da tutte le cartelle d'archivio (piatte e shard).
+    Una cartella entra nel filtro solo se il suo mtime non è cambiato durante l'enumerazione
+    ed è abbastanza vecchio da essere affidabile. -> (docno, cartelle affidabili)"""
+    docnos: set[str] = set()
+    stable: Dict[str, list] = {}
+    _CLOCK.bind(cfg)
+    for d in _archive_dirs(cfg):
+        try:
+            t0 = os.stat(d).st_mtime_ns
+            now = _CLOCK.now_ns(d)
+            with os.scandir(d) as it:
+                for de in it:
+                    mm = BASE_NAME.fullmatch(de.name)
+                    if mm and de.is_file():
+                        docnos.add(_docno_from_match(mm).upper())
+            if os.stat(d).st_mtime_ns == t0 and now - t0 > _DirListCache.RACY_NS:
+                stable[str(d).lower()] = [t0, now]
+        except OSError as e:
+            logging.warning("Filtro docno: %s non enumerabile: %s", d, e)
+    f = _DocnoFilter()
+    f.path = _DocnoFilter.file_for(cfg)
+    f.reset(2 * len(docnos))
+    for dn in docnos:
+        f.add(dn)
+    f.dirs = stable
+    f.save()
+    _DOCNOS.path = None  # il prossimo bind rilegge il file
+    return len(docnos), len(stable)
+
+# ---- REPORT DAI LOG MENSILI: streaming, memoria costante -----------------------------
+#
+# Legge le righe "data # ora # file\t# location\t# esito\t# rif" dei Swarky_<Mese>.<Anno>.log,
+# le "ProcessTime # mm:ss" (durata del batch, datata con l'ultimo orario visto: righe
+# evento o righe del logging) e aggrega per giorno e per mese. Arrivi = Archiviato, scarti
+# (ERRORE), Pari Revisione Identica scartata, ISS e FIV; le righe Metrica Diversa e
+# Rev superata descrivono lo stesso arrivo e contano solo nel mix esiti.
+
+_MONTHS = {m: i for i, m in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), 1)}
+_MONTHS.update({m: i for i, m in enumerate(
+    ("gen", "feb", "mar", "apr", "mag", "giu", "lug", "ago", "set", "ott", "nov", "dic"), 1)})
+_RE_LOG_FILE = re.compile(r"Swarky_([A-Za-z]{3})\.(\d{4})\.log$")
+_RE_EVENT = re.compile(r"(\d{2})\.([A-Za-z]{3})\.(\d{4}) # (\d{2}):(\d{2}):(\d{2}) # (.*?)\t# (.*?)\t# (.*?)\t# (.*?)\s*$")
+_RE_STAMP = re.compile(r"(\d{4})-(\d{2})-(\d{2}) (\d{2}):\d{2}:\d{2} ")
+_RE_PROCESSTIME = re.compile(r"ProcessTime # (\d+):(\d{2})\s*$")
+_ARRIVALS = frozenset(("Archiviato", "Pari Revisione Identica", "ISS", "FIV loading"))
+
+class _DayStats:
+    __slots__ = ("arrivals", "hours", "outcomes", "locations", "batches", "batch_sec", "batch_max", "idle")
+
+    def __init__(self):
+        self.arrivals = 0
+        self.hours = [0] * 24
+        self.outcomes: Dict[str, int] = {}
+        self.locations: Dict[str, int] = {}
+        self.batches = 0
+        self.batch_sec = 0
+        self.batch_max = 0
+        self.idle = 0       # passaggi senza eventi (--watch a vuoto): fuori dalle durate
+
+    def merge(self, o: "_DayStats") -> None:
+        self.arrivals += o.arrivals
+        self.hours = [a + b for a, b in zip(self.hours, o.hours)]
+        for mine, theirs in ((self.outcomes, o.outcomes), (self.locations, o.locations)):
+            for k, v in theirs.items():
+                mine[k] = mine.get(k, 0) + v
+        self.batches += o.batches
+        self.batch_sec += o.batch_sec
+        self.batch_max = max(self.batch_max, o.batch_max)
+        self.idle += o.idle
+
+def _report_logs(log_dir: Path, first: Optional[str], last: Optional[str]) -> List[Path]:
+    """Log mensili in ordine cronologico, filtrati per YYYY-MM (estremi inclusi)."""
+    out = []
+    for p in log_dir.glob("Swarky_*.log"):
+        mm = _RE_LOG_FILE.fullmatch(p.name)
+        mon = _MONTHS.get(mm.group(1).lower()) if mm else None
+        if mon is None:
+            continue
+        tag = f"{mm.group(2)}-{mon:02d}"
+        if (first and tag < first) or (last and tag > last):
+            continue
+        out.append((tag, p))
+    return [p for _t, p in sorted(out)]
+
+def _log_records(paths: List[Path]):
+    """Righe utili dei log, in ordine: ("ev", giorno, secondi del giorno, file, location, esito,
+    riferimento) per gli eventi, ("day", giorno) per le righe del logging, ("pt", secondi) per
+    ProcessTime."""
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                ev = _RE_EVENT.match(line)
+                if ev is not None:
+                    mon = _MONTHS.get(ev.group(2).lower())
+                    if mon is not None:
+                        sec = int(ev.group(4)) * 3600 + int(ev.group(5)) * 60 + int(ev.group(6))
+                        yield ("ev", f"{ev.group(3)}-{mon:02d}-{ev.group(1)}", sec,
+                               ev.group(7), ev.group(8), ev.group(9), ev.group(10))
+                    continue
+                ts = _RE_STAMP.match(line)
+                if ts is not None:
+                    yield ("day", f"{ts.group(1)}-{ts.group(2)}-{ts.group(3)}")
+                    continue
+                pt = _RE_PROCESSTIME.match(line)
+                if pt is not None:
+                    yield ("pt", int(pt.group(1)) * 60 + int(pt.group(2)))
+
+def collect_report(log_dir: Path, first: Optional[str] = None, last: Optional[str] = None) -> Dict[str, _DayStats]:
+    """giorno (YYYY-MM-DD) -> aggregati, leggendo i log riga per riga. Un ProcessTime conta come
+    batch solo se dal ProcessTime precedente c'è stato almeno un evento; gli altri sono passaggi
+    a vuoto (idle)."""
+    days: Dict[str, _DayStats] = {}
+    loc_memo: Dict[tuple[str, str], str] = {}
+    day: Optional[str] = None
+    busy = False
+    for rec in _log_records(_report_logs(log_dir, first, last)):
+        if rec[0] == "day":
+            day = rec[1]
+            continue
+        if rec[0] == "pt":
+            if day is not None:
+                st = days.get(day) or days.setdefault(day, _DayStats())
+                if busy:
+                    st.batches += 1
+                    st.batch_sec += rec[1]
+                    st.batch_max = max(st.batch_max, rec[1])
+                else:
+                    st.idle += 1
+            busy = False
+            continue
+        busy = True
+        _k, day, sec, file, loc, what, _ref = rec
+        st = days.get(day) or days.setdefault(day, _DayStats())
+        if loc == "ERRORE":
+            outcome = f"ERRORE: {what}"
+            mm = BASE_NAME.fullmatch(file)
+            if mm:
+                key = (mm.group(2).upper(), mm.group(3)[0])
+                loc = loc_memo.get(key) or loc_memo.setdefault(key, _location_entry(*key)[1])
+            else:
+                loc = "?"
+            arrival = True
+        else:
+            outcome = what
+            arrival = what in _ARRIVALS
+        st.outcomes[outcome] = st.outcomes.get(outcome, 0) + 1
+        if arrival:
+            st.arrivals += 1
+            st.hours[sec // 3600] += 1
+            st.locations[loc] = st.locations.get(loc, 0) + 1
+    return days
+
+def _report_rows(days: Dict[str, _DayStats]):
+    """Righe (livello, periodo, misura, chiave, valore): giorni e poi il totale di ogni mese."""
+    months: Dict[str, _DayStats] = {}
+    for d in sorted(days):
+        months.setdefault(d[:7], _DayStats()).merge(days[d])
+    for level, table in (("giorno", days), ("mese", months)):
+        for period in sorted(table):
+            st = table[period]
+            yield level, period, "arrivi", "", st.arrivals
+            for h, n in enumerate(st.hours):
+                if n:
+                    yield level, period, "arrivi_ora", f"{h:02d}", n
+            for k, n in sorted(st.outcomes.items()):
+                yield level, period, "esito", k, n
+            for k, n in sorted(st.locations.items()):
+                yield level, period, "location", k, n
+            yield level, period, "batch", "n", st.batches
+            yield level, period, "batch", "sec_tot", st.batch_sec
+            yield level, period, "batch", "sec_max", st.batch_max
+            yield level, period, "batch", "sec_medio", round(st.batch_sec / st.batches, 1) if st.batches else 0
+            yield level, period, "batch", "a_vuoto", st.idle
+
+def _report_html(days: Dict[str, _DayStats]) -> str:
+    from html import escape
+    months: Dict[str, Dict[str, _DayStats]] = {}
+    for d in sorted(days):
+        months.setdefault(d[:7], {})[d] = days[d]
+    out = ["<!doctype html><meta charset='utf-8'><title>Swarky report</title>",
+           "<style>body{font-family:Segoe UI,Arial,sans-serif;margin:16px}table{border-collapse:collapse;"
+           "margin:6px 0 18px}td,th{border:1px solid #cbd5e1;padding:3px 8px;text-align:right}"
+           "th{background:#000080;color:#fff}td:first-child{text-align:left}</style>",
+           "<h1>Swarky report</h1>"]
+    for month, mdays in months.items():
+        tot = _DayStats()
+        for st in mdays.values():
+            tot.merge(st)
+        out.append(f"<h2>{escape(month)}</h2>")
+        out.append("<table><tr><th>Giorno</th><th>Arrivi</th><th>Picco/ora</th><th>Batch</th>"
+                   "<th>Durata media (s)</th><th>Durata max (s)</th><th>Passaggi a vuoto</th></tr>")
+        for d, st in list(mdays.items()) + [("Totale", tot)]:
+            avg = f"{st.batch_sec / st.batches:.1f}" if st.batches else "-"
+            out.append(f"<tr><td>{escape(d)}</td><td>{st.arrivals}</td><td>{max(st.hours)}</td>"
+                       f"<td>{st.batches}</td><td>{avg}</td><td>{st.batch_max}</td><td>{st.idle}</td></tr>")
+        out.append("</table><table><tr><th>Ora</th>" + "".join(f"<th>{h:02d}</th>" for h in range(24)) + "</tr>"
+                   "<tr><td>Arrivi</td>" + "".join(f"<td>{n}</td>" for n in tot.hours) + "</tr></table>")
+        for title, data in (("Esito", tot.outcomes), ("Location", tot.locations)):
+            out.append(f"<table><tr><th>{title}</th><th>File</th><th>%</th></tr>")
+            total = sum(data.values()) or 1
+            for k, n in sorted(data.items(), key=lambda kv: -kv[1]):
+                out.append(f"<tr><td>{escape(k)}</td><td>{n}</td><td>{100 * n / total:.1f}</td></tr>")
+            out.append("</table>")
+    return "\n".join(out) + "\n"
+
+def write_report(cfg: Config, out: Path, fmt: str = "csv",
+                 first: Optional[str] = None, last: Optional[str] = None) -> int:
+    """Report da Swarky_*.log in CSV (formato lungo, per pivot) o HTML. -> giorni coperti"""
+    days = collect_report(cfg.LOG_DIR or cfg.DIR_HPLOTTER, first, last)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    if fmt == "html":
+        out.write_text(_report_html(days), encoding="utf-8")
+    else:
+        import csv
+        with open(out, "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f, delimiter=";")
+            w.writerow(("livello", "periodo", "misura", "chiave", "valore"))
+            w.writerows(_report_rows(days))
+    return len(days)
+
+# ---- REPLAY DI UNA GIORNATA DI PRODUZIONE ------------------------------------------------
+#
+# Dai Swarky_*.log fino al giorno scelto: lo stato dell'archivio a inizio giornata (Archiviato
+# aggiunge, Rev superata sposta in storico) più i file che gli eventi del giorno citano come
+# riferimento (Revisione Precedente, Metrica Diversa, Conflitto Metrica, Pari Revisione, Rev
+# superata) e che i log più vecchi non coprono; gli arrivi del giorno con il loro orario. Il
+# tutto ricostruito in una sandbox locale con la config corrente (solo i percorsi cambiano) e
+# rigiocato con run_once, all'istante o accelerato di `speed` volte. I contenuti sono sintetici
+# (TIFF con le sole dimensioni, ruotato per Immagine Girata, diverso dall'archivio per Pari
+# Revisione non identica): contano nomi, ordine, orari e volumi, non le immagini.
+# Un Rev superata verso un file mai archiviato nei log è un arrivo superato nello stesso batch
+# se quel file compare come soggetto di altre righe del giorno, altrimenti un file archiviato
+# prima dell'inizio dei log (ricreato in archivio).
+
+_REPLAY_SEED_REF = frozenset(("Revisione Precendente", "Metrica Diversa", "Rev superata",
+                              "Conflitto Metrica (DN a pari revisione)",
+                              "Conflitto Metrica (MI a pari revisione)",
+                              "Conflitto Metrica (D/N a pari revisione)"))
+_REPLAY_NOT_ARRIVAL = frozenset(("Presente in Storico", "Conflitto Shard", "Conflitto Storico"))
+
+class ReplayPlan:
+    """archive/storico: nomi presenti a inizio giornata; arrivals: (secondi, cartella, nome,
+    variante, verticale) in ordine di log (variante 1 = contenuto diverso dall'archivio,
+    2 = TIFF troncato); outcomes: mix esiti originale del giorno."""
+    __slots__ = ("day", "archive", "storico", "arrivals", "outcomes")
+
+    def __init__(self, day: str):
+        self.day = day
+        self.archive: set[str] = set()
+        self.storico: set[str] = set()
+        self.arrivals: List[tuple[int, str, str, int, bool]] = []
+        self.outcomes: Dict[str, int] = {}
+
+def _replay_outcome(loc: str, what: str) -> str:
+    return f"ERRORE: {what}" if loc == "ERRORE" else what
+
+def build_replay(log_dir: Path, day: str) -> ReplayPlan:
+    """Stato a inizio `day` (YYYY-MM-DD) e arrivi del giorno dai log mensili fino a quel mese."""
+    plan = ReplayPlan(day)
+    archive, storico = plan.archive, plan.storico
+    today: set[str] = set()   # archiviati durante la giornata
+    events: List[tuple] = []
+
+    def _seed(nm: str) -> None:
+        if BASE_NAME.fullmatch(nm) and nm not in archive and nm not in today:
+            archive.add(nm)
+
+    for rec in _log_records(_report_logs(log_dir, None, day[:7])):
+        if rec[0] != "ev" or rec[1] > day:
+            continue
+        _k, d, sec, file, loc, what, ref = rec
+        if d == day:
+            events.append(rec)
+        elif loc != "ERRORE" and what == "Archiviato":
+            archive.add(file)
+            storico.discard(file)
+        elif what == "Rev superata" and ref:
+            archive.discard(ref)
+            storico.add(ref)
+
+    subjects = {rec[3] for rec in events}
+    for _k, _d, sec, file, loc, what, ref in events:
+        out = _replay_outcome(loc, what)
+        plan.outcomes[out] = plan.outcomes.get(out, 0) + 1
+        if what == "Rev superata" and ref in subjects and ref not in archive and ref not in today:
+            plan.arrivals.append((sec, "hplotter", ref, 0, False))
+        elif what in _REPLAY_SEED_REF and ref:
+            _seed(ref)
+        if loc == "ERRORE":
+            if what in _REPLAY_NOT_ARRIVAL:
+                if what == "Presente in Storico":
+                    storico.add(file)
+                continue
+            if what.startswith("Pari Revisione"):
+                _seed(file)
+            folder = {"Nome ISS Errato": "iss", "Nome FIV Errato": "fiv"}.get(what, "hplotter")
+            variant = {"Pari Revisione": 1, "TIFF Danneggiato": 2}.get(what, 0)
+            plan.arrivals.append((sec, folder, file, variant, what == "Immagine Girata"))
+        elif what == "Archiviato" and ref != "Ripristino":
+            plan.arrivals.append((sec, "hplotter", file, 0, False))
+            today.add(file)
+        elif what == "Pari Revisione Identica":
+            _seed(file)
+            plan.arrivals.append((sec, "hplotter", file, 0, False))
+        elif what in ("ISS", "FIV loading"):
+            plan.arrivals.append((sec, "iss" if what == "ISS" else "fiv", file, 0, False))
+    return plan
+
+def _replay_content(name: str, variant: int, portrait: bool, kb: int) -> bytes:
+    """TIFF/PDF sintetico di ~kb KB, deterministico per (nome, variante); strutturalmente
+    valido (una strip G4) così passa DEEP_TIFF_CHECK, troncato per la variante 2."""
+    seed = hashlib.blake2b(f"{name.lower()}|{variant}".encode(), digest_size=32).digest()
+    pad = (seed * (kb * 32 + 1))[:kb * 1024]
+    if name.lower().endswith(".pdf"):
+        return b"%PDF-1.4\n%" + pad + b"\n%%EOF\n"
+    w, h = (2000, 2800) if portrait else (2800, 2000)
+    data_off = 8 + 2 + 8 * 12 + 4
+    ifd = [(256, 3, 1, w), (257, 3, 1, h), (258, 3, 1, 1), (259, 3, 1, 4), (262, 3, 1, 0),
+           (273, 4, 1, data_off), (278, 3, 1, h), (279, 4, 1, max(1, len(pad)))]
+    body = b"II" + struct.pack("<HI", 42, 8) + struct.pack("<H", len(ifd))
+    body += b"".join(struct.pack("<HHII", t, ty, n, v) for t, ty, n, v in ifd)
+    body += struct.pack("<I", 0) + (pad or b"\0")
+    return body[:data_off + 1] if variant == 2 else body
+
+def replay_day(base: Dict[str, Any], log_dir: Path, day: str, out: Path,
+               speed: float = 0.0, kb: int = 64, poll_sec: float = 1.0) -> dict:
+    """Ricostruisce in `out` (nuova o vuota) e rigioca la giornata; speed 0 = arrivi tutti
+    insieme, altrimenti orari del giorno compressi di `speed` volte. -> riepilogo"""
+    plan = build_replay(log_dir, day)
+    if out.exists() and any(out.iterdir()):
+        raise FileExistsError(f"Cartella replay non vuota: {out}")
+    d = json.loads(json.dumps(base))
+    keys = ("hplotter", "archivio", "error_dir", "pari_rev", "plm", "storico",
+            "iss", "fiv", "heng", "error_plm", "tab")
+    d["paths"] = {k: str(out / k) for k in keys}
+    d["paths"]["log_dir"] = str(out / "logs")
+    d.pop("NODE_ID", None)
+    for k in keys:
+        (out / k).mkdir(parents=True, exist_ok=True)
+    (out / "config.json").write_text(json.dumps(d, indent=2), encoding="utf-8")
+    cfg = dc_replace(Config.from_json(d), NODE_ID=None)   # SWARKY_NODE_ID nell'ambiente non vale nella sandbox
+    setup_logging(cfg)
+
+    for nm in plan.archive:
+        dst = map_location(BASE_NAME.fullmatch(nm), cfg)["dir_tif_loc"]
+        dst.mkdir(parents=True, exist_ok=True)
+        (dst / nm).write_bytes(_replay_content(nm, 0, False, kb))
+    for nm in plan.storico:
+        if BASE_NAME.fullmatch(nm):
+            dst = _storico_dest_dir_for_name(cfg, nm)
+            dst.mkdir(parents=True, exist_ok=True)
+            (dst / nm).write_bytes(_replay_content(nm, 0, False, kb))
+    logging.info("Replay %s: %d in archivio, %d in storico, %d arrivi",
+                 day, len(plan.archive), len(plan.storico), len(plan.arrivals))
+
+    folders = {"hplotter": cfg.DIR_HPLOTTER, "iss": cfg.DIR_ISS, "fiv": cfg.DIR_FIV_LOADING}
+    pending = sorted(plan.arrivals, key=lambda a: a[0])
+    t_first = pending[0][0] if pending else 0
+    batches: List[float] = []
+    skipped: List[str] = []
+    stalls = 0
+    t0 = time.monotonic()
+    i = 0
+    while True:
+        now = (time.monotonic() - t0) * speed if speed > 0 else float("inf")
+        held = False
+        while i < len(pending) and pending[i][0] - t_first <= now:
+            _sec, folder, nm, variant, portrait = pending[i]
+            dst = folders[folder] / nm
+            if dst.exists():
+                held = True   # stesso nome ancora in ingresso: arriva dopo il prossimo batch
+                break
+            dst.write_bytes(_replay_content(nm, variant, portrait, kb))
+            i += 1
+        tb = time.perf_counter()
+        did = run_once(cfg)
+        batches.append(time.perf_counter() - tb)
+        if i >= len(pending) and not did:
+            break
+        if did:
+            stalls = 0
+            continue
+        if held:
+            # il file omonimo non esce dall'ingresso (rimandato, bloccato): dopo qualche
+            # passata a vuoto si salta l'arrivo invece di girare all'infinito
+            stalls += 1
+            if stalls >= 3:
+                logging.warning("Replay: %s resta in ingresso, arrivo successivo saltato", pending[i][2])
+                skipped.append(pending[i][2])
+                i += 1
+                stalls = 0
+            continue
+        wait = (pending[i][0] - t_first) / speed - (time.monotonic() - t0)
+        time.sleep(min(poll_sec, max(0.0, wait)))
+    wall = time.monotonic() - t0
+
+    replayed: Dict[str, int] = {}
+    for rec in _log_records(sorted((out / "logs").glob("Swarky_*.log"))):
+        if rec[0] == "ev":
+            o = _replay_outcome(rec[4], rec[5])
+            replayed[o] = replayed.get(o, 0) + 1
+    return {"day": day, "arrivals": len(pending), "archive": len(plan.archive),
+            "storico": len(plan.storico), "wall_sec": round(wall, 2), "batches": len(batches),
+            "busy_sec": round(sum(batches), 2), "batch_max_sec": round(max(batches, default=0.0), 2),
+            "skipped": skipped,
+            "outcomes": {k: [plan.outcomes.get(k, 0), replayed.get(k, 0)]
+                         for k in sorted(set(plan.outcomes) | set(replayed))}}
+
 # ---- CLI -----------------------------------------------------------------------------
 
 def parse_args(argv: List[str]):
     import argparse
     ap = argparse.ArgumentParser(description="Swarky - batch archiviazione/EDI")
     ap.add_argument("--watch", type=int, default=0, help="Loop di polling in secondi, 0=una sola passata")
+    ap.add_argument("--serve", type=int, default=0, metavar="PORT",
+                    help="Servizio headless con API di stato su 127.0.0.1:PORT (watch ogni --watch s, default 60)")
+    sub = ap.add_subparsers(dest="cmd")
+    au = sub.add_parser("audit", help="Verifica di coerenza dell'archivio (regole README)")
+    au.add_argument("--out", type=Path, default=None, help="File JSON lines delle violazioni")
+    au.add_argument("--workers", type=int, default=8, help="Enumerazioni parallele")
+    au.add_argument("--plm", action="store_true", help="Segnala anche le revisioni correnti assenti in PLM")
+    au.add_argument("--restart", action="store_true", help="Ignora il checkpoint e riparte da zero")
+    ms = sub.add_parser("migrate-shards", help="Sposta archivio e storico nel layout a shard (SHARD_DIGITS)")
+    ms.add_argument("--batch", type=int, default=200, help="File per blocco di enumerazione")
+    ms.add_argument("--rate", type=float, default=50.0, help="Massimo file spostati al secondo (0=senza limite)")
+    rp = sub.add_parser("report", help="Aggregati giornalieri e mensili dai log (CSV o HTML)")
+    rp.add_argument("--format", choices=("csv", "html"), default="csv")
+    rp.add_argument("--out", type=Path, default=None, help="File di uscita (default nella cartella log)")
+    rp.add_argument("--from", dest="first", default=None, metavar="YYYY-MM", help="Primo mese incluso")
+    rp.add_argument("--to", dest="last", default=None, metavar="YYYY-MM", help="Ultimo mese incluso")
+    rl = sub.add_parser("replay", help="Rigioca una giornata dai log su una sandbox locale")
+    rl.add_argument("day", metavar="YYYY-MM-DD")
+    rl.add_argument("--out", type=Path, required=True, help="Cartella sandbox (nuova o vuota)")
+    rl.add_argument("--speed", type=float, default=0.0, help="Accelerazione degli orari (0 = tutto subito)")
+    rl.add_argument("--kb", type=int, default=64, help="Dimensione dei file sintetici in KB")
+    rl.add_argument("--logs", type=Path, default=None, help="Cartella dei Swarky_*.log (default: log correnti)")
+    se = sub.add_parser("storico-extract", help="Estrae una revisione dallo storico (contenitore o file sciolto)")
+    se.add_argument("name", help="Nome file, es. DAM100001R02S01M.tif")
+    se.add_argument("--out", type=Path, default=Path("."), help="Cartella di destinazione")
+    sp = sub.add_parser("storico-pack", help="Converte lo storico sciolto in contenitori per docno (STORICO_PACK)")
+    sp.add_argument("--rate", type=float, default=50.0, help="Massimo file convertiti al secondo (0=senza limite)")
+    sub.add_parser("build-docno-filter", help="Ricostruisce il filtro dei docno in archivio (primo arrivo senza enumerazione)")
     return ap.parse_args(argv)
 
 def load_config(path: Path) -> Config:
@@ -937,15 +4499,54 @@ def load_config(path: Path) -> Config:
     return Config.from_json(data)
 
 def main(argv: List[str]):
+    t0 = time.perf_counter()
     args = parse_args(argv)
     cfg = load_config(Path("config.json"))
     setup_logging(cfg)
+    _EVENTS.bind(cfg)
+    if os.environ.get("SWARKY_STARTUP_REPORT"):
+        print(f"Startup: import Swarky {_IMPORT_MS} ms, argomenti+config+logging "
+              f"{int((time.perf_counter() - t0) * 1000)} ms", file=sys.stderr)
 
-    if args.watch > 0:
+    if args.cmd == "audit":
+        out = args.out or (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / "Swarky_audit.jsonl"
+        n = audit_archive(cfg, out, workers=max(1, args.workers), check_plm=args.plm, restart=args.restart)
+        print(f"Audit: {n} violazioni → {out}")
+    elif args.cmd == "migrate-shards":
+        counts = migrate_shards(cfg, batch=max(1, args.batch), rate=args.rate)
+        print("Migrazione shard: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+    elif args.cmd == "report":
+        out = args.out or (cfg.LOG_DIR or cfg.DIR_HPLOTTER) / f"Swarky_report.{args.format}"
+        n = write_report(cfg, out, args.format, args.first, args.last)
+        print(f"Report: {n} giorni → {out}")
+    elif args.cmd == "replay":
+        base = json.loads(Path("config.json").read_text(encoding="utf-8"))
+        res = replay_day(base, args.logs or cfg.LOG_DIR or cfg.DIR_HPLOTTER, args.day, args.out,
+                         args.speed, args.kb)
+        print(f"Replay {res['day']}: {res['arrivals']} arrivi su {res['archive']} file in archivio, "
+              f"{res['batches']} batch, {res['busy_sec']}s di lavoro in {res['wall_sec']}s "
+              f"(batch max {res['batch_max_sec']}s)")
+        for k, (orig, new) in res["outcomes"].items():
+            print(f"  {k:<45} {orig:>6} {new:>6}{'' if orig == new else '  ≠'}")
+        if res["skipped"]:
+            print(f"  arrivi saltati (omonimo fermo in ingresso): {', '.join(res['skipped'])}")
+    elif args.cmd == "storico-extract":
+        print(storico_extract(cfg, args.name, args.out))
+    elif args.cmd == "storico-pack":
+        counts = storico_pack(cfg, rate=args.rate)
+        print("Storico a contenitori: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+    elif args.cmd == "build-docno-filter":
+        n_doc, n_dirs = build_docno_filter(cfg)
+        print(f"Filtro docno: {n_doc} docno, {n_dirs} cartelle → {_DocnoFilter.file_for(cfg)}")
+    elif args.serve > 0:
+        serve(cfg, args.watch or 60, args.serve)
+    elif args.watch > 0:
         watch_loop(cfg, args.watch)
     else:
         run_once(cfg)
 
+_IMPORT_MS = int((time.perf_counter() - _T_IMPORT0) * 1000)
+
 if __name__ == "__main__":
     try:
         main(sys.argv[1:])
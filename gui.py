@@ -5,12 +5,12 @@
 """
 
 from __future__ import annotations
+import time
+_T_START = time.perf_counter()  # riferimento per il report di avvio
 import json
 import logging
 import threading
 import os, sys, subprocess
-import tkinter.simpledialog as simpledialog
-import time
 from pathlib import Path
 from datetime import datetime, time as dt_time, timedelta
 from typing import Optional, Dict
@@ -18,15 +18,12 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import tkinter.font as tkfont
 
-# watchdog opzionale
-try:
-    from watchdog.observers import Observer
-    from watchdog.events import FileSystemEventHandler
-except Exception:
-    Observer = None  # type: ignore
+# watchdog opzionale: importato in start_plotter_watcher, fuori dal percorso di avvio
 
 # --- Backend hooks ---
-from Swarky import Config, run_once, setup_logging, count_tif_files
+_t = time.perf_counter()
+from Swarky import Config, run_once, setup_logging, count_tif_files, list_dir_head, stuck_candidates, thumbnail_cache
+_SWARKY_IMPORT_MS = int((time.perf_counter() - _t) * 1000)
 
 # --- Tema ---
 LIGHT_BG = "#eef3f9"
@@ -34,6 +31,7 @@ NAVY_BG  = "#000080"
 NAVY_SEL = "#133869"
 FG_LIGHT = "#ffffff"
 FG_DARK  = "#1f2937"
+FG_STUCK = "#fca5a5"
 
 
 def _open_path(path: Path) -> None:
@@ -73,6 +71,15 @@ class SwarkyApp:
         except Exception as e:
             logging.debug("iconbitmap fallita: %s", e)
 
+        self._startup_marks: list[tuple[str, int]] = [("import Swarky", _SWARKY_IMPORT_MS)]
+        self._startup_reported = False
+        self._counters_busy = False
+        self._counters_pending = False
+        self._plotter_busy = False
+        self._plotter_pending = False
+        self._plotter_hidden = 0  # file oltre PLOTTER_LIST_MAX, contati ma non elencati
+        self._stuck: list = []
+
         self._run_error_notified = False
         self._run_in_progress = False
         self._run_lock = threading.Lock()
@@ -85,27 +92,60 @@ class SwarkyApp:
 
         # Config boot
         self._ensure_default_config()
-        self.cfg = self._build_cfg_from_json(self._load_config_json(silent=True))
-        setup_logging(self.cfg)
+        boot_data = self._load_config_json(silent=True)
+        self.cfg = self._build_cfg_from_json(boot_data)
+        # Servizio headless (Swarky.py --serve): se configurato la GUI fa solo da client
+        self.daemon_url: str = str(boot_data.get("DAEMON_URL") or "").rstrip("/")
+        self.plotter_max = max(1, int(boot_data.get("PLOTTER_LIST_MAX", 2000)))
+        self._daemon_seq = 0
+        self._daemon_started = None
 
         # Tema + UI
         self._setup_theme()
         self._build_layout()
 
         # Watchers
-        self.plotter_observer: Optional[Observer] = None
+        self.plotter_observer = None
         self.watch_thread: Optional[threading.Thread] = None
         self.watch_stop_event: Optional[threading.Event] = None
 
-        # Bootstrap
-        self.refresh_plotter()
-        self._schedule_if_ready()
+        # Bootstrap a stadi: la finestra risponde subito, lo stato delle share arriva in background
         self.update_clock()
-        self.periodic_plotter_refresh()
-        self.start_plotter_watcher()
+        self._startup_mark("finestra")
+        self.root.after(0, self._deferred_boot)
+        if self.daemon_url:
+            self.btn_start.config(state="disabled")
+            threading.Thread(target=self._daemon_poll_worker, daemon=True).start()
 
         self.root.protocol("WM_DELETE_WINDOW", self._on_close)
         
+    # ---------------- Avvio a stadi ----------------
+    def _startup_mark(self, label: str) -> None:
+        self._startup_marks.append((label, int((time.perf_counter() - _T_START) * 1000)))
+
+    def _deferred_boot(self) -> None:
+        """Secondo stadio: logging su file, scheduler, plotter e watcher senza bloccare la finestra."""
+        def _bg():
+            try:
+                setup_logging(self.cfg)
+            except Exception as e:
+                logging.debug("setup_logging fallito: %s", e)
+            self.start_plotter_watcher()
+            self.root.after(0, lambda: self._startup_mark("logging+watcher"))
+        threading.Thread(target=_bg, daemon=True).start()
+        self._schedule_if_ready()
+        self.periodic_plotter_refresh()
+
+    def _startup_report(self) -> None:
+        if self._startup_reported:
+            return
+        self._startup_reported = True
+        self._startup_mark("plotter")
+        report = ", ".join(f"{label} {ms} ms" for label, ms in self._startup_marks)
+        logging.info("Startup: %s", report)
+        if os.environ.get("SWARKY_STARTUP_REPORT"):
+            print(f"Startup: {report}", file=sys.stderr)
+
     # ---------------- Tabellari ----------------
     def open_tabellari(self) -> None:
         """
@@ -114,6 +154,7 @@ class SwarkyApp:
         3) Genera un TXT in DIR_TABELLARI con una singola riga:
            DXX12345601,DXX12345602, ...
         """
+        import tkinter.simpledialog as simpledialog
         try:
             # --- Input 1: prefisso ---
             prefix = simpledialog.askstring(
@@ -187,7 +228,8 @@ class SwarkyApp:
             "AUTO_TIME": "",
             "LOG_LEVEL": "INFO",
             "ACCEPT_PDF": True,
-            "LOG_PHASES": True
+            "LOG_PHASES": True,
+            "PARI_REV_DISCARD_IDENTICAL": False
         }
         try:
             self.json_path.write_text(json.dumps(default, indent=2), encoding="utf-8")
@@ -222,9 +264,30 @@ class SwarkyApp:
             DIR_PLM_ERROR     = _p(paths.get("error_plm")),
             DIR_TABELLARI     = _p(paths.get("tab")),
             LOG_DIR           = _p(paths.get("log_dir")),
+            CLOCK_PROBE_DIR   = _p(paths.get("clock_probe")),
             LOG_LEVEL         = logging.INFO if data.get("LOG_LEVEL","INFO")=="INFO" else logging.DEBUG,
             ACCEPT_PDF        = bool(data.get("ACCEPT_PDF", True)),
             LOG_PHASES        = bool(data.get("LOG_PHASES", True)),
+            PARI_REV_DISCARD_IDENTICAL = bool(data.get("PARI_REV_DISCARD_IDENTICAL", False)),
+            NODE_ID           = os.environ.get("SWARKY_NODE_ID") or data.get("NODE_ID") or None,
+            LEASE_SEC         = int(data.get("LEASE_SEC", 300)),
+            CLAIM_BATCH       = int(data.get("CLAIM_BATCH", 50)),
+            JOURNAL           = bool(data.get("JOURNAL", True)),
+            DIR_CACHE         = bool(data.get("DIR_CACHE", True)),
+            SHARD_DIGITS      = int(data.get("SHARD_DIGITS", 0)),
+            FS_TIMEOUT_SEC    = float(data.get("FS_TIMEOUT_SEC", 60.0)),
+            FS_COPY_TIMEOUT_SEC = float(data.get("FS_COPY_TIMEOUT_SEC", 300.0)),
+            BREAKER_FAILS     = int(data.get("BREAKER_FAILS", 3)),
+            BREAKER_COOLDOWN_SEC = int(data.get("BREAKER_COOLDOWN_SEC", 300)),
+            STREAM_CHUNK      = int(data.get("STREAM_CHUNK", 0)),
+            STREAM_QUEUE      = int(data.get("STREAM_QUEUE", 4)),
+            DOCNO_FILTER      = bool(data.get("DOCNO_FILTER", True)),
+            FS_STATS          = bool(data.get("FS_STATS", False)),
+            STORICO_PACK      = bool(data.get("STORICO_PACK", False)),
+            THUMB_CACHE_MB    = int(data.get("THUMB_CACHE_MB", 200)),
+            EVENT_LOG         = bool(data.get("EVENT_LOG", False)),
+            TRACE             = bool(data.get("TRACE", False)),
+            DEEP_TIFF_CHECK   = bool(data.get("DEEP_TIFF_CHECK", False)),
         )
 
     def _reload_cfg(self) -> None:
@@ -264,10 +327,14 @@ class SwarkyApp:
         self.lbl_check_var      = tk.StringVar(value="N° Check Dwgs: 0")
         self.lbl_same_var       = tk.StringVar(value="N° Same Rev.: 0")
         self.lbl_drawings_var   = tk.StringVar(value="N° Drawings: 0")
+        self.lbl_stuck_var      = tk.StringVar(value="N° Bloccati: 0")
         self.plotter_lbl        = tk.StringVar(value="plotter")
         self.plotter_frame   = ttk.LabelFrame(self.root, text="Plotter")
         self.anomaly_frame   = ttk.LabelFrame(self.root, text="Anomalie")
         self.processed_frame = ttk.LabelFrame(self.root, text="File processati")
+        lbl_stuck = ttk.Label(self.plotter_frame, textvariable=self.lbl_stuck_var, anchor="w", cursor="hand2")
+        lbl_stuck.pack(side="bottom", fill="x")
+        lbl_stuck.bind("<Button-1>", lambda _e: self._show_stuck())
         ttk.Label(self.plotter_frame, textvariable=self.lbl_plm_errors_var, anchor="w").pack(side="bottom", fill="x")
         ttk.Label(self.plotter_frame, textvariable=self.lbl_check_var,      anchor="w").pack(side="bottom", fill="x")
         ttk.Label(self.plotter_frame, textvariable=self.lbl_same_var,       anchor="w").pack(side="bottom", fill="x")
@@ -303,6 +370,7 @@ class SwarkyApp:
             self.anomaly_tree.heading(col, text=head, anchor="w")
             self.anomaly_tree.column(col, width=w, anchor="w", stretch=True)
         self.anomaly_tree.pack(fill="both", expand=True)
+        self.anomaly_tree.bind("<Double-Button-1>", self._preview_anomaly)
 
         # Processati
         self.processed_tree = ttk.Treeview(
@@ -371,36 +439,104 @@ class SwarkyApp:
         
     # ---------------- Gestione contatori ----------------        
     def update_counters(self) -> None:
+        """I conteggi sulle share girano in un thread; richieste ravvicinate si coalescono."""
+        shown = 0
         try:
-            stats = count_tif_files(self.cfg)
-        except Exception:
-            stats = {}
-        drawings = 0
-        try:
-            drawings = self.plotter_list.size()
+            shown = self.plotter_list.size()
         except Exception:
             pass
-        self.lbl_drawings_var.set(f"N° Drawings: {drawings}")
+        hidden = self._plotter_hidden
+        self.lbl_drawings_var.set(f"N° Drawings: {shown + hidden}" + (f" (elencati {shown})" if hidden else ""))
+        if self._counters_busy:
+            self._counters_pending = True
+            return
+        self._counters_busy = True
+        def _bg():
+            try:
+                stats = count_tif_files(self.cfg)
+                if not self.daemon_url:
+                    stats["stuck"] = stuck_candidates(self.cfg)
+            except Exception:
+                stats = {}
+            self.root.after(0, lambda: self._apply_counters(stats))
+        threading.Thread(target=_bg, daemon=True).start()
+
+    def _apply_counters(self, stats: dict) -> None:
+        self._counters_busy = False
         self.lbl_same_var.set(f"N° Same Rev.: {stats.get('Same Rev Dwg', 0)}")
         self.lbl_check_var.set(f"N° Check Dwgs: {stats.get('Check Dwg', 0)}")
         self.lbl_plm_errors_var.set(f"N° PLM errors: {stats.get('Plm error Dwg', 0)}")
-        
+        if "stuck" in stats:
+            self.set_stuck(stats["stuck"])
+        if self._counters_pending:
+            self._counters_pending = False
+            self.update_counters()
+
+    # ---------------- File bloccati (backoff dopo errori ripetuti) ----------------
+    def set_stuck(self, entries: list) -> None:
+        entries = list(entries or [])
+        if entries == self._stuck:
+            return
+        prev = {e.get("file", "").lower() for e in self._stuck}
+        self._stuck = entries
+        self.lbl_stuck_var.set(f"N° Bloccati: {len(entries)}")
+        self._mark_stuck(prev)
+
+    def _mark_stuck(self, prev: frozenset = frozenset()) -> None:
+        """Evidenzia nella lista Plotter i file bloccati; prev = bloccati precedenti da ripristinare."""
+        stuck = {e.get("file", "").lower() for e in self._stuck}
+        if not stuck and not prev:
+            return
+        for idx, name in enumerate(self.plotter_list.get(0, tk.END)):
+            low = name.lower()
+            if low in stuck:
+                self.plotter_list.itemconfig(idx, fg=FG_STUCK)
+            elif low in prev:
+                self.plotter_list.itemconfig(idx, fg="white")
+
+    def _show_stuck(self) -> None:
+        if not self._stuck:
+            messagebox.showinfo("Swarky", "Nessun file bloccato.")
+            return
+        lines = []
+        for e in self._stuck[:40]:
+            when = datetime.fromtimestamp(e.get("retry_at", 0)).strftime("%H:%M")
+            lines.append(f"{e.get('file')} • {e.get('attempts')} tentativi • riprova {when}\n    {e.get('reason')}")
+        if len(self._stuck) > 40:
+            lines.append(f"... e altri {len(self._stuck) - 40}")
+        messagebox.showinfo("Swarky - File bloccati", "\n".join(lines))
+
     # ---------------- Plotter ----------------
     def refresh_plotter(self) -> None:
-        """Full scan della cartella Plotter (usare con parsimonia)."""
+        """Full scan della cartella Plotter (usare con parsimonia): scansione in un thread.
+        Si elencano solo i primi PLOTTER_LIST_MAX nomi, il resto è solo contato."""
+        if self._plotter_busy:
+            self._plotter_pending = True
+            return
+        self._plotter_busy = True
+        exts = (".tif", ".pdf") if getattr(self.cfg, "ACCEPT_PDF", True) else (".tif",)
+        base = self.cfg.DIR_HPLOTTER
+        limit = self.plotter_max
+        def _bg():
+            try:
+                names, total = list_dir_head(base, exts, limit)
+            except Exception:
+                names, total = [], 0
+            self.root.after(0, lambda: self._apply_plotter_names(names, total))
+        threading.Thread(target=_bg, daemon=True).start()
+
+    def _apply_plotter_names(self, names: list, total: int) -> None:
+        self._plotter_busy = False
+        self._plotter_hidden = max(0, total - len(names))
         self.plotter_list.delete(0, tk.END)
-        if getattr(self.cfg, "ACCEPT_PDF", True):
-            patterns = ("*.tif","*.TIF","*.pdf","*.PDF")
-        else:
-            patterns = ("*.tif","*.TIF")
-        try:
-            base = self.cfg.DIR_HPLOTTER
-            files = {p.name.lower(): p.name for pat in patterns for p in base.glob(pat) if p.is_file()}
-        except Exception:
-            files = {}
-        for name in sorted(files.values(), key=str.lower):
+        for name in names:
             self.plotter_list.insert(tk.END, name)
+        self._mark_stuck()
         self.update_counters()
+        self._startup_report()
+        if self._plotter_pending:
+            self._plotter_pending = False
+            self.refresh_plotter()
 
     def request_plotter_refresh(self, delay_ms: int = 300) -> None:
         """Debounce: pianifica un refresh_plotter unico entro delay_ms."""
@@ -463,6 +599,9 @@ class SwarkyApp:
 
     # ---------------- Run & scheduler ----------------
     def run_once_thread(self) -> None:
+        if self.daemon_url:
+            threading.Thread(target=self._daemon_request_run, daemon=True).start()
+            return
         if self._run_in_progress:
             return
         self._run_in_progress = True
@@ -544,9 +683,67 @@ class SwarkyApp:
         self.run_once_thread()
         self._schedule_if_ready()
 
+    # ---------------- Client servizio headless ----------------
+    def _daemon_get(self, path: str):
+        from urllib.request import urlopen
+        with urlopen(self.daemon_url + path, timeout=5) as r:
+            return r.read().decode("utf-8")
+
+    def _daemon_request_run(self) -> None:
+        from urllib.request import Request, urlopen
+        try:
+            urlopen(Request(self.daemon_url + "/run", data=b"", method="POST"), timeout=5).close()
+            self.root.after(0, lambda: self.phase_var.set("Batch richiesto al servizio."))
+        except Exception as e:
+            err = str(e)
+            self.root.after(0, lambda: messagebox.showwarning(
+                "Swarky", f"Servizio non raggiungibile:\n{self.daemon_url}\n\nDettagli: {err}"))
+
+    def _daemon_poll_worker(self) -> None:
+        """Replica in tabella gli eventi del servizio e ne mostra la fase corrente."""
+        was_running = False
+        while True:
+            try:
+                st = json.loads(self._daemon_get("/status"))
+                # servizio riavviato: il suo contatore riparte da 0
+                if st.get("started") != self._daemon_started or int(st.get("last_seq", 0)) < self._daemon_seq:
+                    self._daemon_started = st.get("started")
+                    self._daemon_seq = 0
+                body = self._daemon_get(f"/events?since={self._daemon_seq}")
+                events = [json.loads(ln) for ln in body.splitlines() if ln.strip()]
+                if events:
+                    self._daemon_seq = events[-1]["seq"]
+                    self.root.after(0, lambda evs=events: self._apply_daemon_events(evs))
+                running = bool(st.get("running"))
+                if running:
+                    text = f"{st.get('phase') or 'In corso'} • coda {st.get('queue_depth', 0)}"
+                    self.root.after(0, lambda t=text: self.phase_var.set(t))
+                elif was_running:
+                    self.root.after(0, lambda: (self._phase_end("Pronto."), self.request_plotter_refresh()))
+                was_running = running
+                stuck = st.get("stuck") or []
+                self.root.after(0, lambda s=stuck: self.set_stuck(s))
+            except Exception as e:
+                logging.debug("Servizio non raggiungibile: %s", e)
+            time.sleep(1)
+
+    def _apply_daemon_events(self, events: list) -> None:
+        for ev in events:
+            ts = datetime.fromtimestamp(ev.get("ts", time.time()))
+            d, h = ts.strftime("%d.%b.%Y"), ts.strftime("%H:%M:%S")
+            if ev.get("kind") == "processed":
+                self.insert_processed(d, h, ev.get("file", ""), ev.get("process", ""),
+                                      ev.get("dest", ""), ev.get("compare", ""))
+            else:
+                self.insert_anomaly(d, h, ev.get("file", ""), ev.get("error", ""))
+            self.tree_handler._remove_from_plotter_listbox(ev.get("file", ""))
+
     # ---------------- Watchdog FS ----------------
     def start_plotter_watcher(self) -> None:
-        if Observer is None:
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except Exception:
             return
         app = self
         class Handler(FileSystemEventHandler):
@@ -652,6 +849,43 @@ class SwarkyApp:
     def open_settings(self) -> None:
         SettingsDialog(self)
         
+    def _anomaly_path(self, file_name: str) -> Path:
+        """Dove è finito un file scartato: ERROR_DIR o, per le pari revisioni, PARI_REV_DIR."""
+        for d in (self.cfg.ERROR_DIR, self.cfg.PARI_REV_DIR):
+            if (d / file_name).exists():
+                return d / file_name
+        return self.cfg.ERROR_DIR / file_name
+
+    def _preview_anomaly(self, _=None) -> None:
+        """Anteprima affiancata (file scartato | archivio) senza aprire il TIFF intero."""
+        sel = self.anomaly_tree.selection()
+        if not sel:
+            return
+        file_name = self.anomaly_tree.item(sel[0], "values")[2]
+        try:
+            from Gui_Parirev import ThumbPair
+        except Exception as e:
+            messagebox.showerror("Swarky", f"Anteprima non disponibile:\n{e}")
+            return
+        win = tk.Toplevel(self.root)
+        win.title(f"Swarky - {file_name}")
+        win.transient(self.root)
+        pair = ThumbPair(win, self.cfg, "Scartato")
+        pair.pack(fill="both", expand=True, padx=8, pady=8)
+        btn = ttk.Button(win, text="Apri originale", state="disabled")
+        btn.pack(pady=(0, 8))
+        def _apply(src: Path) -> None:
+            if win.winfo_exists():
+                btn.config(state="normal", command=lambda: _open_path(src))
+                pair.show(src)
+        def _bg():
+            src = self._anomaly_path(file_name)   # exists() su share: fuori dal thread Tk
+            try:
+                self.root.after(0, lambda: _apply(src))
+            except (tk.TclError, RuntimeError):
+                pass
+        threading.Thread(target=_bg, daemon=True).start()
+
     def open_parirev(self) -> None:
         try:
             if getattr(self, "_parirev_win", None) and self._parirev_win.winfo_exists():
@@ -783,8 +1017,15 @@ class SettingsDialog(tk.Toplevel):
             row=r+2, column=0, columnspan=2, sticky="w", pady=(0,8)
         )
 
+        # Checkbox PARI_REV_DISCARD_IDENTICAL
+        self.discard_identical_var = tk.BooleanVar(value=bool(self._discard_identical))
+        ttk.Checkbutton(frm, text="Scarta i Pari Revisione identici all'archivio",
+                        variable=self.discard_identical_var).grid(
+            row=r+3, column=0, columnspan=2, sticky="w", pady=(0,8)
+        )
+
         btns = ttk.Frame(frm)
-        btns.grid(row=r+3, column=0, columnspan=3, sticky="e", pady=(12,0))
+        btns.grid(row=r+4, column=0, columnspan=3, sticky="e", pady=(12,0))
         ttk.Button(btns, text="Annulla", command=self.destroy).pack(side="right", padx=6)
         ttk.Button(btns, text="Salva", command=self._save).pack(side="right")
 
@@ -796,11 +1037,13 @@ class SettingsDialog(tk.Toplevel):
             data = json.loads(self.app.json_path.read_text(encoding="utf-8"))
         except Exception:
             pass
+        self._data = data if isinstance(data, dict) else {}
         self._paths = data.get("paths", {})
         self._auto_time = data.get("AUTO_TIME", "")
         self._log_level = data.get("LOG_LEVEL", "INFO")
         self._accept_pdf = data.get("ACCEPT_PDF", True)
         self._log_phases = data.get("LOG_PHASES", True)
+        self._discard_identical = data.get("PARI_REV_DISCARD_IDENTICAL", False)
 
     def _browse_dir(self, key: str) -> None:
         start = self.vars[key].get().strip() or str(Path.cwd())
@@ -835,13 +1078,16 @@ class SettingsDialog(tk.Toplevel):
                 messagebox.showerror("Errore", "Orario non valido. Usa HH:MM (es. 08:30) o lascia vuoto.")
                 return
 
-        data_out = {
-            "paths": new_paths,
+        # conserva le chiavi non gestite dal dialog
+        data_out = dict(self._data)
+        data_out.update({
+            "paths": {**self._paths, **new_paths},
             "AUTO_TIME": auto_time,
             "LOG_LEVEL": self._log_level,
             "ACCEPT_PDF": bool(self.accept_pdf_var.get()),
-            "LOG_PHASES": bool(self.log_phases_var.get())
-        }
+            "LOG_PHASES": bool(self.log_phases_var.get()),
+            "PARI_REV_DISCARD_IDENTICAL": bool(self.discard_identical_var.get()),
+        })
         try:
             self.app.json_path.write_text(json.dumps(data_out, indent=2), encoding="utf-8")
         except Exception as e:
@@ -902,8 +1148,17 @@ class _TreeviewHandler(logging.Handler):
                                         ts.strftime("%H:%M:%S"),
                                         file_name, msg)
                 self._remove_from_plotter_listbox(file_name)
+                if msg == "Immagine Girata" or msg.startswith("Pari Revisione"):
+                    # l'operatore probabilmente la guarderà: anteprima pronta in anticipo
+                    dest = self.app.cfg.ERROR_DIR if msg == "Immagine Girata" else self.app.cfg.PARI_REV_DIR
+                    thumbnail_cache(self.app.cfg).submit(dest / file_name)
             self.app.root.after(0, _add)
 
+        elif kind == "stuck":
+            # ui = ("stuck", [{"file", "attempts", "retry_at", "reason"}, ...])
+            entries = ui[1] if len(ui) > 1 else []
+            self.app.root.after(0, lambda: self.app.set_stuck(entries))
+
         elif kind == "phase":
             # ui = ("phase", "Testo fase corrente")
             phase_text = ui[1] if len(ui) > 1 else ""
@@ -0,0 +1,75 @@
+"""Cache degli elenchi cartella: validità per mtime, finestra racy e sonda orologio."""
+import dataclasses
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from test_multinode import KEYS, _sandbox
+
+import Swarky
+
+
+class DirCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        self.cfg = Swarky.load_config(_sandbox(self.root))
+        Swarky._DIRCACHE.bind(self.cfg)
+        self.d = self.root / "archivio" / "A"
+        self.d.mkdir()
+        (self.d / "DAK100000R01S01M.tif").write_bytes(b"x")
+
+    def tearDown(self):
+        Swarky._DIRCACHE.path = None
+        self._tmp.cleanup()
+
+    def _age(self, sec: float) -> None:
+        t = time.time() - sec
+        os.utime(self.d, (t, t))
+
+    def _list(self):
+        calls = []
+        def scan():
+            calls.append(1)
+            return sorted(os.listdir(self.d))
+        return Swarky._DIRCACHE.cached(self.d, "t", scan), len(calls)
+
+    def test_unchanged_folder_is_served_from_cache(self):
+        self._age(3600)
+        self.assertEqual(self._list(), (["DAK100000R01S01M.tif"], 1))
+        self.assertEqual(self._list(), (["DAK100000R01S01M.tif"], 0))
+
+    def test_mtime_change_invalidates(self):
+        self._age(3600)
+        self._list()
+        (self.d / "DAK100001R01S01M.tif").write_bytes(b"y")
+        self._age(1800)
+        names, scans = self._list()
+        self.assertEqual(scans, 1)
+        self.assertIn("DAK100001R01S01M.tif", names)
+
+    def test_racy_mtime_is_not_trusted(self):
+        self._list()                   # mtime appena scritto: troppo vicino all'ora del server
+        self.assertEqual(self._list()[1], 1)
+
+    def test_probe_written_only_in_log_dir(self):
+        for k in KEYS:
+            Swarky.list_dir_cached(self.root / k, (".tif",))
+        Swarky.list_dir_cached(self.d, (".tif",))
+        probes = [p.parent.name for p in self.root.rglob(Swarky._ServerClock.PROBE)]
+        self.assertEqual(probes, ["logs"])
+        for k in KEYS:
+            self.assertFalse(list((self.root / k).rglob(Swarky._ServerClock.PROBE)), k)
+
+    def test_host_without_probe_uses_conservative_window(self):
+        clock = Swarky._ServerClock()
+        clock.bind(dataclasses.replace(self.cfg, LOG_DIR=None))
+        self.assertEqual(clock.probes, {})
+        self.assertLessEqual(clock.now_ns(self.d), time.time_ns() - clock.SKEW_NS)
+        self.assertFalse(list(self.root.rglob(clock.PROBE)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Filtro docno: una cartella registrata nella finestra racy non dà mai un falso "assente"."""
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from test_multinode import _sandbox
+
+import Swarky
+
+
+class DocnoFilterTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        cfg = Swarky.load_config(_sandbox(self.root))
+        Swarky._CLOCK.bind(cfg)
+        self.d = self.root / "archivio" / "A"
+        self.d.mkdir()
+        (self.d / "DAK100000R01S01M.tif").write_bytes(b"x")
+        self.f = Swarky._DocnoFilter()
+        self.f.reset(1000)
+        self.f.add("DAK100000")
+        self.f.enabled = True
+
+    def tearDown(self):
+        Swarky._CLOCK.__dict__.pop("now_ns", None)
+        self._tmp.cleanup()
+
+    def _later(self, sec: float) -> None:
+        Swarky._CLOCK.now_ns = lambda dirp: time.time_ns() + int(sec * 1e9)
+
+    def _sneak_in(self, nm: str) -> None:
+        """File altrui nella stessa granularità: l'mtime della cartella non cambia."""
+        m = os.stat(self.d).st_mtime_ns
+        (self.d / nm).write_bytes(b"y")
+        os.utime(self.d, ns=(m, m))
+
+    def test_racy_record_is_not_trusted_then_verified(self):
+        self.f.record(self.d)
+        self._sneak_in("DAK200000R01S01M.tif")
+        self.assertFalse(self.f.absent("DAK200000", self.d))    # dentro la finestra
+        self._later(10)
+        self.assertFalse(self.f.absent("DAK200000", self.d))    # rilettura: ora nel filtro
+        self.assertTrue(self.f.absent("DAK300000", self.d))     # cartella di nuovo affidabile
+        self.assertGreater(self.f.dirs[str(self.d).lower()][1] - os.stat(self.d).st_mtime_ns,
+                           Swarky._DirListCache.RACY_NS)
+
+    def test_old_snapshot_is_trusted_and_mtime_change_drops_it(self):
+        t = time.time() - 3600
+        os.utime(self.d, (t, t))
+        self.f.record(self.d)
+        self.assertTrue(self.f.absent("DAK300000", self.d))
+        (self.d / "DAK300000R01S01M.tif").write_bytes(b"z")
+        self.assertFalse(self.f.absent("DAK300000", self.d))
+        self.assertNotIn(str(self.d).lower(), self.f.dirs)
+
+
+if __name__ == "__main__":
+    unittest.main()
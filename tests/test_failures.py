@@ -0,0 +1,78 @@
+"""Cache dei candidati che falliscono: backoff, invalidazione al cambio del file, persistenza."""
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from test_multinode import _sandbox, _tiff
+
+import Swarky
+
+NAME = "DAK100000R01S01M.tif"
+
+
+class FailureCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        self.cfg = Swarky.load_config(_sandbox(self.root))
+        self.src = self.cfg.DIR_HPLOTTER / NAME
+        self.src.write_bytes(_tiff())
+        self.calls = []
+        self._orig = Swarky._process_candidate, Swarky.move_to
+        def counted(p, *a, **k):
+            self.calls.append(p.name)
+            return self._orig[0](p, *a, **k)
+        Swarky._process_candidate = counted
+
+    def tearDown(self):
+        Swarky._process_candidate, Swarky.move_to = self._orig
+        self._tmp.cleanup()
+
+    def _fail_moves(self):
+        def boom(*a, **k):
+            raise RuntimeError("share rotta")
+        Swarky.move_to = boom
+
+    def test_failing_file_is_parked_with_backoff(self):
+        self._fail_moves()
+        self.assertFalse(Swarky.run_once(self.cfg))
+        (ent,) = Swarky.stuck_candidates(self.cfg)
+        self.assertEqual((ent["file"], ent["attempts"]), (NAME, 1))
+        self.assertIn("share rotta", ent["reason"])
+        self.assertAlmostEqual(ent["retry_at"] - time.time(), Swarky._FailureCache.BASE_SEC, delta=5)
+        Swarky.run_once(self.cfg)
+        self.assertEqual(self.calls, [NAME])             # secondo giro: saltato, niente lavoro
+        self.assertTrue(self.src.exists())
+
+    def test_changed_file_is_retried_at_once(self):
+        self._fail_moves()
+        Swarky.run_once(self.cfg)
+        Swarky.move_to = self._orig[1]
+        self.src.write_bytes(_tiff(400))                  # nuova copia dal plotter: dimensione diversa
+        self.assertTrue(Swarky.run_once(self.cfg))
+        self.assertEqual(self.calls, [NAME, NAME])
+        self.assertFalse(self.src.exists())
+        self.assertEqual(Swarky.stuck_candidates(self.cfg), [])
+
+    def test_backoff_doubles_and_survives_restart(self):
+        self._fail_moves()
+        Swarky.run_once(self.cfg)
+        Swarky._FAILURES.data[NAME.lower()][3] = 0       # scaduto: si riprova
+        Swarky.run_once(self.cfg)
+        fresh = Swarky._FailureCache()
+        fresh.bind(self.cfg)                              # come dopo un riavvio
+        (ent,) = fresh.stuck()
+        self.assertEqual(ent["attempts"], 2)
+        self.assertAlmostEqual(ent["retry_at"] - time.time(), 2 * Swarky._FailureCache.BASE_SEC, delta=5)
+
+    def test_entry_dropped_when_file_leaves_hplotter(self):
+        self._fail_moves()
+        Swarky.run_once(self.cfg)
+        self.src.unlink()
+        Swarky.run_once(self.cfg)
+        self.assertEqual(Swarky.stuck_candidates(self.cfg), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Journal: ripresa dei passi dopo un crash, anche per le revisioni superate nello stesso batch."""
+import tempfile
+import unittest
+from pathlib import Path
+
+from test_multinode import _sandbox, _spawn, _tiff
+
+import Swarky
+
+CRASH_BEFORE_FLUSH = """
+    import logging, os, sys
+    from pathlib import Path
+    import Swarky
+    logging.disable(logging.CRITICAL)
+    cfg = Swarky.load_config(Path(sys.argv[1]))
+    Swarky._flush_file_log = lambda cfg: os._exit(3)   # righe di log perse con il buffer
+    Swarky.run_once(cfg)
+"""
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+
+    def tearDown(self):
+        Swarky._JOURNAL = None
+        self._tmp.cleanup()
+
+    def _cfg(self, **extra):
+        self.cfg_path = _sandbox(self.root, **extra)
+        return Swarky.load_config(self.cfg_path)
+
+    def _archive(self, cfg, nm: str) -> Path:
+        d = Swarky.map_location(Swarky.BASE_NAME.fullmatch(nm), cfg)["dir_tif_loc"]
+        d.mkdir(parents=True, exist_ok=True)
+        (d / nm).write_bytes(_tiff())
+        return d / nm
+
+    def _log(self) -> str:
+        return "".join(p.read_text(encoding="utf-8") for p in (self.root / "logs").glob("Swarky*.log"))
+
+    def _restart(self, cfg) -> None:
+        Swarky._JOURNAL = None          # come un processo nuovo: piani riletti dal file
+        Swarky.run_once(cfg)
+
+    def test_superseded_plan_replays_into_storico_pack(self):
+        cfg = self._cfg(STORICO_PACK=True)
+        old = self._archive(cfg, "DAK100000R01S01M.tif")
+        src = cfg.DIR_HPLOTTER / "DAK100000R02S01M.tif"
+        src.write_bytes(_tiff())
+        dest = Swarky._storico_dest_dir_for_name(cfg, src.name)
+        Swarky._JOURNAL = None
+        jr = Swarky._journal(cfg)
+        jid = jr.plan(src.name, src, dest, [old.name], tail=("log",), superseded="DAK100000R03S01M.tif")
+        self.assertEqual(Swarky.move_to_storico_safe(src, dest, cfg), (True, 1))
+        jr.done(jid, "archive")
+        jr._f.close()                   # crash: lo storico di R01 non è stato fatto
+
+        self._restart(cfg)
+        self.assertFalse(old.exists())
+        self.assertEqual(Swarky._storico_names(dest, old.name, fresh=True) & {old.name.lower(), src.name.lower()},
+                         {old.name.lower(), src.name.lower()})
+        self.assertEqual(self._log().count("Rev superata"), 2)     # R01 da R02, R02 da R03
+        self.assertFalse(Swarky._journal(cfg).open_plans)
+
+    def test_coalesced_batch_round_trip_after_crash(self):
+        cfg = self._cfg()
+        r02 = self._archive(cfg, "DAK100000R02S01M.tif")
+        for nm in ("DAK100000R03S01M.tif", "DAK100000R04S01M.tif"):
+            (cfg.DIR_HPLOTTER / nm).write_bytes(_tiff())
+        p = _spawn(CRASH_BEFORE_FLUSH, str(self.cfg_path))
+        p.communicate(timeout=60)
+        self.assertEqual(p.returncode, 3)
+        self.assertEqual(self._log(), "")
+        self.assertTrue(Swarky._journal(cfg).path.exists())
+
+        self._restart(cfg)
+        log = self._log()
+        self.assertEqual(log.count("\t# Archiviato"), 1)
+        self.assertEqual(log.count("Rev superata"), 2)           # R02 e R03, righe ripetute dal journal
+        self.assertTrue((r02.parent / "DAK100000R04S01M.tif").exists())
+        self.assertFalse(r02.exists())
+        storico = Swarky._storico_dest_dir_for_name(cfg, r02.name)
+        self.assertEqual(sorted(p.name for p in storico.iterdir()),
+                         ["DAK100000R02S01M.tif", "DAK100000R03S01M.tif"])
+        self.assertEqual([p.name for p in cfg.PLM_DIR.glob("*.tif")], ["DAK100000R04S01M.tif"])
+        self.assertFalse(list(cfg.DIR_HPLOTTER.glob("*.tif")))
+        self.assertFalse(Swarky._journal(cfg).path.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
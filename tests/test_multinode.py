@@ -0,0 +1,163 @@
+"""Multi-nodo con processi veri su una cartella locale: claim, lease docno e failover."""
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import Swarky  # noqa: E402
+
+KEYS = ("hplotter", "archivio", "error_dir", "pari_rev", "plm", "storico",
+        "iss", "fiv", "heng", "error_plm", "tab")
+
+
+def _tiff(w: int = 300, h: int = 100) -> bytes:
+    ents = [(256, 3, 1, w), (257, 3, 1, h)]
+    body = b"II" + struct.pack("<HI", 42, 8) + struct.pack("<H", len(ents))
+    body += b"".join(struct.pack("<HHII", *e) for e in ents)
+    return body + struct.pack("<I", 0)
+
+
+def _sandbox(root: Path, **extra) -> Path:
+    paths = {k: str(root / k) for k in KEYS}
+    for p in paths.values():
+        os.makedirs(p, exist_ok=True)
+    paths["log_dir"] = str(root / "logs")
+    cfg = {"paths": paths, "ACCEPT_PDF": False, "LEASE_SEC": 3, "CLAIM_BATCH": 5}
+    cfg.update(extra)
+    path = root / "config.json"
+    path.write_text(json.dumps(cfg), encoding="utf-8")
+    return path
+
+
+def _spawn(code: str, *args: str) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    env.pop("SWARKY_NODE_ID", None)
+    return subprocess.Popen([sys.executable, "-c", textwrap.dedent(code), *args], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+NODE = """
+    import dataclasses, logging, sys
+    from pathlib import Path
+    import Swarky
+    logging.disable(logging.CRITICAL)
+    cfg = dataclasses.replace(Swarky.load_config(Path(sys.argv[1])), NODE_ID=sys.argv[2])
+    hp = cfg.DIR_HPLOTTER
+    stage = Swarky._node_stage_dir(cfg)
+    idle = 0
+    while idle < 3:
+        Swarky.run_once(cfg)
+        busy = any(p.suffix == ".tif" for p in hp.iterdir()) or \\
+            (stage.exists() and any(p.suffix == ".tif" for p in stage.iterdir()))
+        idle = 0 if busy else idle + 1
+"""
+
+LEASE = """
+    import dataclasses, logging, os, sys, time, random
+    from pathlib import Path
+    import Swarky
+    logging.disable(logging.CRITICAL)
+    cfg = dataclasses.replace(Swarky.load_config(Path(sys.argv[1])), NODE_ID=sys.argv[2])
+    marker = Path(sys.argv[3])
+    if sys.argv[4] == "crash":
+        Swarky._lease_acquire(cfg, "DOC", wait_sec=30)
+        os._exit(0)          # muore con il lease in mano: gli altri devono subentrare dopo la scadenza
+    for _ in range(int(sys.argv[4])):
+        lp = Swarky._lease_acquire(cfg, "DOC", wait_sec=60)
+        assert lp is not None
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)   # fallisce se un altro è dentro
+        os.close(fd)
+        time.sleep(random.random() * 0.02)
+        assert Swarky._lease_held(lp)
+        os.unlink(marker)
+        Swarky._lease_release(cfg, lp)
+"""
+
+
+class MultiNodeTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _wait(self, procs, timeout=180):
+        t0 = time.monotonic()
+        for p in procs:
+            out, err = p.communicate(timeout=max(1, timeout - (time.monotonic() - t0)))
+            self.assertEqual(p.returncode, 0, err)
+
+    def test_nodes_split_backlog_without_duplicates(self):
+        cfg_path = _sandbox(self.root)
+        rnd = random.Random(7)
+        names = set()
+        while len(names) < 120:
+            names.add(f"DAK{rnd.randint(100000, 100029):06d}R{rnd.randint(0, 9):02d}"
+                      f"S0{rnd.randint(1, 2)}{rnd.choice('MI')}.tif")
+        for nm in names:
+            (self.root / "hplotter" / nm).write_bytes(_tiff())
+        self._wait([_spawn(NODE, str(cfg_path), f"n{i}") for i in range(4)])
+
+        self.assertFalse([p for p in (self.root / "hplotter").rglob("*.tif")])
+        final = [p.name for k in ("archivio", "storico", "error_dir", "pari_rev")
+                 for p in (self.root / k).rglob("*.tif")]
+        self.assertEqual(sorted(final), sorted(names))     # ogni file una volta sola
+        logs = "".join(p.read_text(encoding="utf-8") for p in (self.root / "logs").glob("Swarky*.log"))
+        archived = [ln.split(" # ")[2].split("\t")[0] for ln in logs.splitlines() if "\t# Archiviato" in ln]
+        self.assertEqual(len(archived), len(set(archived)))
+
+    def test_lease_is_exclusive_and_survives_a_crashed_holder(self):
+        cfg_path = _sandbox(self.root)
+        marker = self.root / "inside"
+        self._wait([_spawn(LEASE, str(cfg_path), "dead", str(marker), "crash")])
+        t0 = time.monotonic()
+        self._wait([_spawn(LEASE, str(cfg_path), f"n{i}", str(marker), "25") for i in range(5)])
+        self.assertGreaterEqual(time.monotonic() - t0, 2.0)  # prima la scadenza del lease del nodo morto
+        gens = Swarky._lease_gens(self.root / "hplotter" / Swarky._LEASES_DIRNAME / "DOC")
+        self.assertEqual(gens, [126])
+
+    def test_vanishing_lease_respects_wait_and_backs_off(self):
+        cfg = Swarky.load_config(_sandbox(self.root))
+        d = self.root / "hplotter" / Swarky._LEASES_DIRNAME / "DOC"
+        d.mkdir(parents=True)
+        (d / "1.lease").write_text("{}")
+        reads = []
+        orig = Swarky._lease_read
+        Swarky._lease_read = lambda lp: reads.append(lp) and None   # sparito a ogni lettura
+        try:
+            t0 = time.monotonic()
+            self.assertIsNone(Swarky._lease_acquire(cfg, "DOC", wait_sec=0.5))
+        finally:
+            Swarky._lease_read = orig
+        self.assertLess(time.monotonic() - t0, 2.0)
+        self.assertLess(len(reads), 20)                     # pausa tra un tentativo e l'altro
+
+    def test_dead_node_recovery_does_not_overwrite_new_arrival(self):
+        cfg = Swarky.load_config(_sandbox(self.root))
+        cfg = Swarky.Config(**{**cfg.__dict__, "NODE_ID": "me"})
+        stage = Swarky._node_stage_dir(cfg, "dead")
+        stage.mkdir(parents=True)
+        (stage / ".alive").write_text("0")
+        os.utime(stage / ".alive", (0, 0))
+        (stage / "DAK100000R01S01M.tif").write_bytes(b"old")
+        (stage / "DAK100001R01S01M.tif").write_bytes(b"orphan")
+        (cfg.DIR_HPLOTTER / "DAK100000R01S01M.tif").write_bytes(b"new")
+        Swarky._recover_dead_nodes(cfg)
+        self.assertEqual((cfg.DIR_HPLOTTER / "DAK100000R01S01M.tif").read_bytes(), b"new")
+        self.assertTrue((stage / "DAK100000R01S01M.tif").exists())
+        self.assertEqual((cfg.DIR_HPLOTTER / "DAK100001R01S01M.tif").read_bytes(), b"orphan")
+
+
+if __name__ == "__main__":
+    unittest.main()
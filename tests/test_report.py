@@ -0,0 +1,72 @@
+"""Report dai log mensili: batch contro passaggi a vuoto, esiti, durate, CSV."""
+import tempfile
+import unittest
+from datetime import date
+from pathlib import Path
+
+from test_multinode import _sandbox, _tiff
+
+import Swarky
+
+LOG = "".join(ln + "\n" for ln in (
+    "19.Oct.2026 # 08:10:00 # DAK100000R01S01M.tif\t# Bozzetti\t# Archiviato\t# ",
+    "19.Oct.2026 # 08:10:01 # DAK100000R00S01M.tif\t# Bozzetti\t# Rev superata\t# Storico",
+    "ProcessTime # 01:30",
+    "ProcessTime # 00:00",
+    "19.Oct.2026 # 09:20:00 # DAK100001R01S01X.tif\t# ERRORE\t# Metrica Errata\t# ",
+    "ProcessTime # 00:45",
+    "2026-10-20 07:00:00 INFO Batch: 0 candidati",
+    "ProcessTime # 00:00",
+    "20.Oct.2026 # 10:00:00 # G1234ABCD123456ISSR01S01.pdf\t# ISS\t# ISS\t# ",
+    "ProcessTime # 00:05",
+))
+
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        self.cfg = Swarky.load_config(_sandbox(self.root))
+        self.logs = self.root / "logs"
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_batches_and_idle_passes_from_handwritten_log(self):
+        self.logs.mkdir()
+        (self.logs / "Swarky_Oct.2026.log").write_text(LOG, encoding="utf-8")
+        (self.logs / "Swarky_Sep.2026.log").write_text(LOG.replace("Oct", "Sep"), encoding="utf-8")
+        days = Swarky.collect_report(self.logs, "2026-10", "2026-10")
+        self.assertEqual(sorted(days), ["2026-10-19", "2026-10-20"])
+        d19, d20 = days["2026-10-19"], days["2026-10-20"]
+        self.assertEqual((d19.batches, d19.idle, d19.batch_sec, d19.batch_max), (2, 1, 135, 90))
+        self.assertEqual((d20.batches, d20.idle, d20.batch_sec), (1, 1, 5))   # giorno dalla riga del logging
+        self.assertEqual(d19.arrivals, 2)                    # Rev superata: stesso arrivo, solo nel mix
+        self.assertEqual(d19.outcomes, {"Archiviato": 1, "Rev superata": 1, "ERRORE: Metrica Errata": 1})
+        self.assertEqual((d19.hours[8], d19.hours[9]), (1, 1))
+        self.assertEqual(d20.locations, {"ISS": 1})
+
+        out = self.root / "r.csv"
+        self.assertEqual(Swarky.write_report(self.cfg, out, "csv", "2026-10", "2026-10"), 2)
+        rows = out.read_text(encoding="utf-8").splitlines()
+        self.assertEqual(rows[0], "livello;periodo;misura;chiave;valore")
+        for row in ("giorno;2026-10-19;batch;n;2", "giorno;2026-10-19;batch;a_vuoto;1",
+                    "giorno;2026-10-19;batch;sec_medio;67.5", "mese;2026-10;batch;n;3",
+                    "mese;2026-10;batch;a_vuoto;2", "mese;2026-10;arrivi;;3"):
+            self.assertIn(row, rows)
+
+    def test_real_batch_then_idle_watch_passes(self):
+        for nm in ("DAK100000R01S01M.tif", "DAK100001R01S01X.tif"):
+            (self.cfg.DIR_HPLOTTER / nm).write_bytes(_tiff())
+        for _ in range(3):
+            Swarky.run_once(self.cfg)
+        st = Swarky.collect_report(self.logs)[date.today().isoformat()]
+        self.assertEqual((st.batches, st.idle, st.arrivals), (1, 2, 2))
+        self.assertEqual(st.outcomes, {"Archiviato": 1, "ERRORE: Metrica Errata": 1})
+        html = self.root / "r.html"
+        Swarky.write_report(self.cfg, html, "html")
+        self.assertIn("<th>Passaggi a vuoto</th>", html.read_text(encoding="utf-8"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Nodo singolo: il batch non prende lease, legge solo _ARCHIVIO della manutenzione."""
+import json
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from test_multinode import _sandbox, _spawn, _tiff
+
+import Swarky
+
+CRASH = """
+    import logging, os, sys
+    from pathlib import Path
+    import Swarky
+    logging.disable(logging.CRITICAL)
+    cfg = Swarky.load_config(Path(sys.argv[1]))
+    Swarky._process_candidate = lambda *a, **k: os._exit(3)   # muore a metà batch
+    Swarky.run_once(cfg)
+"""
+
+
+class SingleNodeTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        self.cfg = Swarky.load_config(_sandbox(self.root, LEASE_SEC=300))
+        self.hp = self.cfg.DIR_HPLOTTER
+        (self.hp / "DAK100000R01S01M.tif").write_bytes(_tiff())
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write_maint_lease(self, expires: float) -> None:
+        d = self.hp / Swarky._LEASES_DIRNAME / Swarky._SINGLE_NODE_LEASE
+        d.mkdir(parents=True)
+        (d / "1.lease").write_text(json.dumps({"node": None, "nonce": "m", "expires": expires}))
+
+    def test_restart_after_crash_is_not_blocked(self):
+        p = _spawn(CRASH, str(self.root / "config.json"))
+        p.communicate(timeout=60)
+        self.assertEqual(p.returncode, 3)
+        t0 = time.monotonic()
+        self.assertTrue(Swarky.run_once(self.cfg))
+        self.assertLess(time.monotonic() - t0, 10)           # niente attesa di LEASE_SEC
+        self.assertFalse(list(self.hp.glob("*.tif")))
+        self.assertFalse((self.hp / Swarky._LEASES_DIRNAME).exists())   # nessun lease scritto
+
+    def test_live_maintenance_defers_batch_without_waiting(self):
+        self._write_maint_lease(time.time() + 300)
+        t0 = time.monotonic()
+        self.assertFalse(Swarky.run_once(self.cfg))
+        self.assertLess(time.monotonic() - t0, 10)
+        self.assertTrue((self.hp / "DAK100000R01S01M.tif").exists())
+
+    def test_expired_maintenance_lease_is_ignored(self):
+        self._write_maint_lease(time.time() - 1)
+        self.assertTrue(Swarky.run_once(self.cfg))
+        self.assertFalse(list(self.hp.glob("*.tif")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""API locale del servizio: forma delle risposte di /status, /events e /run."""
+import json
+import logging
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from test_multinode import _sandbox, _tiff
+
+import Swarky
+
+STATUS_KEYS = {"running", "phase", "queue_depth", "batches", "files_total", "files_per_min",
+               "last_batch_sec", "last_seq", "uptime_sec", "started", "stuck"}
+
+
+class StatusApiTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        self.cfg = Swarky.load_config(_sandbox(self.root))
+        self.status = Swarky._StatusHandler()
+        root = logging.getLogger()
+        self._level = root.level
+        root.setLevel(logging.INFO)                   # come dopo setup_logging nel servizio
+        root.addHandler(self.status)
+        self.wake = threading.Event()
+        self.server = Swarky._make_status_server(self.status, self.wake, 0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        logging.getLogger().removeHandler(self.status)
+        logging.getLogger().setLevel(self._level)
+        self._tmp.cleanup()
+
+    def _get(self, path: str, method: str = "GET"):
+        with urlopen(Request(self.base + path, method=method), timeout=10) as r:
+            return r.status, r.headers.get_content_type(), r.read().decode("utf-8")
+
+    def test_status_shape_before_and_after_a_batch(self):
+        code, ctype, body = self._get("/status")
+        st = json.loads(body)
+        self.assertEqual((code, ctype), (200, "application/json"))
+        self.assertEqual(set(st), STATUS_KEYS)
+        self.assertEqual((st["running"], st["batches"], st["files_total"], st["last_seq"]), (False, 0, 0, 0))
+        self.assertEqual(st["stuck"], [])
+
+        for nm in ("DAK100000R01S01M.tif", "DAK100001R01S01X.tif"):
+            (self.cfg.DIR_HPLOTTER / nm).write_bytes(_tiff())
+        Swarky.run_once(self.cfg)
+        st = json.loads(self._get("/status")[2])
+        self.assertEqual(set(st), STATUS_KEYS)
+        self.assertEqual((st["running"], st["queue_depth"], st["batches"], st["files_total"]), (False, 0, 1, 2))
+        self.assertEqual(st["last_seq"], 2)
+        self.assertIsInstance(st["files_per_min"], float)
+
+    def test_events_since_cursor_is_ndjson(self):
+        for nm in ("DAK100000R01S01M.tif", "DAK100001R01S01X.tif"):
+            (self.cfg.DIR_HPLOTTER / nm).write_bytes(_tiff())
+        Swarky.run_once(self.cfg)
+        code, ctype, body = self._get("/events?since=0")
+        self.assertEqual((code, ctype), (200, "application/x-ndjson"))
+        evs = [json.loads(ln) for ln in body.splitlines()]
+        self.assertEqual([ev["seq"] for ev in evs], [1, 2])
+        by_kind = {ev["kind"]: ev for ev in evs}
+        self.assertEqual(set(by_kind["processed"]), {"seq", "ts", "kind", "file", "process", "compare", "dest"})
+        self.assertEqual(set(by_kind["anomaly"]), {"seq", "ts", "kind", "file", "error"})
+        self.assertEqual(by_kind["anomaly"]["file"], "DAK100001R01S01X.tif")
+        self.assertEqual(self._get("/events?since=2")[2], "")
+        self.assertEqual(self._get("/events?since=abc")[2], body)      # cursore non numerico: da capo
+
+    def test_run_wakes_the_loop_and_unknown_paths_are_404(self):
+        code, _, body = self._get("/run", "POST")
+        self.assertEqual((code, json.loads(body)), (202, {"queued": True}))
+        self.assertTrue(self.wake.is_set())
+        for path, method in (("/nope", "GET"), ("/status", "POST")):
+            with self.assertRaises(HTTPError) as cm:
+                self._get(path, method)
+            self.assertEqual(cm.exception.code, 404)
+            self.assertEqual(json.loads(cm.exception.read()), {"error": "not found"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""Verifica TIFF profonda: struttura integra, file troncati o corrotti, scarto nel batch."""
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+
+from test_multinode import _sandbox, _tiff
+
+import Swarky
+
+
+def _page(w: int, h: int, data_off: int, nbytes: int, nxt: int = 0, comp: int = 1) -> bytes:
+    ents = [(256, 3, 1, w), (257, 3, 1, h), (258, 3, 1, 1), (259, 3, 1, comp),
+            (273, 4, 1, data_off), (278, 3, 1, h), (279, 4, 1, nbytes)]
+    ifd = struct.pack("<H", len(ents)) + b"".join(struct.pack("<HHII", *e) for e in ents)
+    return ifd + struct.pack("<I", nxt)
+
+
+def _good(w: int = 300, h: int = 100, pages: int = 1) -> bytes:
+    """TIFF bilivello non compresso, una strip per pagina, IFD e dati in sequenza."""
+    nbytes = -(-w // 8) * h
+    ifd_sz = 2 + 7 * 12 + 4
+    body = b"II" + struct.pack("<HI", 42, 8)
+    for k in range(pages):
+        at = len(body)
+        nxt = at + ifd_sz + nbytes if k < pages - 1 else 0
+        body += _page(w, h, at + ifd_sz, nbytes, nxt) + b"\0" * nbytes
+    return body
+
+
+class TiffDeepCheckTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _check(self, data: bytes):
+        p = self.root / "x.tif"
+        p.write_bytes(data)
+        return Swarky.tiff_deep_check(p)
+
+    def test_intact_single_and_multi_page(self):
+        self.assertEqual(self._check(_good()), (1, None))
+        self.assertEqual(self._check(_good(pages=3)), (3, None))
+
+    def test_truncated_and_corrupt_files(self):
+        good = _good()
+        self.assertEqual(self._check(good[:6]), (0, "file troncato"))
+        self.assertEqual(self._check(b"PK" + good[2:]), (0, "intestazione non TIFF"))
+        self.assertEqual(self._check(good[:-10]), (1, "pagina 1: strip 1 fuori dal file (file troncato)"))
+        self.assertEqual(self._check(good[:50]), (0, "pagina 1: IFD troncato"))
+        self.assertEqual(self._check(_tiff()), (1, "pagina 1: strip mancanti"))
+        cyc = bytearray(_good(pages=2))
+        struct.pack_into("<I", cyc, 8 + 2 + 7 * 12, 8)           # pagina 1 -> di nuovo pagina 1
+        self.assertEqual(self._check(bytes(cyc)), (1, "pagina 2: IFD ciclico"))
+        bad = bytearray(good)
+        struct.pack_into("<I", bad, 8 + 2 + 3 * 12 + 8, 999)     # compressione inesistente
+        self.assertEqual(self._check(bytes(bad)), (1, "pagina 1: compressione 999 sconosciuta"))
+
+    def test_batch_sends_damaged_tiff_to_error_dir(self):
+        cfg = Swarky.load_config(_sandbox(self.root, DEEP_TIFF_CHECK=True))
+        ok, broken = "DAK100000R01S01M.tif", "DAK100001R01S01M.tif"
+        (cfg.DIR_HPLOTTER / ok).write_bytes(_good())
+        (cfg.DIR_HPLOTTER / broken).write_bytes(_good()[:-10])
+        Swarky.run_once(cfg)
+        self.assertTrue((cfg.ERROR_DIR / broken).exists())
+        self.assertFalse((cfg.ERROR_DIR / ok).exists())
+        self.assertFalse(list(cfg.DIR_HPLOTTER.glob("*.tif")))
+        log = "".join(p.read_text(encoding="utf-8") for p in (self.root / "logs").glob("Swarky*.log"))
+        self.assertIn(f"{broken}\t# ERRORE\t# TIFF Danneggiato", log)
+
+
+if __name__ == "__main__":
+    unittest.main()